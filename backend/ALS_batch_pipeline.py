@@ -0,0 +1,581 @@
+"""
+ALS_batch_pipeline.py
+Functions that schedule the chunk loop of batch reconstructions (eg. overlapping the read, recon and write of consecutive chunks, or spreading chunks over several GPUs)
+Kept separate from ALS_batch_recon.py so they can be used from notebooks without the batch script entry point
+"""
+
+import os
+import threading
+import queue
+import time
+import subprocess
+import importlib
+import traceback
+import json
+import hashlib
+import platform
+import multiprocessing as mp
+import numpy as np
+import ALS_recon_io as als_io
+import ALS_recon_resources as resources
+
+_DONE = object() # sentinel passed down the pipeline once all chunks have been submitted
+
+def run_chunk_pipeline(chunks, stages, queue_depth=2, verbose=True):
+    """ Streams chunks through a list of stages, each running in its own thread and connected by bounded queues.
+        This lets chunk N+1 be read while chunk N is reconstructed and chunk N-1 is written, so disk, CPU and GPU are busy at the same time.
+        chunks: iterable of items passed to the first stage (eg. (start_slice, stop_slice) tuples)
+        stages: list of (name, function) tuples. Each function takes the output of the previous stage. The output of the last stage is discarded
+        queue_depth: max number of items waiting between two stages. Bounds memory to roughly queue_depth+1 chunks per stage
+        verbose: whether to print per-stage utilization at the end
+
+        Returns dictionary of per-stage stats (see print_pipeline_stats). Any exception raised in a stage is re-raised here
+    """
+    assert queue_depth >= 1, f"queue_depth must be at least 1, but got: {queue_depth}"
+    queues = [queue.Queue(maxsize=queue_depth) for _ in range(len(stages)-1)]
+    stats = {name: {'busy': 0., 'wait_in': 0., 'wait_out': 0., 'items': 0} for name, _ in stages}
+    errors = []
+    abort = threading.Event()
+
+    def put(q, item, stage_stats):
+        # blocking put that gives up if another stage failed (otherwise we could deadlock on a full queue)
+        tic = time.time()
+        while not abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stage_stats['wait_out'] += time.time() - tic
+
+    def get(q, stage_stats):
+        tic = time.time()
+        item = _DONE
+        while not abort.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        stage_stats['wait_in'] += time.time() - tic
+        return item
+
+    def run_stage(i, name, func):
+        stage_stats = stats[name]
+        q_in = queues[i-1] if i > 0 else None
+        q_out = queues[i] if i < len(queues) else None
+        source = iter(chunks) if q_in is None else None
+        try:
+            while not abort.is_set():
+                if source is not None:
+                    item = next(source, _DONE)
+                else:
+                    item = get(q_in, stage_stats)
+                if item is _DONE:
+                    break
+                tic = time.time()
+                result = func(item)
+                stage_stats['busy'] += time.time() - tic
+                stage_stats['items'] += 1
+                if q_out is not None:
+                    put(q_out, result, stage_stats)
+        except BaseException as e:
+            errors.append((name, e))
+            abort.set()
+        finally:
+            if q_out is not None:
+                put(q_out, _DONE, stage_stats)
+
+    tic0 = time.time()
+    threads = [threading.Thread(target=run_stage, args=(i, name, func), name=f"pipeline-{name}", daemon=True)
+               for i, (name, func) in enumerate(stages)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - tic0
+
+    for name in stats:
+        stats[name]['wall'] = wall
+        stats[name]['utilization'] = stats[name]['busy']/wall if wall > 0 else 0.
+    if errors:
+        name, e = errors[0]
+        print(f"Pipeline stage '{name}' failed: {e!r}")
+        raise e
+    if verbose:
+        print_pipeline_stats(stats)
+    return stats
+
+def print_pipeline_stats(stats):
+    """ Prints per-stage utilization from run_chunk_pipeline.
+        busy: time spent doing work. wait in/out: time blocked waiting on the previous/next stage. A stage with high utilization and the others mostly waiting on it is the bottleneck
+    """
+    print(f"{'stage':>10} {'items':>6} {'busy (s)':>10} {'wait in (s)':>12} {'wait out (s)':>13} {'utilization':>12}")
+    for name, s in stats.items():
+        print(f"{name:>10} {s['items']:>6d} {s['busy']:>10.1f} {s['wait_in']:>12.1f} {s['wait_out']:>13.1f} {100*s['utilization']:>11.0f}%")
+
+def get_num_gpus():
+    """ Number of Nvidia GPUs visible to this process (0 if none or nvidia-smi not found) """
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible is not None:
+        return len([d for d in visible.split(',') if d.strip()])
+    try:
+        out = subprocess.check_output(['nvidia-smi', '-L'], stderr=subprocess.DEVNULL).decode('utf-8')
+        return len([line for line in out.splitlines() if line.startswith('GPU')])
+    except Exception:
+        return 0
+
+def get_worker_assignments(num_workers, backend="gpu"):
+    """ Splits node resources between workers. Returns list of (gpu index or None, list of cpu cores), one per worker
+        num_workers: number of workers. "auto" means one per GPU (gpu backend) or 1 (cpu backend)
+        backend: "gpu" pins each worker to one GPU (round robin if more workers than GPUs). "cpu" gives workers no GPU
+    """
+    num_gpus = get_num_gpus() if backend == "gpu" else 0
+    if backend == "gpu" and num_gpus == 0:
+        print("No GPU found for gpu worker backend, using cpu backend")
+        backend = "cpu"
+    if num_workers == "auto":
+        num_workers = num_gpus if backend == "gpu" else 1
+    cores = resources.get_available_cores()
+    if num_workers <= len(cores):
+        core_sets = [list(c) for c in np.array_split(cores, num_workers)] # contiguous blocks, so workers don't share cores
+    else:
+        print(f"More workers ({num_workers}) than available cores ({len(cores)}), workers will share cores")
+        core_sets = [[cores[i % len(cores)]] for i in range(num_workers)]
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    gpu_ids = [d.strip() for d in visible.split(',')] if visible else [str(i) for i in range(num_gpus)]
+    return [(gpu_ids[i % num_gpus] if backend == "gpu" else None, [int(c) for c in core_sets[i]]) for i in range(num_workers)]
+
+_DONE_MARKER = "done" # sent by a worker process when it exits
+
+def _worker_env(gpu, cores):
+    # environment for a worker process. Has to be in place when the process starts, since spawn re-imports the main script (and so CUDA, numexpr, OpenMP libraries) before running the worker
+    env = {'CUDA_VISIBLE_DEVICES': str(gpu) if gpu is not None else ''} # cpu workers shouldn't grab a GPU
+    env.update(resources.get_thread_env(len(cores))) # one thread per core of the worker's block (see ALS_recon_resources)
+    return env
+
+def _pin_worker(gpu, cores):
+    os.environ.update(_worker_env(gpu, cores))
+    resources.configure(num_threads=len(cores), cores=cores)
+
+def _worker_main(worker_id, gpu, cores, worker_spec, worker_args, tasks, results):
+    """ Runs in each worker process: pins itself, creates the worker object, then reconstructs chunks from the shared queue until it gets None """
+    _pin_worker(gpu, cores)
+    resources.check_oversubscription()
+    module_name, class_name = worker_spec
+    worker_class = getattr(importlib.import_module(module_name), class_name) # imported after pinning, so CUDA only sees our GPU
+    worker = None
+    try:
+        worker = worker_class(*worker_args, use_gpu=gpu is not None)
+        while True:
+            chunk = tasks.get()
+            if chunk is None:
+                break
+            tic = time.time()
+            try:
+                worker(chunk)
+                results.put((worker_id, chunk, time.time()-tic, None))
+            except Exception:
+                results.put((worker_id, chunk, time.time()-tic, traceback.format_exc()))
+    except Exception:
+        results.put((worker_id, None, 0., traceback.format_exc()))
+    finally:
+        if worker is not None:
+            worker.close()
+        results.put((worker_id, _DONE_MARKER, 0., None))
+
+def run_chunk_workers(chunks, worker_spec, worker_args, num_workers="auto", backend="gpu", verbose=True):
+    """ Reconstructs chunks with a pool of worker processes that each take the next chunk from a shared queue. Each worker is pinned to its own GPU (gpu backend) and block of cpu cores, and writes its own results.
+        chunks: list of chunks (eg. (start_slice, stop_slice) tuples)
+        worker_spec: (module name, class name) of the worker. Created in each process as worker_class(*worker_args, use_gpu=...), then called as worker(chunk) for each chunk, and finally worker.close()
+            Given by name so it's imported only after the process is pinned to its GPU
+        worker_args: tuple of arguments for worker class (must be picklable)
+        num_workers: number of worker processes. "auto" means one per GPU (gpu backend) or 1 (cpu backend)
+        backend: "gpu" or "cpu" (no GPU, eg. CPU nodes or testing). See get_worker_assignments
+
+        Returns dictionary of per-worker stats. Raises RuntimeError listing any chunks that failed, after all other chunks have finished
+    """
+    assignments = get_worker_assignments(num_workers, backend)
+    ctx = mp.get_context("spawn") # fork would copy CUDA/h5py state from parent
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    for chunk in chunks:
+        tasks.put(chunk)
+    for _ in assignments:
+        tasks.put(None)
+
+    tic0 = time.time()
+    procs = []
+    for worker_id, (gpu, cores) in enumerate(assignments):
+        if verbose:
+            print(f"Starting worker {worker_id}: GPU {gpu}, cores {cores[0]}-{cores[-1]}")
+        p = ctx.Process(target=_worker_main, args=(worker_id, gpu, cores, worker_spec, worker_args, tasks, results),
+                        name=f"chunk-worker-{worker_id}")
+        env = _worker_env(gpu, cores)
+        saved_env = {var: os.environ.get(var) for var in env}
+        os.environ.update(env) # child inherits environment at start
+        try:
+            p.start()
+        finally:
+            for var, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+        procs.append(p)
+
+    stats = {worker_id: {'busy': 0., 'items': 0} for worker_id in range(len(procs))}
+    failed = []
+    running = set(range(len(procs)))
+    while running:
+        try:
+            worker_id, chunk, seconds, error = results.get(timeout=1)
+        except queue.Empty:
+            for worker_id in list(running): # worker died without saying goodbye (eg. segfault or out of memory)
+                if not procs[worker_id].is_alive():
+                    print(f"Worker {worker_id} exited unexpectedly (exit code {procs[worker_id].exitcode})")
+                    failed.append((worker_id, None, f"exit code {procs[worker_id].exitcode}"))
+                    running.discard(worker_id)
+            continue
+        if chunk == _DONE_MARKER:
+            running.discard(worker_id)
+            continue
+        if error is not None:
+            print(f"Worker {worker_id} failed on chunk {chunk}:\n{error}")
+            failed.append((worker_id, chunk, error))
+            continue
+        stats[worker_id]['busy'] += seconds
+        stats[worker_id]['items'] += 1
+        if verbose:
+            print(f"Worker {worker_id} finished slices {chunk[0]}-{chunk[1]}, took {seconds:.1f} sec")
+    for p in procs:
+        p.join()
+
+    wall = time.time() - tic0
+    for worker_id in stats:
+        stats[worker_id]['wall'] = wall
+        stats[worker_id]['utilization'] = stats[worker_id]['busy']/wall if wall > 0 else 0.
+    if verbose:
+        for worker_id, s in stats.items():
+            print(f"Worker {worker_id}: {s['items']} chunks, busy {s['busy']:.1f} sec ({100*s['utilization']:.0f}%)")
+    if failed:
+        raise RuntimeError(f"{len(failed)} chunk(s) failed: {[chunk for _, chunk, _ in failed]}")
+    return stats
+
+def get_available_memory():
+    """ Host memory available for new allocations, in bytes (MemAvailable from /proc/meminfo, or total physical memory if that isn't there) """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+
+def get_gpu_free_memory():
+    """ Free memory on the visible GPU with the least free memory, in bytes. None if no GPU (or nvidia-smi not found) """
+    cmd = ['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits']
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible:
+        cmd += ['-i', visible]
+    try:
+        out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode('utf-8')
+        return min(int(line) for line in out.split()) * 1024**2 # reported in MiB
+    except Exception:
+        return None
+
+def get_peak_memory(children=False):
+    """ Peak resident memory so far, in bytes, of this process (or of its finished child processes, eg. run_chunk_workers workers) """
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss*1024 # kB on Linux
+
+def estimate_slice_memory(path, settings, algorithm="astra"):
+    """ Estimates memory needed per slice of a chunk, for the reading/preprocessing and reconstruction steps of a batch job. Rough (errs on the high side), but scales correctly with detector width, angles, downsampling and 360 stitching.
+        path: full path to .h5 file
+        settings: reconstruction settings dictionary (uses "data", "preprocess", "postprocess" and "recon" or "svmbir_settings")
+        algorithm: "astra" (any non-SVMBIR method) or "svmbir"
+
+        Returns dictionary of bytes per slice:
+            read: peak while reading and preprocessing one chunk
+            tomo: size of a preprocessed chunk (what waits between read and recon)
+            recon: peak while reconstructing one chunk
+            output: size of a reconstructed chunk (what waits to be written)
+            gpu: GPU memory for one slice (Astra reconstructs slice by slice, so this doesn't grow with chunk size)
+    """
+    dataset = als_io.open_dataset(path)
+    num_angles, _, num_rays = dataset.data_shape
+    num_angles = len(range(num_angles)[als_io.as_slice(settings["data"]["angles_ind"])])
+    itemsize = dataset.file['/exchange/data'].dtype.itemsize
+    num_frames = dataset.file['/exchange/data_white'].shape[0] + dataset.file['/exchange/data_dark'].shape[0]
+    f = settings["data"]["proj_downsample"] or 1
+    pre = settings.get("preprocess") or {}
+    post = settings.get("postprocess") or {}
+    recon_settings = settings["svmbir_settings"] if algorithm == "svmbir" else settings["recon"]
+
+    px = 4*num_angles*num_rays # float32 sinogram
+    est = {}
+    # read raw data then convert to float32 working copy. Flat/dark frames are read once per slice and averaged
+    read = [itemsize*px/4 + px, 4*num_frames*num_rays]
+    if pre.get('sm_size'):
+        read.append(3*px) # remove_all_stripe returns a new array, plus sorting/filtering scratch
+    if pre.get('outlier_diff_1D') or pre.get('outlier_diff_2D'):
+        read.append(2*px) # median filter output before copying back
+    ds = px/f**2 # downsampling bins slices and rays
+    if f > 1:
+        read.append(px + ds)
+    if post.get('ringSigma'):
+        read.append(3*ds) # remove_stripe_fw output plus wavelet coefficients
+    if dataset.metadata['angularrange'] > 300: # 360 to 180 stitching: half the angles, up to twice the rays
+        COR = recon_settings.get("COR")
+        stitched_rays = num_rays + 2*abs(COR) if COR is not None else 2*num_rays
+        stitched_rays = min(stitched_rays, 2*num_rays) / f
+        stitched = 4*(num_angles//2)*stitched_rays/f
+        read.append(ds + stitched)
+    else:
+        stitched_rays = num_rays / f
+        stitched = ds
+    est['read'] = max(read)
+    est['tomo'] = stitched
+
+    est['output'] = 4*stitched_rays**2/f # recon is rays x rays, slices are also downsampled
+    recon = stitched + stitched + est['output'] # tomopy.recon makes its own float32 copy
+    if algorithm != "svmbir" and recon_settings.get("fc", 1) != 1:
+        recon += stitched # LP filter writes a filtered float32 copy (see ALS_recon_functions.filter_sinograms)
+    if algorithm != "svmbir" and recon_settings.get("method") == "fbp_numpy":
+        recon += est['output'] # backprojects into (pixels, slices) then transposes, instead of tomopy's copy of the input
+    if algorithm == "svmbir":
+        recon += 2*stitched + 2*est['output'] # shifted sinogram, weights, FBP init image and svmbir's own output
+    est['recon'] = recon
+    est['gpu'] = 4*(num_angles//2 if dataset.metadata['angularrange'] > 300 else num_angles)*stitched_rays + 4*stitched_rays**2
+    return est
+
+def plan_chunk_size(path, settings, algorithm="astra", num_workers=1, pipelined=True, queue_depth=1,
+                    memory_GB=None, memory_fraction=0.7, min_chunk=1, max_chunk=None, verbose=True):
+    """ Picks the largest chunk (number of slices) whose estimated peak memory fits in a memory budget. See estimate_slice_memory.
+        path: full path to .h5 file
+        settings: reconstruction settings dictionary
+        algorithm: "astra" or "svmbir"
+        num_workers: number of processes on this node sharing the memory (workers or MPI ranks)
+        pipelined: whether read, recon and write run at the same time (see run_chunk_pipeline). Otherwise they run one after the other, with writes in the background
+        queue_depth: chunks allowed to wait between pipeline stages
+        memory_GB: memory budget for the whole node. None means memory_fraction of currently available memory
+        memory_fraction: fraction of available memory to use when memory_GB is None (leaves room for libraries, page cache, and our estimates being off)
+        min_chunk, max_chunk: limits on the result. max_chunk None means the number of slices being reconstructed
+
+        Returns number of slices per chunk, and dictionary describing the plan (also printed if verbose)
+    """
+    num_slices = settings["data"]["stop_slice"] - settings["data"]["start_slice"] + 1
+    if max_chunk is None:
+        max_chunk = num_slices
+    available = get_available_memory()
+    budget = memory_GB*1024**3 if memory_GB is not None else memory_fraction*available
+    budget_per_worker = budget/num_workers
+    est = estimate_slice_memory(path, settings, algorithm)
+    if pipelined: # reader, recon and writer each hold a chunk, plus whatever waits in the queues between them
+        per_slice = est['read'] + est['recon'] + est['output'] + queue_depth*(est['tomo'] + est['output'])
+    else:
+        per_slice = max(est['read'], est['recon']) + queue_depth*est['output']
+    nchunk = int(np.clip(budget_per_worker // per_slice, min_chunk, max(min_chunk, max_chunk)))
+
+    plan = {'nchunk': nchunk,
+            'bytes_per_slice': per_slice,
+            'planned_bytes': nchunk*per_slice*num_workers,
+            'budget_bytes': budget,
+            'available_bytes': available,
+            'gpu_bytes': est['gpu'],
+            'gpu_free_bytes': get_gpu_free_memory() if algorithm != "svmbir" else None,
+            'estimate': est}
+    if verbose:
+        print(f"Chunk plan: {nchunk} slices per chunk, {num_workers} worker(s). Estimated {per_slice/1024**2:.1f} MB per slice, "
+              f"{plan['planned_bytes']/1024**3:.1f} GB total of {budget/1024**3:.1f} GB budget ({available/1024**3:.1f} GB available)")
+        if plan['gpu_free_bytes'] is not None:
+            print(f"GPU memory per slice: {est['gpu']/1024**2:.1f} MB ({plan['gpu_free_bytes']/1024**3:.1f} GB free)")
+    if nchunk*per_slice > budget_per_worker:
+        print(f"Warning: even {nchunk} slice(s) per chunk is estimated to exceed the memory budget")
+    if plan['gpu_free_bytes'] is not None and est['gpu'] > plan['gpu_free_bytes']:
+        print(f"Warning: one slice is estimated to need more GPU memory than is free")
+    return nchunk, plan
+
+def print_memory_report(plan, children=False):
+    """ Prints measured peak memory next to what plan_chunk_size planned for, so the estimates can be checked (and chunk sizes tuned) """
+    peak = get_peak_memory(children=children)
+    print(f"Measured peak memory: {peak/1024**3:.1f} GB per process (planned {plan['planned_bytes']/1024**3:.1f} GB total, budget {plan['budget_bytes']/1024**3:.1f} GB)")
+
+class StaticChunkSchedule:
+    """ Round robin assignment of chunks to MPI ranks (rank takes chunks rank, rank+size, ...). No communication, but the job lasts as long as the slowest rank.
+        Iterate over it to get this rank's chunks. Same interface as MPIChunkQueue
+    """
+    def __init__(self, chunks, comm):
+        self.chunks = list(chunks)[comm.Get_rank()::comm.Get_size()]
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def free(self):
+        pass
+
+class MPIChunkQueue:
+    """ Dynamic assignment of chunks to MPI ranks: a shared counter lives in a one-sided MPI window on rank 0, and each rank atomically takes the next chunk index (fetch and add) whenever it finishes one.
+        Fast ranks take more chunks, so stragglers (eg. slow nodes, or chunks with more content) don't hold up the job. No rank has to stop working to act as coordinator.
+        Iterate over it to get this rank's chunks. Creating it and free() are collective (all ranks must call them)
+    """
+    def __init__(self, chunks, comm):
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.chunks = list(chunks)
+        self.comm = comm
+        itemsize = MPI.INT64_T.Get_size()
+        self.win = MPI.Win.Allocate(itemsize if comm.Get_rank() == 0 else 0, itemsize, comm=comm)
+        if comm.Get_rank() == 0: # window memory isn't initialized
+            self.win.Lock(0)
+            self.win.Put(np.zeros(1, dtype=np.int64), 0)
+            self.win.Unlock(0)
+        comm.Barrier()
+
+    def next_index(self):
+        """ Takes the next chunk index from the shared counter. Indices past the last chunk mean there's nothing left """
+        one = np.ones(1, dtype=np.int64)
+        index = np.zeros(1, dtype=np.int64)
+        self.win.Lock(0, self.MPI.LOCK_SHARED)
+        self.win.Fetch_and_op(one, index, 0, 0, self.MPI.SUM)
+        self.win.Unlock(0)
+        return int(index[0])
+
+    def __iter__(self):
+        while True:
+            i = self.next_index()
+            if i >= len(self.chunks):
+                return
+            yield self.chunks[i]
+
+    def free(self):
+        self.comm.Barrier() # nobody may still be using the counter
+        self.win.Free()
+
+MPI_SCHEDULERS = {"static": StaticChunkSchedule, "dynamic": MPIChunkQueue}
+
+def print_rank_stats(comm, items, busy):
+    """ Gathers how many chunks each MPI rank reconstructed and how long it was busy, and prints a summary on rank 0 (idle time at the end shows load imbalance) """
+    stats = comm.gather((items, busy), root=0)
+    if comm.Get_rank() == 0:
+        items, busy = np.array([s[0] for s in stats]), np.array([s[1] for s in stats])
+        print(f"Chunks per rank: min {items.min()}, max {items.max()}. Busy time per rank: min {busy.min():.0f} sec, mean {busy.mean():.0f} sec, max {busy.max():.0f} sec")
+        print(f"Idle rank time from imbalance: {np.sum(busy.max()-busy):.0f} sec ({100*(1-busy.mean()/busy.max()) if busy.max() > 0 else 0:.0f}%)")
+
+# batch settings that only change how a job runs, not what it writes. Changing these doesn't invalidate a manifest
+MANIFEST_IGNORED_BATCH_KEYS = ["pipeline", "queue_depth", "num_workers", "worker_backend", "chunk_slices", "memory_GB", "memory_fraction", "scheduler", "sinogram_store", "sinogram_store_GB", "trace", "record_timings"]
+
+def settings_hash(settings):
+    """ Short hash of everything in settings that affects the output (so a rerun can tell whether finished chunks are still valid) """
+    settings = {key: value for key, value in settings.items() if key != "batch"}
+    settings["batch"] = {key: value for key, value in (settings.get("batch") or {}).items() if key not in MANIFEST_IGNORED_BATCH_KEYS}
+    text = json.dumps(settings, sort_keys=True, default=repr) # repr for slices, numpy values, etc.
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+MANIFEST_DIR = ".batch_manifest" # hidden directory in save_dir for the job's own bookkeeping (chunk manifests, file locks of shared writers), so it isn't mixed with the output
+
+class ChunkManifest:
+    """ Record of which slices a batch job has finished, so a job that hit its time limit can be resubmitted and pick up where it stopped.
+        Kept in save_dir/.batch_manifest/<settings hash>/, so changing reconstruction settings starts over. Each finished chunk is its own small json file,
+        written atomically (write temporary file then rename), so several processes can record chunks at once and a killed job never leaves a half written record.
+        save_dir: output directory of the job
+        settings: reconstruction settings dictionary. Hash should be taken before anything fills in settings (eg. automatic COR)
+    """
+    def __init__(self, save_dir, settings):
+        self.key = settings_hash(settings)
+        self.directory = os.path.join(save_dir, MANIFEST_DIR, self.key)
+
+    def create(self, settings):
+        """ Creates manifest directory, with a copy of the settings for reference. Call from one process only """
+        os.makedirs(self.directory, exist_ok=True)
+        settings_file = os.path.join(self.directory, "settings.json")
+        if not os.path.exists(settings_file):
+            self._write_json(settings_file, settings)
+
+    @staticmethod
+    def _write_json(fname, obj):
+        tmp = f"{fname}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(obj, f, indent=1, default=repr)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fname) # atomic
+
+    def _record_name(self, start, stop):
+        return os.path.join(self.directory, f"chunk_{start:06d}_{stop:06d}.json")
+
+    def mark_done(self, start, stop, **info):
+        """ Records slices start to stop (not inclusive) as finished. Call only once they are safely written """
+        self._write_json(self._record_name(start, stop), dict(start=start, stop=stop, time=time.time(), host=platform.node(), **info))
+
+    def completed(self):
+        """ List of (start, stop) slice ranges recorded as finished """
+        if not os.path.isdir(self.directory):
+            return []
+        done = []
+        for fname in sorted(os.listdir(self.directory)):
+            if fname.startswith("chunk_") and fname.endswith(".json"):
+                try:
+                    with open(os.path.join(self.directory, fname)) as f:
+                        record = json.load(f)
+                    done.append((record['start'], record['stop']))
+                except (OSError, ValueError, KeyError):
+                    pass
+        return done
+
+    def verify(self, writer):
+        """ Checks that each recorded chunk is really in the output (see has_slices of volume writers), and forgets any that aren't. Call from one process only.
+            Returns list of (start, stop) slice ranges that are finished
+        """
+        done = []
+        for start, stop in self.completed():
+            if writer.has_slices(start, stop):
+                done.append((start, stop))
+            else:
+                print(f"Slices {start}-{stop} are in manifest but missing from output, will reconstruct them again")
+                os.remove(self._record_name(start, stop))
+        return done
+
+    def remaining_chunks(self, start_slice, stop_slice, nchunk, done=None, align=1):
+        """ Splits slices start_slice to stop_slice (inclusive) that aren't finished into chunks of at most nchunk slices. Returns list of (start, stop) like get_chunk_ranges
+            done: finished ranges (eg. from verify). None means read from manifest
+            align: unfinished ranges are widened to multiples of align slices from start_slice (eg. so pyramid level slices are never split between runs). nchunk should be a multiple of align
+        """
+        if done is None:
+            done = self.completed()
+        finished = np.zeros(stop_slice-start_slice+1, dtype=bool)
+        for start, stop in done:
+            finished[max(start-start_slice, 0):max(stop-start_slice, 0)] = True
+        todo = ~finished
+        if align > 1: # any unfinished slice makes its whole aligned block unfinished
+            blocks = np.pad(todo, (0, -len(todo) % align)).reshape(-1, align).any(axis=1)
+            todo = np.repeat(blocks, align)[:len(todo)]
+        # runs of unfinished slices, then split each run into chunks
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], todo.astype(np.int8), [0]])))
+        chunks = []
+        for lo, hi in zip(edges[::2], edges[1::2]):
+            for start in range(lo, hi, nchunk):
+                chunks.append((start_slice+int(start), start_slice+int(min(start+nchunk, hi))))
+        return chunks
+
+class ManifestWriter:
+    """ Wraps a volume writer so each chunk is recorded in a ChunkManifest once it has been written and flushed to disk """
+    def __init__(self, writer, manifest):
+        self.writer = writer
+        self.manifest = manifest
+
+    def write(self, data, start):
+        self.writer.write(data, start)
+        self.writer.flush()
+        self.manifest.mark_done(start, start+data.shape[0])
+
+    def has_slices(self, start, stop):
+        return self.writer.has_slices(start, stop)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
@@ -5,9 +5,7 @@ Functions that used to either set up reconstruction batch jobs, or used within t
 
 import sys
 import os
-import multiprocessing as mp
-os.environ['NUMEXPR_MAX_THREADS'] = str(mp.cpu_count()) # to avoid numexpr warning
-import numexpr
+import ALS_recon_resources as resources # first, so thread settings are in place before numexpr/tomopy start
 import numpy as np
 import dxchange
 import base64
@@ -15,12 +13,149 @@ import pickle
 import time
 import datetime
 import re
+import platform
+import traceback
 from pathlib import Path
 
 import ALS_recon_functions as als
 import ALS_recon_helper as helper
+import ALS_batch_pipeline as pipeline
+import ALS_recon_io as als_io
+import ALS_batch_timing as timing
+import ALS_recon_trace as trace
+import ALS_recon_cor as cor_finder
+import ALS_recon_svmbir_cache as svmbir_cache
+import ALS_recon_sinogram_store as sinogram_store
 
 MAX_JOB_SECONDS = 80*60 # 1 hour 20 min
+CHUNKS_PER_WORKER = 4 # "auto" chunk sizes leave every worker (or MPI rank) at least this many chunks, so pipeline stages overlap, fast workers take over from slow ones, and a resumed job redoes little
+SVMBIR_MAX_CHUNK = 8 # "auto" SVMBIR chunks are at most this many slices (SVMBIR is slow per slice, so small chunks cost little and balance better)
+
+# Options for how batch jobs are run (as opposed to what is reconstructed). Can be overridden with an optional settings["batch"] dictionary
+DEFAULT_BATCH_SETTINGS = {
+    "pipeline": True, # overlap read/preprocess, recon and write of consecutive chunks (see ALS_batch_pipeline.run_chunk_pipeline)
+    "queue_depth": 1, # how many chunks can wait between pipeline stages. Each waiting chunk costs memory
+    "writer": "tiff", # output format: "tiff" (one file per slice), "hdf5" or "zarr" (single chunked volume). See ALS_recon_io.get_volume_writer
+    "compression": None, # lossless compression for hdf5/zarr: None, "lz4", "zstd", "blosclz", or "gzip"/"lzf" (hdf5 only)
+    "output_dtype": "float32", # dtype of saved volumes: "float32", or "float16" to halve their size (cast in the same pass as masking and unit conversion, see ALS_recon_functions.finish_recon)
+    "pyramid_levels": None, # eg. [2,4,8] to also save 2x, 4x and 8x downsampled volumes for fast viewing (Astra only). See ALS_recon_io.PyramidWriter
+    "num_workers": "auto", # number of worker processes (Astra, or SVMBIR with "local" scheduler), each pinned to its own GPU and/or block of cores, taking chunks from a shared queue. "auto" means one per GPU for Astra, 1 for SVMBIR. See ALS_batch_pipeline.run_chunk_workers
+    "worker_backend": "gpu", # "gpu" or "cpu" (workers get no GPU, eg. on CPU nodes)
+    "chunk_slices": "auto", # slices per chunk. "auto" picks the largest chunk that fits the memory budget (see ALS_batch_pipeline.plan_chunk_size), leaving each worker CHUNKS_PER_WORKER chunks
+    "memory_GB": None, # memory budget for the node when chunk_slices is "auto". None means memory_fraction of available memory
+    "memory_fraction": 0.7,
+    "trace": False, # record time, data size and memory of every stage of every chunk (see ALS_recon_trace). Saved in <output>/traces/
+    "record_timings": True, # record chunk and job times, so future batch scripts can request a realistic wall time. See ALS_batch_timing
+    "resume": True, # record finished chunks in the output directory, so a resubmitted job (with the same settings) skips them. See ALS_batch_pipeline.ChunkManifest
+    "scheduler": "dynamic", # SVMBIR only: how chunks are shared out. "dynamic" (MPI ranks take the next chunk when ready), "static" (round robin over MPI ranks), or "local" (worker processes on this node, no MPI needed)
+    "sinogram_store": False, # keep processed sinograms on scratch, so a rerun with different reconstruction settings (method, fc, COR, SVMBIR parameters) skips reading and preprocessing. True for the default directory, or a directory. See ALS_recon_sinogram_store
+    "sinogram_store_GB": 500, # size limit of the sinogram store (least recently used scans are removed)
+}
+
+def get_batch_settings(settings):
+    """ Returns batch options from settings["batch"], with defaults for anything not set (older settings dictionaries won't have this key) """
+    batch_settings = dict(DEFAULT_BATCH_SETTINGS)
+    batch_settings.update(settings.get("batch") or {})
+    return batch_settings
+
+def get_chunk_ranges(start_slice, stop_slice, nchunk):
+    """ Splits slices start_slice to stop_slice (inclusive) into list of (start, stop) ranges of at most nchunk slices (stop not inclusive) """
+    chunks = []
+    for i in range(int(np.ceil((stop_slice-start_slice+1)/nchunk))):
+        start_iter = start_slice+i*nchunk
+        stop_iter = int(np.minimum(start_iter+nchunk,stop_slice+1))
+        chunks.append((start_iter,stop_iter))
+    return chunks
+
+def get_max_chunk(settings, num_workers, limit=None):
+    """ Largest "auto" chunk size: the slices being reconstructed shared out so every worker gets CHUNKS_PER_WORKER chunks
+        num_workers: total workers (or MPI ranks)
+        limit: absolute cap, or None
+    """
+    num_slices = settings["data"]['stop_slice']-settings["data"]['start_slice']+1
+    max_chunk = max(int(np.ceil(num_slices/(CHUNKS_PER_WORKER*num_workers))), 1)
+    return min(max_chunk, limit) if limit is not None else max_chunk
+
+def align_chunks(settings, nchunk, align=1):
+    """ Returns chunk size and alignment (see get_remaining_chunks) rounded up to whole downsampling blocks if the job uses a sinogram store, so every chunk can be stored (see ALS_recon_sinogram_store.SinogramStore.read_data)
+        nchunk: slices per chunk
+        align: alignment the job already needs (eg. pyramid levels)
+    """
+    factor = int(settings["data"]["proj_downsample"] or 1)
+    if not get_batch_settings(settings)["sinogram_store"] or factor == 1:
+        return nchunk, align
+    align = int(np.lcm(align, factor))
+    return -(-nchunk//align)*align, align
+
+def get_batch_writer(settings, save_dir, nchunk, shared=False):
+    """ Creates volume writer for batch output, as chosen in batch settings (see ALS_recon_io.get_volume_writer)
+        nchunk: slices per chunk
+        shared: whether several processes write to the output volume at the same time
+    """
+    batch_settings = get_batch_settings(settings)
+    return als_io.get_volume_writer(batch_settings["writer"], save_dir, settings["data"]["name"],
+                                    num_slices=settings["data"]['stop_slice']-settings["data"]['start_slice']+1,
+                                    start_slice=settings["data"]['start_slice'],
+                                    chunk_slices=nchunk,
+                                    compression=batch_settings["compression"],
+                                    shared=shared,
+                                    lock_dir=os.path.join(save_dir, pipeline.MANIFEST_DIR, "locks") if shared else None)
+
+def get_remaining_chunks(settings, save_dir, nchunk, manifest, align=1):
+    """ Returns chunk ranges still to reconstruct. With a manifest, checks which recorded chunks are really in the output and skips them (see ALS_batch_pipeline.ChunkManifest) """
+    if manifest is None:
+        return get_chunk_ranges(settings["data"]['start_slice'],settings["data"]['stop_slice'],nchunk)
+    done = manifest.verify(get_batch_writer(settings, save_dir, nchunk))
+    chunks = manifest.remaining_chunks(settings["data"]['start_slice'],settings["data"]['stop_slice'],nchunk, done=done, align=align)
+    num_done = settings["data"]['stop_slice']-settings["data"]['start_slice']+1 - sum(stop-start for start, stop in chunks)
+    if num_done:
+        print(f"Resuming: {num_done} slices already finished (manifest {manifest.directory}), {len(chunks)} chunks left")
+    return chunks
+
+def find_COR(settings, cor_settings, proj_downsample=1):
+    """ Fills in cor_settings["COR"] if it is None, measuring COR at many slice heights (see ALS_recon_cor.estimate_cor_profile).
+        A tilted rotation axis is stored as cor_settings["COR_slope"] (COR change per slice) and cor_settings["COR_slice"] (slice that COR is at), and each chunk gets its own COR (see get_chunk_COR)
+        cor_settings: settings["recon"] (COR in full resolution pixels) or settings["svmbir_settings"] (COR in pixels of downsampled projections)
+        proj_downsample: downsampling of the projections cor_settings["COR"] is used on
+    """
+    if cor_settings["COR"] is not None:
+        return
+    if not proj_downsample: proj_downsample = 1
+    profile = cor_finder.estimate_cor_profile(settings["data"]["data_path"]) # all slices, so tilt is measured over the full height
+    print(f"Estimated COR: {profile}")
+    cor_settings["COR"] = profile.COR/proj_downsample
+    cor_settings["COR_slope"] = profile.slope/proj_downsample
+    cor_settings["COR_slice"] = profile.reference_slice
+
+def get_chunk_COR(cor_settings, chunk):
+    """ COR for chunk of slices (start, stop): COR at the middle slice of the chunk if the rotation axis is tilted (cor_settings has a "COR_slope"), otherwise cor_settings["COR"] """
+    slope = cor_settings.get("COR_slope") or 0
+    if not slope:
+        return cor_settings["COR"]
+    return cor_settings["COR"] + slope*((chunk[0] + chunk[1] - 1)/2 - cor_settings.get("COR_slice", 0))
+
+def get_trace_dir(settings, save_dir):
+    """ Directory for this job's trace files, or None if tracing is off """
+    if not get_batch_settings(settings)["trace"]:
+        return None
+    return os.path.join(save_dir, "traces", os.environ.get('SLURM_JOB_ID') or datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+
+def start_worker_trace(trace_dir):
+    # called in each process that reconstructs chunks
+    if trace_dir is not None and not trace.is_tracing():
+        trace.enable_tracing()
+
+def save_worker_trace(trace_dir):
+    if trace_dir is not None:
+        trace.save_trace(os.path.join(trace_dir, f"{platform.node()}-{os.getpid()}"))
+
+def combine_traces(trace_dir):
+    """ Combines trace files of all processes of a job into trace_dir/all (.json and .chrome.json), and prints per-stage summary """
+    files = sorted(f for f in os.listdir(trace_dir) if f.endswith(".json") and not f.endswith(".chrome.json") and not f.startswith("all."))
+    spans = trace.load_spans([os.path.join(trace_dir, f) for f in files])
+    trace.save_trace(os.path.join(trace_dir, "all"), spans)
+    trace.print_trace_summary(spans)
+    print(f"Trace saved in {trace_dir}")
 
 def get_batch_template(algorithm="astra"):
     """ Gets path to appropriate batch scrpit template, depending on whether using Astra or SVMBIR, on Cori or Perlmutter """
@@ -54,10 +189,16 @@ def create_batch_script(settings):
     s = os.popen("echo $NERSC_HOST")
     out = s.read()
 
-    # calculate job time by number of slices (on either perlmutter or cori)
+    # calculate job time from recorded timings of past jobs if there are enough, otherwise by number of slices (on either perlmutter or cori)
     sec_per_100_slices = 45 if 'perlmutter' in out else 90 # may need to adjust a little
     num_slices = settings["data"]["stop_slice"] - settings["data"]["start_slice"]
-    total_seconds = int(np.minimum(np.ceil(num_slices/100)*sec_per_100_slices,MAX_JOB_SECONDS))
+    gpus = re.search('#SBATCH -G ([0-9]+)',template)
+    num_workers = int(gpus[1]) if gpus and get_batch_settings(settings)["num_workers"] == "auto" else 1
+    predicted = estimate_job_seconds(settings, "astra", num_slices+1, num_workers)
+    total_seconds = predicted if predicted is not None else np.ceil(num_slices/100)*sec_per_100_slices
+    if total_seconds > MAX_JOB_SECONDS:
+        print(f"Job will probably need more than the {MAX_JOB_SECONDS//60} min limit, resubmit it to finish the remaining slices")
+    total_seconds = int(np.minimum(total_seconds,MAX_JOB_SECONDS))
     seconds = total_seconds % 60
     minutes = (total_seconds // 60) % 60
     hours = (total_seconds // 60) // 60
@@ -79,6 +220,34 @@ def create_batch_script(settings):
     
     return configs_dir, config_script_name
 
+def get_svmbir_geometry(settings, factor=1):
+    """ (num_rays, angles) of the sinograms SVMBIR reconstructs with these settings, after angles_ind and proj_downsample. Its system matrix depends on these (see ALS_recon_svmbir_cache)
+        factor: binning factor of a coarse level (see ALS_recon_functions.svmbir_recon levels)
+    """
+    dataset = als_io.open_dataset(settings["data"]["data_path"])
+    angles = np.asarray(dataset.angles[als_io.as_slice(settings["data"]["angles_ind"])]).ravel()
+    proj_downsample = settings["data"]["proj_downsample"] or 1
+    num_rays = -(-dataset.metadata['numrays']//proj_downsample) # binning pads to a whole number of binned pixels
+    return -(-num_rays//factor), angles
+
+def get_svmbir_geometries(settings):
+    """ (num_rays, angles) of every level SVMBIR reconstructs with these settings, coarsest first (just one unless svmbir_settings has levels) """
+    levels = als.get_svmbir_levels((settings.get("svmbir_settings") or {}).get("levels"))
+    return [get_svmbir_geometry(settings, factor) for factor in levels]
+
+def get_svmbir_build_seconds(settings):
+    """ Estimated time to build the system matrices these settings need that aren't cached yet (0 if all are). Reports the ones that are missing """
+    cache = svmbir_cache.SVMBIRCache(als.get_svmbir_cache_dir())
+    total = 0
+    for num_rays, angles in get_svmbir_geometries(settings):
+        if cache.lookup(num_rays, angles) is None:
+            build_seconds = cache.estimate_build_seconds(num_rays, len(angles))
+            print(f"SVMBIR system matrix for {num_rays} rays x {len(angles)} angles isn't cached, the job will build it first"
+                  + (f" (about {build_seconds/60:.0f} min, added to job time)" if build_seconds is not None else " (can take hours)")
+                  + ". To build it ahead of time: ALS_recon_svmbir_cache.SVMBIRCache(als.get_svmbir_cache_dir()).prewarm(ALS_batch_recon.get_svmbir_geometries(settings))")
+            total += build_seconds or 0
+    return total
+
 def create_svmbir_batch_script(settings):
     """ Completes svmbir script from template by adding reconstruction settings """
     with open (get_batch_template(algorithm="svmbir"), "r") as t:
@@ -95,10 +264,26 @@ def create_svmbir_batch_script(settings):
     s = os.popen("echo $NERSC_HOST")
     out = s.read()
 
-    # calculate job time by number of slices (on either perlmutter or cori)
+    # calculate job time from recorded timings of past jobs if there are enough, otherwise by number of slices (on either perlmutter or cori)
     sec_per_slice = 20*60 # Found 20 min was about right for 8 slices. Can increase if jobs aren't finishing 
     num_slices = settings["data"]["stop_slice"] - settings["data"]["start_slice"]
-    total_seconds = int(np.minimum(np.ceil(num_slices/n)*sec_per_slice,MAX_JOB_SECONDS))
+    model = get_cost_model(settings, "svmbir")
+    if model is not None:
+        # fewest ranks (up to the template's) that finish within the time limit: fewer nodes to wait for in the queue, and less startup repeated per node
+        ranks_per_node = max(n // N, 1)
+        for num_ranks in range(ranks_per_node, n+1, ranks_per_node):
+            total_seconds = predict_svmbir_job_seconds(model, settings, num_slices+1, num_ranks)
+            if total_seconds <= MAX_JOB_SECONDS:
+                break
+        user_template = user_template.replace(f"#SBATCH -N {N}", f"#SBATCH -N {num_ranks//ranks_per_node}").replace(f"#SBATCH -n {n}", f"#SBATCH -n {num_ranks}")
+        N, n = num_ranks//ranks_per_node, num_ranks
+        print(f"Requesting {N} nodes, {n} tasks. Predicted job time: {total_seconds/60:.1f} min")
+    else:
+        total_seconds = np.ceil(num_slices/n)*sec_per_slice
+    total_seconds += get_svmbir_build_seconds(settings) # a system matrix that isn't cached is built before any slice is reconstructed
+    if total_seconds > MAX_JOB_SECONDS:
+        print(f"Job will probably need more than the {MAX_JOB_SECONDS//60} min limit, resubmit it to finish the remaining slices")
+    total_seconds = int(np.minimum(total_seconds,MAX_JOB_SECONDS))
     seconds = total_seconds % 60
     minutes = (total_seconds // 60) % 60
     hours = (total_seconds // 60) // 60
@@ -120,6 +305,30 @@ def create_svmbir_batch_script(settings):
     return configs_dir, config_script_name
 
 
+def get_cost_model(settings, algorithm):
+    """ Run time model fit to recorded timings of past batch jobs like this one (see ALS_batch_timing). None if there isn't enough history """
+    try:
+        return timing.fit_cost_model(timing.get_timing_features(settings, algorithm))
+    except Exception as e: # never stop a job being submitted because of timing history
+        print(f"Couldn't use recorded timings: {e!r}")
+        return None
+
+def estimate_job_seconds(settings, algorithm, num_slices, num_workers=1):
+    """ Predicted wall time (with safety margin) of a batch job from recorded timings, or None if there isn't enough history
+        num_workers: chunks reconstructed at the same time (Astra workers, or SVMBIR ranks)
+    """
+    model = get_cost_model(settings, algorithm)
+    if model is None:
+        return None
+    total_seconds = model.job_seconds(timing.get_timing_features(settings, algorithm), num_slices, num_workers)
+    print(f"Predicted job time: {total_seconds/60:.1f} min")
+    return total_seconds
+
+def predict_svmbir_job_seconds(model, settings, num_slices, num_ranks):
+    # SVMBIR jobs cap chunks so every rank gets one (see plan_svmbir_chunks)
+    chunk_slices = min(model.chunk_slices, int(np.ceil(num_slices/num_ranks)))
+    return model.job_seconds(timing.get_timing_features(settings, "svmbir"), num_slices, num_ranks, chunk_slices=chunk_slices)
+
 def dictionary_prep(dictionary):
     ''' Encodes reconstruction parameter dictionary into string 
     Input: 
@@ -132,94 +341,397 @@ def dictionary_prep(dictionary):
     return st
 
 
+class AstraChunkWorker:
+    """ Reads, reconstructs and writes chunks of slices for an Astra batch job. Used directly for single-process jobs, or created in each worker process by ALS_batch_pipeline.run_chunk_workers
+        settings: reconstruction settings dictionary (COR must already be set)
+        nchunk: slices per chunk
+        shared: whether other processes write to the same output volume at the same time (hdf5/zarr writers then lock the file)
+        background_write: whether to write in a background thread (see ALS_recon_io.BackgroundWriter). Not needed when write is run as its own pipeline stage
+        manifest: ChunkManifest to record finished chunks in (see ALS_batch_pipeline). None means don't record
+        timings: TimingRecorder to record chunk times in (see ALS_batch_timing). None means don't record
+        trace_dir: directory to save trace of this process in (see get_trace_dir). None means don't trace
+        use_gpu: whether to reconstruct on GPU. If None, checks for one
+    """
+    def __init__(self, settings, nchunk, shared=False, background_write=False, manifest=None, timings=None, trace_dir=None, use_gpu=None):
+        self.settings = settings
+        self.trace_dir = trace_dir
+        start_worker_trace(trace_dir)
+        self.use_gpu = als.check_for_gpu() if use_gpu is None else use_gpu
+        self.timings = timings
+        self.chunk_seconds = 0. # total time spent on chunks (all stages)
+        self._stage_seconds = {} # chunk -> {stage: seconds}, filled in as the chunk goes through read, recon and write
+        batch_settings = get_batch_settings(settings)
+        self.dtype = np.dtype(batch_settings["output_dtype"])
+        self.stats = als.ReconStats() # range of reconstructed values, collected as chunks are finished
+        save_dir = os.path.join(settings["data"]["output_path"],settings["data"]["name"])
+        self.writer = get_batch_writer(settings, save_dir, nchunk, shared=shared)
+        if batch_settings["pyramid_levels"]:
+            self.writer = als_io.PyramidWriter(self.writer, factors=batch_settings["pyramid_levels"],
+                                               num_slices=settings["data"]['stop_slice']-settings["data"]['start_slice']+1,
+                                               start_slice=settings["data"]['start_slice'])
+        if manifest is not None:
+            self.writer = pipeline.ManifestWriter(self.writer, manifest)
+        if background_write:
+            self.writer = als_io.BackgroundWriter(self.writer, queue_depth=batch_settings["queue_depth"])
+        self.sinogram_store = sinogram_store.get_batch_store(batch_settings)
+
+    def read(self, chunk):
+        tic = time.time()
+        start_iter, stop_iter = chunk
+        with trace.stage("read_chunk", chunk=chunk):
+            tomo, angles, metadata = helper.prepare_tomo(path=self.settings["data"]["data_path"],
+                                                         angles_ind=self.settings["data"]['angles_ind'],
+                                                         slices_ind=slice(start_iter,stop_iter,1),
+                                                         COR=get_chunk_COR(self.settings["recon"], chunk),
+                                                         proj_downsample=self.settings["data"]["proj_downsample"],
+                                                         preprocessing_settings=self.settings["preprocess"],
+                                                         postprocessing_settings=self.settings["postprocess"],
+                                                         sinogram_store=self.sinogram_store)
+        self._stage_seconds.setdefault(chunk, {})['read'] = time.time() - tic
+        return chunk, tomo, angles, metadata
+
+    def recon(self, item):
+        tic = time.time()
+        chunk, tomo, angles, metadata = item
+        with trace.stage("recon_chunk", chunk=chunk):
+            recon = helper.reconstruct_tomo(tomo, angles,
+                                            COR=get_chunk_COR(self.settings["recon"], chunk),
+                                            metadata=metadata,
+                                            method=self.settings["recon"]["method"],
+                                            proj_downsample=self.settings["data"]["proj_downsample"],
+                                            fc=self.settings["recon"]["fc"],
+                                            use_gpu=self.use_gpu,
+                                            stats=self.stats, dtype=self.dtype)
+        self._stage_seconds.setdefault(chunk, {})['recon'] = time.time() - tic
+        return chunk, recon
+
+    def write(self, item):
+        tic = time.time()
+        chunk, recon = item
+        with trace.stage("write_chunk", chunk=chunk):
+            self.writer.write(recon, start=chunk[0])
+        if isinstance(self.writer, als_io.BackgroundWriter): # saved later, in the writer's thread (errors are raised on a later write, or on close)
+            print(f"Queued slices {chunk[0]}-{chunk[1]} for writing")
+        else:
+            print(f"Saved slices {chunk[0]}-{chunk[1]}")
+        stage_seconds = self._stage_seconds.pop(chunk, {})
+        stage_seconds['write'] = time.time() - tic
+        self.chunk_seconds += sum(stage_seconds.values())
+        if self.timings is not None:
+            self.timings.record_chunk(chunk[1]-chunk[0], sum(stage_seconds.values()), **stage_seconds)
+
+    def __call__(self, chunk):
+        self.write(self.recon(self.read(chunk)))
+
+    def close(self):
+        self.writer.close()
+        if self.stats.count:
+            print(f"Reconstructed values: {self.stats}")
+        save_worker_trace(self.trace_dir)
+
 def batch_astra_recon(settings): 
     """ Perform Astra reconstruction using encoded settings string """
 
     print(f"Starting ALS batch Astra recon...")
+    tic_job = time.time()
+    resources.configure(verbose=True) # worker processes (if any) get their own block of cores, see ALS_batch_pipeline.run_chunk_workers
+    resources.check_oversubscription()
     
-    use_gpu = als.check_for_gpu()
-    nchunk = 50 
-    '''
-    nchunk is balance between available cpus and memory (larger value can be more parallelized but uses more memory)
-    50 was empirically chosen on Perlmutter exclusive node, though 100 was more or less the same
-    ''' 
     save_dir = os.path.join(settings["data"]["output_path"],settings["data"]["name"])
     if not os.path.exists(save_dir): os.makedirs(save_dir)
-    save_name = os.path.join(save_dir,settings["data"]["name"])
+    batch_settings = get_batch_settings(settings)
+    manifest = None
+    if batch_settings["resume"]: # hash settings before COR is filled in below, so a resubmitted job matches
+        manifest = pipeline.ChunkManifest(save_dir, settings)
+        manifest.create(settings)
     
-    # if COR is None, use cross-correlation finder
-    if settings["recon"]["COR"] is None:
-        settings["recon"]["COR"] = als.auto_find_cor(settings["data"]["data_path"])
+    # if COR is None, measure it (and any tilt of the rotation axis)
+    find_COR(settings, settings["recon"])
 
-    tic0 = time.time()
-    for i in range(np.ceil((settings["data"]['stop_slice']-settings["data"]['start_slice'])/nchunk).astype(int)):
-        start_iter = settings["data"]['start_slice']+i*nchunk
-        stop_iter = np.minimum(start_iter+nchunk,settings["data"]['stop_slice']+1)
-        print(f"Starting recon of slices {start_iter}-{stop_iter}...",end=' ')
-        tic = time.time()
+    num_workers = batch_settings["num_workers"]
+    if num_workers == "auto":
+        num_workers = max(pipeline.get_num_gpus(), 1) if batch_settings["worker_backend"] == "gpu" else 1
+    if batch_settings["chunk_slices"] == "auto":
+        # largest chunk that fits in memory (bigger chunks parallelize better inside tomopy/astra, but all workers and pipeline stages hold chunks at once), leaving each worker several chunks
+        nchunk, plan = pipeline.plan_chunk_size(settings["data"]["data_path"], settings, algorithm="astra",
+                                                num_workers=num_workers,
+                                                pipelined=batch_settings["pipeline"] and num_workers == 1,
+                                                queue_depth=batch_settings["queue_depth"],
+                                                memory_GB=batch_settings["memory_GB"],
+                                                memory_fraction=batch_settings["memory_fraction"],
+                                                max_chunk=get_max_chunk(settings, num_workers))
+    else:
+        nchunk, plan = int(batch_settings["chunk_slices"]), None
+    align = 1
+    if batch_settings["pyramid_levels"]:
+        # pyramid levels are built from each chunk in memory, so chunks (of different workers, or of a resumed job) can't split a downsampled slice of any level (eg. [3,4] needs multiples of 12)
+        align = int(np.lcm.reduce([int(factor) for factor in batch_settings["pyramid_levels"]]))
+        nchunk = max(nchunk // align, 1) * align
+    nchunk, align = align_chunks(settings, nchunk, align)
+    slope = settings["recon"].get("COR_slope") or 0
+    if nchunk*abs(slope) > 1: # tilted rotation axis: keep COR within half a pixel of the chunk's COR (after alignment, which can only round down here)
+        nchunk = max(int(1/abs(slope)) // align, 1) * align
+        print(f"Rotation axis is tilted (COR changes {slope:.3g} pixels per slice), limiting chunks to {nchunk} slices")
+        if nchunk*abs(slope) > 1:
+            print(f"Warning: chunks can't be smaller than {align} slices (pyramid levels / downsampling), so COR is up to {nchunk*abs(slope)/2:.2f} pixels off at chunk ends")
+    chunks = get_remaining_chunks(settings, save_dir, nchunk, manifest, align=align)
+    timings = timing.TimingRecorder(settings, "astra") if batch_settings["record_timings"] else None
+    trace_dir = get_trace_dir(settings, save_dir)
 
-        recon, _ = helper.reconstruct(path=settings["data"]["data_path"],
-                                      angles_ind=settings["data"]['angles_ind'],
-                                      slices_ind=slice(start_iter,stop_iter,1),
-                                      COR=settings["recon"]["COR"],
-                                      method=settings["recon"]["method"],
-                                      proj_downsample=settings["data"]["proj_downsample"],
-                                      fc=settings["recon"]["fc"],
-                                      preprocessing_settings=settings["preprocess"],
-                                      postprocessing_settings=settings["postprocess"],
-                                      use_gpu=use_gpu)
-
-        print(f"Finished: took {time.time()-tic} sec. Saving files...")
-        dxchange.write_tiff_stack(recon, fname=save_name, start=start_iter)
+    tic0 = time.time()
+    chunk_seconds = 0.
+    if not chunks:
+        print("All slices already reconstructed")
+    elif num_workers > 1:
+        print(f"Running {len(chunks)} chunks on {num_workers} {batch_settings['worker_backend']} workers")
+        stats = pipeline.run_chunk_workers(chunks, ("ALS_batch_recon","AstraChunkWorker"), (settings, nchunk, True, True, manifest, timings, trace_dir),
+                                           num_workers=num_workers, backend=batch_settings["worker_backend"])
+        chunk_seconds = sum(s['busy'] for s in stats.values())
+    elif batch_settings["pipeline"]:
+        print(f"Running {len(chunks)} chunks as read/recon/write pipeline (queue depth {batch_settings['queue_depth']})")
+        worker = AstraChunkWorker(settings, nchunk, manifest=manifest, timings=timings, trace_dir=trace_dir)
+        try:
+            pipeline.run_chunk_pipeline(chunks,
+                                        [("read",worker.read), ("recon",worker.recon), ("write",worker.write)],
+                                        queue_depth=batch_settings["queue_depth"])
+        finally:
+            worker.close()
+        chunk_seconds = worker.chunk_seconds
+    else:
+        worker = AstraChunkWorker(settings, nchunk, background_write=True, manifest=manifest, timings=timings, trace_dir=trace_dir) # still write in background, so next chunk can start
+        try:
+            for chunk in chunks:
+                print(f"Starting recon of slices {chunk[0]}-{chunk[1]}...",end=' ')
+                tic = time.time()
+                item = worker.recon(worker.read(chunk))
+                print(f"Finished: took {time.time()-tic} sec. Saving files...")
+                worker.write(item)
+        finally:
+            worker.close()
+        chunk_seconds = worker.chunk_seconds
     print(f"Done, took {time.time()-tic0} sec")
+    if timings is not None and chunks:
+        timings.record_job(sum(stop-start for start, stop in chunks), time.time()-tic_job, tic0-tic_job, chunk_seconds, num_workers)
+    if trace_dir is not None and chunks:
+        combine_traces(trace_dir)
+    if plan is not None:
+        pipeline.print_memory_report(plan, children=num_workers > 1)
     
+class SvmbirChunkWorker:
+    """ Reads, reconstructs (SVMBIR) and writes chunks of slices. Used by each MPI rank in mpi4py_svmbir_recon, or created in each worker process by ALS_batch_pipeline.run_chunk_workers (local_svmbir_recon)
+        settings: reconstruction settings dictionary (COR must already be set)
+        nchunk: slices per chunk
+        shared: whether other processes write to the same output volume at the same time
+        background_write: whether to write in a background thread, so the next chunk can start
+        manifest: ChunkManifest to record finished chunks in (see ALS_batch_pipeline). None means don't record
+        timings: TimingRecorder to record chunk times in (see ALS_batch_timing). None means don't record
+        trace_dir: directory to save trace of this process in (see get_trace_dir). None means don't trace
+        svmbir_lib_path: where SVMBIR finds its system matrix, eg. a node-local copy (see ALS_recon_svmbir_cache). None means the shared cache
+        use_gpu: not used (SVMBIR runs on CPU, its FBP initialization checks for a GPU itself). Accepted so run_chunk_workers can create it
+        name: label for printouts (eg. node name and MPI rank)
+    """
+    def __init__(self, settings, nchunk, shared=False, background_write=True, manifest=None, timings=None, trace_dir=None, svmbir_lib_path=None, use_gpu=None, name=""):
+        self.settings = settings
+        self.svmbir_lib_path = svmbir_lib_path
+        self.name = name
+        self.timings = timings
+        self.trace_dir = trace_dir
+        start_worker_trace(trace_dir)
+        batch_settings = get_batch_settings(settings)
+        self.dtype = np.dtype(batch_settings["output_dtype"])
+        self.stats = als.ReconStats() # range of reconstructed values, collected as chunks are finished
+        self.pxsize = als.read_metadata(settings["data"]["data_path"], print_flag=False)['pxsize']
+        save_dir = os.path.join(settings["data"]["output_path"],settings["data"]["name"]+"-svmbir")
+        self.writer = get_batch_writer(settings, save_dir, nchunk, shared=shared) # all ranks/workers write disjoint slabs of the same volume
+        if manifest is not None:
+            self.writer = pipeline.ManifestWriter(self.writer, manifest)
+        if background_write:
+            self.writer = als_io.BackgroundWriter(self.writer, queue_depth=batch_settings["queue_depth"])
+        store = sinogram_store.get_batch_store(batch_settings)
+        self.read_data = als.read_data if store is None else store.read_data
+
+    def __call__(self, chunk):
+        start_slice, end_slice = chunk
+        print(f"Starting SVMBIR recon of slices {start_slice} to {end_slice-1} {self.name}")
+        tic = time.time()
+        
+        with trace.stage("read_chunk", chunk=chunk):
+            tomo, angles = self.read_data(self.settings["data"]["data_path"],
+                                          proj=self.settings["data"]["angles_ind"],
+                                          sino=slice(start_slice,end_slice),
+                                          downsample_factor=self.settings["data"]["proj_downsample"],
+                                          preprocess_settings=self.settings["preprocess"],
+                                          postprocess_settings=self.settings["postprocess"])
+        
+        with trace.stage("recon_chunk", chunk=chunk):
+            svmbir_kwargs = {key: value for key, value in self.settings["svmbir_settings"].items() if key not in ["COR_slope", "COR_slice"]}
+            svmbir_kwargs["COR"] = get_chunk_COR(self.settings["svmbir_settings"], chunk)
+            svmbir_recon = als.svmbir_recon(tomo,angles,svmbir_lib_path=self.svmbir_lib_path,**svmbir_kwargs)
+        with trace.stage("finish_recon", chunk=chunk): # same epilogue as Astra: mask, convert units and cast in one pass
+            svmbir_recon = als.finish_recon(svmbir_recon, self.pxsize, stats=self.stats, dtype=self.dtype)
+        print(f"Finished slice {start_slice} to {end_slice} {self.name}, took {time.time()-tic} sec")
+        with trace.stage("write_chunk", chunk=chunk):
+            self.writer.write(svmbir_recon, start=start_slice)
+        if self.timings is not None:
+            self.timings.record_chunk(end_slice-start_slice, time.time()-tic)
+
+    def close(self):
+        self.writer.close()
+        if self.stats.count:
+            print(f"Reconstructed values {self.name}: {self.stats}")
+        save_worker_trace(self.trace_dir)
+
+def plan_svmbir_chunks(settings, batch_settings, num_workers, num_per_node, verbose=True):
+    """ Returns SVMBIR slices per chunk and chunk plan (None if chunk size was set in batch settings). See ALS_batch_pipeline.plan_chunk_size
+        num_workers: total ranks/workers. Chunks are capped so every one gets several (see get_max_chunk), and at SVMBIR_MAX_CHUNK slices (SVMBIR is slow per slice, so load balance matters more than chunk overhead)
+        num_per_node: ranks/workers sharing this node's memory
+    """
+    if batch_settings["chunk_slices"] == "auto":
+        SLICES_PER_CHUNK, plan = pipeline.plan_chunk_size(settings["data"]["data_path"], settings, algorithm="svmbir",
+                                                          num_workers=num_per_node, pipelined=False,
+                                                          queue_depth=batch_settings["queue_depth"],
+                                                          memory_GB=batch_settings["memory_GB"],
+                                                          memory_fraction=batch_settings["memory_fraction"],
+                                                          max_chunk=get_max_chunk(settings, num_workers, SVMBIR_MAX_CHUNK),
+                                                          verbose=verbose)
+    else:
+        SLICES_PER_CHUNK, plan = int(batch_settings["chunk_slices"]), None
+    return SLICES_PER_CHUNK, plan
+
 def mpi4py_svmbir_recon(settings):
-    """ Perform SVMBIR reconstruction using encoded settings string. Parallelize over slices using mpi4py """
+    """ Perform SVMBIR reconstruction using encoded settings string. Parallelize over slices using mpi4py.
+        By default ranks take the next chunk from a shared counter as they finish (batch setting "scheduler": "dynamic"), "static" gives the old round robin assignment
+    """
 
     from mpi4py import MPI
     comm = MPI.COMM_WORLD
-    size = comm.Get_size()
-    rank = comm.Get_rank()
-    name = MPI.Get_processor_name()
+    try:
+        size = comm.Get_size()
+        rank = comm.Get_rank()
+        name = MPI.Get_processor_name()
+        tic_job = time.time()
     
-    save_dir = os.path.join(settings["data"]["output_path"],settings["data"]["name"]+"-svmbir")
-    if rank == 0: # to avoid multiple tasks doing this at the same time
-        if not os.path.exists(save_dir): os.makedirs(save_dir)
+        save_dir = os.path.join(settings["data"]["output_path"],settings["data"]["name"]+"-svmbir")
+        batch_settings = get_batch_settings(settings)
+        manifest = pipeline.ChunkManifest(save_dir, settings) if batch_settings["resume"] else None # hash settings before COR is filled in
+        if rank == 0: # to avoid multiple tasks doing this at the same time
+            if not os.path.exists(save_dir): os.makedirs(save_dir)
+            if manifest is not None: manifest.create(settings)
+        comm.Barrier() # make sure save_dir exists before anyone writes to it
                         
-    # if COR is None, use cross-correlation finder
-    if settings["svmbir_settings"]["COR"] is None:
-        settings["svmbir_settings"]["COR"] = als.auto_find_cor(settings["data"]["data_path"])    
+        # if COR is None, measure it (and any tilt of the rotation axis) once, and share with all ranks
+        if rank == 0:
+            find_COR(settings, settings["svmbir_settings"], settings["data"]["proj_downsample"])
+        settings["svmbir_settings"] = comm.bcast(settings["svmbir_settings"], root=0)
 
-    SLICES_PER_CHUNK = 8 # hardcoded parameter -- didn't see improvement at 16, but didn't test much        
-    NUM_CHUNKS = int(np.ceil((settings["data"]['stop_slice']-settings["data"]['start_slice'])/SLICES_PER_CHUNK))
-    
-    print(f"SLICES_PER_CHUNK: {SLICES_PER_CHUNK},    NUM_CHUNKS: {NUM_CHUNKS}")
+        assert batch_settings["scheduler"] in pipeline.MPI_SCHEDULERS, f"MPI scheduler must be one of {list(pipeline.MPI_SCHEDULERS)}, but got: {batch_settings['scheduler']}"
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        ranks_per_node = node_comm.Get_size()
+        # each rank gets its own block of the node's cores (unless the launcher already bound it), and every library uses that many threads
+        resources.configure(cores=resources.get_node_cores(node_comm.Get_rank(), ranks_per_node), verbose=rank == 0)
+        resources.check_oversubscription(ranks_per_node, verbose=node_comm.Get_rank() == 0)
+        node_comm.Free()
+        # system matrix built once if it isn't cached, read once from the shared cache and copied to every node, before any rank starts.
+        # Done before planning chunks, so memory the node-local copy takes (/dev/shm) isn't counted as available
+        cache = svmbir_cache.SVMBIRCache(als.get_svmbir_cache_dir())
+        paths = {svmbir_cache.stage_mpi(cache, num_rays, angles, comm) for num_rays, angles in get_svmbir_geometries(settings)} # every level, if there are several
+        svmbir_lib_path = paths.pop() if len(paths) == 1 else cache.path # all levels must be in the same place
+        SLICES_PER_CHUNK, plan = plan_svmbir_chunks(settings, batch_settings, size, ranks_per_node, verbose=rank == 0)
+        SLICES_PER_CHUNK = comm.bcast(SLICES_PER_CHUNK, root=0) # available memory differs a little between ranks, but all must agree on chunks
+        SLICES_PER_CHUNK, align = align_chunks(settings, SLICES_PER_CHUNK)
+        chunks = get_remaining_chunks(settings, save_dir, SLICES_PER_CHUNK, manifest, align=align) if rank == 0 else None
+        chunks = comm.bcast(chunks, root=0)
+        NUM_CHUNKS = len(chunks)
     
-    for i in range(NUM_CHUNKS):
-        if i % size == rank:
-            start_slice = settings["data"]['start_slice'] + i*SLICES_PER_CHUNK
-            end_slice = np.minimum((i+1)*SLICES_PER_CHUNK,settings["data"]['stop_slice']+1)
-            print(f"Starting SVMBIR recon of slices {start_slice} to {end_slice-1} on {name}, core {rank} of {size}")
-            save_name = os.path.join(save_dir,settings["data"]["name"])
-            tic = time.time()
-            
-            tomo, angles = als.read_data(settings["data"]["data_path"],
-                                         proj=settings["data"]["angles_ind"],
-                                         sino=slice(start_slice,end_slice),
-                                         downsample_factor=settings["data"]["proj_downsample"],
-                                         preprocess_settings=settings["preprocess"],
-                                         postprocess_settings=settings["postprocess"])
-            
-            svmbir_recon = als.svmbir_recon(tomo,angles,**settings["svmbir_settings"])
-            svmbir_recon = als.mask_recon(svmbir_recon)
-            print(f"Finished slice {start_slice} to {end_slice} on {name}, core {rank} of {size}, took {time.time()-tic} sec")
-            dxchange.write_tiff_stack(svmbir_recon, fname=save_name, start=start_slice)
+        print(f"SLICES_PER_CHUNK: {SLICES_PER_CHUNK},    NUM_CHUNKS: {NUM_CHUNKS}")
+
+        timings = timing.TimingRecorder(settings, "svmbir") if batch_settings["record_timings"] else None
+        if timings is not None:
+            timings.job_id = comm.bcast(timings.job_id, root=0) # same job id on every rank
+        trace_dir = comm.bcast(get_trace_dir(settings, save_dir), root=0) # every rank saves its trace in the same directory
+        worker = SvmbirChunkWorker(settings, SLICES_PER_CHUNK, shared=size > 1, manifest=manifest, timings=timings, trace_dir=trace_dir, svmbir_lib_path=svmbir_lib_path, name=f"on {name}, core {rank} of {size}")
+        tic0 = time.time()
+        schedule = pipeline.MPI_SCHEDULERS[batch_settings["scheduler"]](chunks, comm)
+        items, busy = 0, 0.
+        try:
+            for chunk in schedule:
+                tic = time.time()
+                worker(chunk)
+                items += 1
+                busy += time.time() - tic
+        finally:
+            worker.close()
+        schedule.free()
+        pipeline.print_rank_stats(comm, items, busy)
+        chunk_seconds = comm.reduce(busy, op=MPI.SUM, root=0)
+        startup = comm.reduce(tic0-tic_job, op=MPI.MAX, root=0)
+        if rank == 0 and timings is not None and chunks:
+            timings.record_job(sum(stop-start for start, stop in chunks), time.time()-tic_job, startup, chunk_seconds, size)
+        if trace_dir is not None and chunks:
+            comm.Barrier() # all ranks have saved their traces
+            if rank == 0:
+                combine_traces(trace_dir)
+        if plan is not None:
+            pipeline.print_memory_report(plan)
+    except BaseException: # a rank that fails would leave the others waiting forever in collective calls (bcast, Barrier, schedule.free, reductions), so stop the whole job. Finished chunks are in the manifest, so a resubmitted job resumes
+        traceback.print_exc()
+        sys.stdout.flush()
+        comm.Abort(1)
+
+def local_svmbir_recon(settings):
+    """ Perform SVMBIR reconstruction on this node only, without an MPI launcher (batch setting "scheduler": "local").
+        Worker processes (batch setting "num_workers", "auto" means 1) each get their own block of cores and take chunks from a shared queue (see ALS_batch_pipeline.run_chunk_workers)
+    """
+    tic_job = time.time()
+    resources.configure(verbose=True) # worker processes get their own block of cores, see ALS_batch_pipeline.run_chunk_workers
+    resources.check_oversubscription()
+    save_dir = os.path.join(settings["data"]["output_path"],settings["data"]["name"]+"-svmbir")
+    if not os.path.exists(save_dir): os.makedirs(save_dir)
+    batch_settings = get_batch_settings(settings)
+    manifest = None
+    if batch_settings["resume"]:
+        manifest = pipeline.ChunkManifest(save_dir, settings)
+        manifest.create(settings)
+    find_COR(settings, settings["svmbir_settings"], settings["data"]["proj_downsample"])
+
+    num_workers = 1 if batch_settings["num_workers"] == "auto" else batch_settings["num_workers"]
+    # system matrix built once if it isn't cached, and copied to node-local storage for all workers.
+    # Done before planning chunks, so memory the node-local copy takes (/dev/shm) isn't counted as available
+    cache = svmbir_cache.SVMBIRCache(als.get_svmbir_cache_dir())
+    paths = set()
+    for num_rays, angles in get_svmbir_geometries(settings): # every level, if there are several
+        cache.ensure(num_rays, angles)
+        paths.add(cache.stage(num_rays, angles))
+    svmbir_lib_path = paths.pop() if len(paths) == 1 else cache.path # all levels must be in the same place
+    SLICES_PER_CHUNK, plan = plan_svmbir_chunks(settings, batch_settings, num_workers, num_workers)
+    SLICES_PER_CHUNK, align = align_chunks(settings, SLICES_PER_CHUNK)
+    chunks = get_remaining_chunks(settings, save_dir, SLICES_PER_CHUNK, manifest, align=align)
+    print(f"SLICES_PER_CHUNK: {SLICES_PER_CHUNK},    NUM_CHUNKS: {len(chunks)}")
+
+    timings = timing.TimingRecorder(settings, "svmbir") if batch_settings["record_timings"] else None
+    trace_dir = get_trace_dir(settings, save_dir)
+
+    tic0 = time.time()
+    if chunks:
+        stats = pipeline.run_chunk_workers(chunks, ("ALS_batch_recon","SvmbirChunkWorker"), (settings, SLICES_PER_CHUNK, num_workers > 1, True, manifest, timings, trace_dir, svmbir_lib_path),
+                                           num_workers=num_workers, backend="cpu")
+        if timings is not None:
+            timings.record_job(sum(stop-start for start, stop in chunks), time.time()-tic_job, tic0-tic_job,
+                               sum(s['busy'] for s in stats.values()), num_workers)
+        if trace_dir is not None:
+            combine_traces(trace_dir)
+    print(f"Done, took {time.time()-tic0} sec")
+    if plan is not None:
+        pipeline.print_memory_report(plan, children=True)
 
 def main():
     string = sys.argv[:][-1] 
     settings = pickle.loads(base64.b64decode(string.encode('utf-8')))
     if settings["recon"]["method"] == "svmbir":
-        mpi4py_svmbir_recon(settings)
+        if get_batch_settings(settings)["scheduler"] == "local":
+            local_svmbir_recon(settings)
+        else:
+            mpi4py_svmbir_recon(settings)
     else:
         batch_astra_recon(settings)
        
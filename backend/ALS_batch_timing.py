@@ -0,0 +1,175 @@
+"""
+ALS_batch_timing.py
+Records how long batch reconstruction chunks take, and fits a cost model from that history so batch scripts can request a realistic wall time (and number of SVMBIR nodes)
+Timings are kept in a small local database (one json line per chunk or job), by default in ~/.als832/batch_timings.jsonl. Set ALS832_TIMING_DB to use a different file
+"""
+
+import os
+import json
+import time
+import uuid
+import platform
+import numpy as np
+from scipy.optimize import nnls
+import ALS_recon_io as als_io
+
+MIN_TIMING_RECORDS = 5 # fewer chunk records than this (for the same algorithm, method and machine) means use the fixed defaults instead of the model
+TIMING_QUANTILE = 0.95 # margin covers this fraction of past chunks (ratio of measured to predicted time)
+TIMING_SAFETY = 1.25 # extra margin on top, for queue/filesystem variation we haven't seen yet
+DEFAULT_STARTUP_SECONDS = 180 # container start, imports, COR finding. Used until jobs have been recorded
+
+def get_timing_db_path():
+    """ Path of the timing database """
+    return os.environ.get('ALS832_TIMING_DB', os.path.join(os.path.expanduser('~'), '.als832', 'batch_timings.jsonl'))
+
+def get_machine():
+    """ Name of the machine timings belong to (NERSC_HOST on NERSC, else host name) """
+    return os.environ.get('NERSC_HOST') or platform.node()
+
+def get_timing_features(settings, algorithm="astra"):
+    """ Describes what determines the cost of reconstructing a slice: dataset shape and the settings that change the amount of work
+        settings: reconstruction settings dictionary
+        algorithm: "astra" or "svmbir"
+    """
+    dataset = als_io.open_dataset(settings["data"]["data_path"])
+    num_angles, _, num_rays = dataset.data_shape
+    pre = settings.get("preprocess") or {}
+    post = settings.get("postprocess") or {}
+    svmbir_settings = settings.get("svmbir_settings") or {}
+    if algorithm == "svmbir": # coarse-to-fine levels change the cost per iteration a lot, so they're timed separately
+        method = "svmbir_multires" if any(int(factor) != 1 for factor in svmbir_settings.get("levels") or []) else "svmbir"
+    else:
+        method = settings["recon"].get("method") or "default"
+    return {'algorithm': algorithm,
+            'method': method,
+            'machine': get_machine(),
+            'angles': len(range(num_angles)[als_io.as_slice(settings["data"]["angles_ind"])]),
+            'rays': int(num_rays),
+            'downsample': int(settings["data"]["proj_downsample"] or 1),
+            'is360': bool(dataset.metadata['angularrange'] > 300),
+            'stripe': bool(pre.get('sm_size')),
+            'ring': bool(post.get('ringSigma')),
+            'max_iter': int(svmbir_settings.get('max_iter', 100)) if algorithm == "svmbir" else 1}
+
+def _work_per_slice(features):
+    # cost model terms for one raw slice: reading/normalizing (per pixel), stripe removal (per pixel), reconstruction (backprojection, ~angles x output pixels)
+    f = features['downsample']
+    pixels = features['angles']*features['rays']
+    recon_rays = features['rays']*(2 if features['is360'] else 1)/f
+    recon = features['angles']*recon_rays**2/f * features['max_iter']
+    return np.array([pixels, pixels*features['stripe'], pixels*features['ring']/f**2, recon], dtype=float)
+
+def _group(features):
+    return (features['algorithm'], features['method'], features['machine'])
+
+class TimingRecorder:
+    """ Appends chunk and job timings of one batch job to the timing database. Picklable, so batch worker processes can record their own chunks.
+        Never raises: failing to record timings shouldn't fail a reconstruction
+        settings: reconstruction settings dictionary
+        algorithm: "astra" or "svmbir"
+    """
+    def __init__(self, settings, algorithm="astra"):
+        self.path = get_timing_db_path()
+        self.job_id = '-'.join(filter(None, [os.environ.get('SLURM_JOB_ID'), uuid.uuid4().hex[:8]]))
+        try:
+            self.features = get_timing_features(settings, algorithm)
+        except Exception as e:
+            print(f"Not recording timings, couldn't read dataset shape: {e!r}")
+            self.features = None
+
+    def _append(self, record):
+        if self.features is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            line = json.dumps(dict(record, job_id=self.job_id, time=time.time(), **self.features)) + "\n"
+            with als_io.file_lock(self.path + ".lock"): # MPI ranks and workers append at the same time
+                with open(self.path, 'a') as f:
+                    f.write(line)
+        except Exception as e:
+            print(f"Couldn't record timing in {self.path}: {e!r}")
+
+    def record_chunk(self, num_slices, seconds, **stage_seconds):
+        """ Records one chunk: number of slices and total seconds spent on it (stage_seconds, eg. read=..., recon=..., are kept for reference) """
+        self._append(dict(kind='chunk', slices=int(num_slices), seconds=float(seconds), **stage_seconds))
+
+    def record_job(self, num_slices, wall_seconds, startup_seconds, chunk_seconds, num_workers):
+        """ Records a whole job. chunk_seconds: sum of recorded chunk times. Used to learn startup time and how well chunks overlap (pipelining, several workers) """
+        self._append(dict(kind='job', slices=int(num_slices), seconds=float(wall_seconds), startup=float(startup_seconds),
+                          chunk_seconds=float(chunk_seconds), workers=int(num_workers)))
+
+def read_timings(path=None):
+    """ Reads all records from the timing database (empty list if there isn't one yet) """
+    path = path or get_timing_db_path()
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError: # eg. line cut off by a killed job
+                pass
+    return records
+
+class CostModel:
+    """ Chunk time model fit to recorded timings for one algorithm, method and machine:
+            seconds = overhead + slices * (c_read * angles*rays + c_stripe * angles*rays*stripe + c_ring * binned pixels*ring + c_recon * angles*recon_rays^2)
+        Coefficients are fit by non-negative least squares, so the model can't predict negative times for shapes we haven't seen.
+        Use fit_cost_model rather than creating directly
+    """
+    def __init__(self, coefficients, scale, margin, startup, efficiency, chunk_slices, num_records):
+        self.coefficients = coefficients
+        self.scale = scale
+        self.margin = margin
+        self.startup = startup
+        self.efficiency = efficiency
+        self.chunk_slices = chunk_slices
+        self.num_records = num_records
+
+    def chunk_seconds(self, features, num_slices):
+        """ Predicted (typical) seconds to reconstruct a chunk of num_slices """
+        x = np.concatenate([[1.], num_slices*_work_per_slice(features)]) / self.scale
+        return float(x @ self.coefficients)
+
+    def job_seconds(self, features, num_slices, num_workers=1, chunk_slices=None):
+        """ Predicted wall time of a job with margin: startup, then chunks shared between num_workers workers/ranks
+            chunk_slices: slices per chunk. None means typical chunk size of the recorded jobs
+        """
+        if chunk_slices is None:
+            chunk_slices = self.chunk_slices
+        num_chunks = int(np.ceil(num_slices/chunk_slices))
+        chunks_per_worker = int(np.ceil(num_chunks/num_workers))
+        return self.startup + self.margin*self.efficiency*chunks_per_worker*self.chunk_seconds(features, min(chunk_slices, num_slices))
+
+def fit_cost_model(features, records=None, verbose=True):
+    """ Fits CostModel to past chunks with the same algorithm, method and machine as features. Returns None if there aren't enough (then use the fixed defaults)
+        features: from get_timing_features
+        records: timing records (None means read the timing database)
+    """
+    if records is None:
+        records = read_timings()
+    group = _group(features)
+    chunks = [r for r in records if r.get('kind') == 'chunk' and _group(r) == group and r['seconds'] > 0]
+    if len(chunks) < MIN_TIMING_RECORDS:
+        if verbose:
+            print(f"Only {len(chunks)} recorded chunks for {group}, need {MIN_TIMING_RECORDS} to predict run time")
+        return None
+    A = np.array([np.concatenate([[1.], r['slices']*_work_per_slice(r)]) for r in chunks])
+    t = np.array([r['seconds'] for r in chunks])
+    scale = np.maximum(A.max(axis=0), 1e-12) # columns differ by many orders of magnitude
+    coefficients, _ = nnls(A/scale, t)
+    predicted = (A/scale) @ coefficients
+    ratio = t / np.maximum(predicted, 1e-6)
+    margin = max(1., float(np.quantile(ratio, TIMING_QUANTILE))) * TIMING_SAFETY
+
+    jobs = [r for r in records if r.get('kind') == 'job' and _group(r) == group and r['chunk_seconds'] > 0]
+    startup = max([r['startup'] for r in jobs], default=DEFAULT_STARTUP_SECONDS)
+    # wall time of chunk loop compared to chunk time per worker: <1 when pipelining overlaps read/recon/write
+    efficiency = float(np.median([(r['seconds']-r['startup'])*r['workers']/r['chunk_seconds'] for r in jobs])) if jobs else 1.
+    efficiency = float(np.clip(efficiency, 0.1, 2.))
+    chunk_slices = int(np.median([r['slices'] for r in chunks]))
+    model = CostModel(coefficients, scale, margin, startup, efficiency, chunk_slices, len(chunks))
+    if verbose:
+        print(f"Run time model from {len(chunks)} recorded chunks ({len(jobs)} jobs): margin x{margin:.2f}, startup {startup:.0f} sec")
+    return model
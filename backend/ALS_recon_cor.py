@@ -0,0 +1,338 @@
+"""
+ALS_recon_cor.py
+Center of rotation (COR) estimation from binned projections. COR is measured independently at many slice heights by normalized cross-correlation of opposing (180 degrees apart) rows of the sinograms,
+then a straight line COR(slice) is fit through them, so a tilted rotation axis (which blurs the top or bottom of the volume when one COR is used) is detected and can be corrected chunk by chunk.
+COR can also be checked on reconstructions: cor_sweep reconstructs one slice at a range of trial CORs in one batch and scores each (sharpness, entropy, and for 360 degree scans how well the two stitched halves match).
+COR is in pixels from center of detector, like everywhere else in this package (tomopy center = COR + numrays/2)
+"""
+
+import numpy as np
+import scipy.fft
+import scipy.ndimage
+import ALS_recon_functions as als
+import ALS_recon_io as als_io
+import ALS_recon_trace as trace
+import ALS_recon_resources as resources
+
+
+class CORProfile:
+    """ COR measured at several slice heights, and the line COR(slice) = COR + slope*(slice - reference_slice) fit through them. Call it with slice numbers to get the fitted COR there.
+        slices: slice height (in full resolution slice numbers) of each measurement
+        cors: COR measured at each height (full resolution pixels from center)
+        quality: normalized correlation of each measurement (1 is a perfect match). Heights with little structure (eg. above or below the sample) have low quality and are left out
+        reference_slice: slice the fitted COR refers to (middle of the measured heights)
+        min_quality: heights below this quality aren't used (unless fewer than two are above it, then the best two are used)
+        tolerance: heights further than this (pixels) from the fitted line are outliers (correlation locked onto the wrong feature)
+    """
+    def __init__(self, slices, cors, quality, reference_slice, min_quality=0.7, tolerance=1.):
+        self.slices = np.asarray(slices, dtype=np.float64)
+        self.cors = np.asarray(cors, dtype=np.float64)
+        self.quality = np.asarray(quality, dtype=np.float64)
+        self.reference_slice = float(reference_slice)
+        self.used = self.quality >= min_quality
+        if np.count_nonzero(self.used) < 2: # too little structure anywhere, use the best heights
+            self.used = self.quality >= np.sort(self.quality)[-min(2, self.quality.size)]
+        self.COR, self.slope, self.residual = self._fit(tolerance)
+
+    def _fit(self, tolerance):
+        # line through the two heights that the most other heights agree with (robust to any number of outliers), then weighted least squares fit through those
+        x, y, w = self.slices - self.reference_slice, self.cors, self.quality
+        candidates = np.flatnonzero(self.used)
+        best = self.used & (np.abs(y - np.median(y[self.used])) <= tolerance) # no slope, if no line does better
+        for n, i in enumerate(candidates):
+            for j in candidates[n+1:]:
+                if x[i] == x[j]:
+                    continue
+                slope = (y[j] - y[i])/(x[j] - x[i])
+                inliers = self.used & (np.abs(y - (y[i] + slope*(x - x[i]))) <= tolerance)
+                if np.sum(w[inliers]) > np.sum(w[best]):
+                    best = inliers
+        if np.count_nonzero(best) < 2: # measurements all disagree, use the best one
+            best = self.used & (w == np.max(w[self.used]))
+        self.used = best
+        if np.count_nonzero(best) < 3 or np.ptp(x[best]) == 0: # not enough heights to fit a slope
+            COR, slope = np.average(y[best], weights=w[best]), 0.
+        else:
+            slope, COR = np.polyfit(x[best], y[best], 1, w=np.sqrt(w[best]))
+        residuals = y[best] - (COR + slope*x[best])
+        return float(COR), float(slope), float(np.sqrt(np.average(residuals**2, weights=w[best])))
+
+    def __call__(self, slices):
+        """ Fitted COR at slice number(s) slices """
+        return self.COR + self.slope*(np.asarray(slices, dtype=np.float64) - self.reference_slice)
+
+    @property
+    def tilt_deg(self):
+        """ Tilt of the rotation axis in the detector plane, in degrees (positive means COR increases with slice number) """
+        return float(np.rad2deg(np.arctan(self.slope)))
+
+    def __repr__(self):
+        return (f"CORProfile(COR={self.COR:.2f} at slice {self.reference_slice:.0f}, slope={self.slope:.3g} pixels/slice (tilt {self.tilt_deg:.3f} deg), "
+                f"residual {self.residual:.2f} pixels, {np.count_nonzero(self.used)} of {self.slices.size} heights used)")
+
+def get_opposing_pairs(angles, max_pairs=4):
+    """ Indices (i,j) of projections 180 degrees apart. 180 degree scans only have one pair (first and last), 360 degree scans have up to max_pairs, spread over the first half of the scan
+        angles: projection angles, in radians
+    """
+    angles = np.asarray(angles)
+    if angles[-1] - angles[0] < 1.5*np.pi: # 180 degree scan
+        return [(0, angles.size-1)]
+    half = int(np.searchsorted(angles, angles[0] + np.pi - 1e-6))
+    pairs = []
+    for i in np.linspace(0, half-1, min(max_pairs, half)).astype(int):
+        j = int(np.argmin(np.abs(angles - (angles[i] + np.pi))))
+        if (i, j) not in pairs:
+            pairs.append((int(i), j))
+    return pairs
+
+def read_opposing_projections(path, pairs, proj_downsample=4, sino=None):
+    """ Reads pairs of opposing projections (see get_opposing_pairs), normalized, log and binned. Returns float32 array (pairs,2,slices,rays)
+        sino: which slices to read (first,last,step). None means all slices
+    """
+    projs = []
+    for i, j in pairs:
+        # one read per pair: projections i and j only, no ring/outlier filtering (not needed to line up projections)
+        tomo, _ = als.read_data(path, proj=slice(i, j+1, j-i), sino=sino, downsample_factor=proj_downsample)
+        projs.append(tomo)
+    return np.stack(projs)
+
+def _correlation_shift(first, second, min_overlap):
+    # Shift (pixels) that best lines up rows of first with flipped rows of second: normalized cross-correlation over only the pixels that overlap at each shift
+    # (so 360 degree offset scans, where opposing projections share a narrow strip, work too), summed over all rows. Computed with FFTs.
+    # first, second: arrays (...,rays). Returns shift and normalized correlation at that shift (1 is a perfect match)
+    nrays = first.shape[-1]
+    n = scipy.fft.next_fast_len(2*nrays, real=True) # zero padded, so correlation doesn't wrap around
+    a = first.reshape(-1, nrays).astype(np.float64)
+    b = second.reshape(-1, nrays)[:, ::-1].astype(np.float64)
+    a -= a.mean(axis=-1, keepdims=True) # not needed for the result, but avoids round off of large sums
+    b -= b.mean(axis=-1, keepdims=True)
+    fa, fb = scipy.fft.rfft(a, n=n), scipy.fft.rfft(b, n=n)
+    fa2, fb2 = scipy.fft.rfft(a**2, n=n), scipy.fft.rfft(b**2, n=n)
+    fones = scipy.fft.rfft(np.ones(nrays), n=n)
+    # sum over x of u[x+k]*v[x], for all lags k
+    corr = lambda fu, fv: scipy.fft.irfft(fu*np.conj(fv), n=n)
+    lags = np.arange(-(nrays-min_overlap), nrays-min_overlap+1)
+    count = (nrays - np.abs(lags)).astype(np.float64) # overlapping pixels at each lag
+    sum_ab = corr(fa, fb)[:, lags % n]
+    sum_a = corr(fa, fones)[:, lags % n]
+    sum_b = corr(fones, fb)[:, lags % n]
+    sum_aa = corr(fa2, fones)[:, lags % n]
+    sum_bb = corr(fones, fb2)[:, lags % n]
+    covariance = np.sum(sum_ab - sum_a*sum_b/count, axis=0)
+    variance = np.sum(sum_aa - sum_a**2/count, axis=0) * np.sum(sum_bb - sum_b**2/count, axis=0)
+    values = covariance / np.sqrt(np.maximum(variance, 1e-30))
+    k = int(np.argmax(values))
+    shift = float(lags[k])
+    if 0 < k < values.size-1: # parabola through peak for subpixel shift
+        y0, y1, y2 = values[k-1], values[k], values[k+1]
+        denominator = y0 - 2*y1 + y2
+        if denominator < 0:
+            shift += 0.5*(y0 - y2)/denominator
+    return shift, float(values[k])
+
+def estimate_cor_profile(path, proj_downsample=4, num_heights=16, sino=None, max_pairs=4, num_threads=None):
+    """ Measures COR at num_heights slice heights (in parallel) from binned opposing projections, and fits COR(slice) to detect rotation axis tilt. Returns CORProfile.
+        Much less data is processed than by auto_find_cor (binned projections, no full resolution image registration), and each height is independent, so a tilted axis is measured instead of averaged away.
+        path: full path to .h5 file
+        proj_downsample: binning of projections. COR precision is still a fraction of a full resolution pixel, since many rows and heights are combined
+        num_heights: number of slice heights to measure COR at (bands of binned rows)
+        sino: which slices to use (first,last,step). None means all slices
+        max_pairs: for 360 degree scans, number of opposing projection pairs to combine. The fitted COR of 360 degree scans is then refined at reference_slice by matching the stitched halves (see refine_cor_360)
+        num_threads: number of threads, each handles a slice height. None means this process's thread budget (see ALS_recon_resources)
+    """
+    if not proj_downsample: proj_downsample = 1
+    metadata = als.read_metadata(path, print_flag=False)
+    sino = als_io.as_slice(sino)
+    first_slice, last_slice, step = sino.indices(metadata['numslices']) # last_slice not inclusive
+    angles = als_io.open_dataset(path).angles
+    pairs = get_opposing_pairs(angles, max_pairs)
+    with trace.stage("read_cor_projections", pairs=len(pairs)):
+        projs = read_opposing_projections(path, pairs, proj_downsample, sino=sino)
+    nrows, nrays = projs.shape[2:]
+    num_heights = int(np.clip(num_heights, 1, nrows))
+    bands = np.array_split(np.arange(nrows), num_heights)
+
+    def measure(rows):
+        shift, quality = _correlation_shift(projs[:, 0, rows], projs[:, 1, rows], min_overlap=max(nrays//20, 4))
+        return shift/2*proj_downsample, quality # shift between opposing projections is twice the COR
+
+    with trace.stage("cor_correlation", heights=num_heights):
+        results = resources.run_blocks(measure, bands, num_threads) # numpy/scipy release the GIL during FFTs, so threads run in parallel
+    cors, quality = np.array(results).T
+    # binned row r covers full resolution slices first_slice + (r*proj_downsample ... (r+1)*proj_downsample-1)*step
+    slices = np.array([first_slice + ((rows[0] + rows[-1] + 1)*proj_downsample/2 - 0.5)*step for rows in bands])
+    # binning pads the detector to a whole number of binned pixels, which moves its center by half the padding
+    cors += (nrays*proj_downsample - metadata['numrays'])/2
+    profile = CORProfile(slices, cors, quality, reference_slice=(first_slice + last_slice - step)/2, tolerance=max(1., proj_downsample/2))
+    if metadata['angularrange'] > 300: # opposing projections only overlap a little on offset 360 degree scans, so they're often off by a pixel or so, which goes straight into the stitching overlap
+        with trace.stage("cor_refine_360"):
+            COR = profile(profile.reference_slice)
+            profile.COR += refine_cor_360(path, COR, int(round(profile.reference_slice))) - COR
+    return profile
+
+def refine_cor_360(path, COR, slice_num, search=3, step=0.1, num_rows=8):
+    """ Refines a COR estimate of a 360 degree scan by how well the two halves of the sinogram match where they overlap when stitched (see _seam_scores). Returns the refined COR
+        (or COR unchanged if the halves don't overlap anywhere in the search range). Reads num_rows full resolution slices around slice_num, all projections
+        COR: estimate, in full resolution pixels from center (eg. from estimate_cor_profile)
+        search: trial CORs go from COR-search to COR+search pixels, in steps of step
+    """
+    metadata = als.read_metadata(path, print_flag=False)
+    first = int(np.clip(slice_num - num_rows//2, 0, max(metadata['numslices'] - num_rows, 0)))
+    tomo, _ = als.read_data(path, sino=slice(first, min(first + num_rows, metadata['numslices']), 1), preprocess_settings={'minimum_transmission':0.01})
+    cors = np.arange(COR - search, COR + search + step/2, step)
+    cors = cors[(cors >= 0) & (cors <= metadata['numrays']/2)] # overlap between 0 and the whole detector
+    seam = _seam_scores(tomo, cors) if cors.size else np.array([np.nan])
+    if np.all(np.isnan(seam)):
+        return COR
+    return float(cors[np.nanargmin(seam)])
+
+class CORSweep:
+    """ Reconstructions of one slice at a range of trial CORs (see cor_sweep), with image quality scores for each.
+        cors: trial CORs (full resolution pixels from center)
+        recons: float32 array (trials,rows,columns) of reconstructions, masked and in 1/cm like reconstruct
+        sharpness: mean squared gradient (of the lightly smoothed image) inside the mask, per trial. Higher is better: the right COR gives the crispest edges
+        entropy: Shannon entropy (bits) of each trial's histogram inside the mask, all trials binned the same. Lower is better: arc artifacts from a wrong COR spread values out
+        seam: 360 degree scans only (None otherwise), mismatch of the two halves of the sinogram where they overlap when stitched at each trial COR (see _seam_scores). Lower is better.
+              Sharpness and entropy don't work on 360 degree scans: the stitched field of view grows with the overlap, so they drift steadily across the range whether or not COR is right
+    """
+    def __init__(self, cors, recons, slice_num, seam=None):
+        self.cors = np.asarray(cors, dtype=np.float64)
+        self.recons = recons
+        self.slice_num = slice_num
+        self.sharpness, self.entropy = _sweep_scores(recons)
+        self.seam = None if seam is None else np.asarray(seam, dtype=np.float64)
+
+    @property
+    def default_score(self):
+        """ Score best uses by default: "seam" for 360 degree scans, "entropy" otherwise """
+        return "entropy" if self.seam is None else "seam"
+
+    def best_index(self, score=None):
+        """ Index of the trial with the best score ("entropy", "sharpness" or "seam"). None means default_score """
+        score = score or self.default_score
+        assert score in ["entropy", "sharpness", "seam"], f"score must be 'entropy', 'sharpness' or 'seam', but got: {score}"
+        if score == "seam":
+            assert self.seam is not None, "seam score is only measured for 360 degree scans"
+            return int(np.nanargmin(self.seam))
+        return int(np.argmin(self.entropy) if score == "entropy" else np.argmax(self.sharpness))
+
+    def best(self, score=None):
+        """ Trial COR with the best score ("entropy", "sharpness" or "seam"). None means default_score """
+        return float(self.cors[self.best_index(score)])
+
+    def __repr__(self):
+        if self.seam is not None:
+            best = f"best COR {self.best('seam'):g} by seam"
+        else:
+            best = f"best COR {self.best('entropy'):g} by entropy, {self.best('sharpness'):g} by sharpness"
+        return f"CORSweep(slice {self.slice_num}, {self.cors.size} CORs from {self.cors[0]:g} to {self.cors[-1]:g}, {best})"
+
+def _sweep_scores(recons):
+    # sharpness and entropy of each trial reconstruction, over pixels inside the recon mask
+    inside = ~als.get_recon_mask(recons.shape[1:])
+    inside_gradient = inside[1:, 1:] & inside[:-1, 1:] & inside[1:, :-1] # both neighbours inside too, so the mask edge doesn't count
+    values = recons[:, inside]
+    value_range = (float(values.min()), float(values.max()))
+    if value_range[0] == value_range[1]: # blank slice
+        return np.zeros(len(recons)), np.zeros(len(recons))
+    sharpness, entropy = np.empty(len(recons)), np.empty(len(recons))
+    for k, recon in enumerate(recons):
+        smoothed = scipy.ndimage.gaussian_filter(recon, 1) # so noise (the same at every COR) doesn't swamp the edges
+        dy = np.diff(smoothed, axis=0)[:, 1:]
+        dx = np.diff(smoothed, axis=1)[1:, :]
+        sharpness[k] = np.mean((dx**2 + dy**2)[inside_gradient])
+        counts, _ = np.histogram(values[k], bins=256, range=value_range)
+        p = counts[counts > 0] / values.shape[1]
+        entropy[k] = -np.sum(p*np.log2(p))
+    return sharpness, entropy
+
+def _seam_scores(tomo, binned_cors, sigma=1.5, min_overlap=2):
+    # For 360 degree scans: mismatch between the first half of the sinogram and the mirrored second half, over the pixels they share when stitched at each trial COR
+    # (rotation 'right', see ALS_recon_functions.sino_360_to_180): sum of squared differences over sum of squares, after removing each row's mean. 0 is a perfect match, nan if they overlap by less than min_overlap pixels.
+    # Both halves are smoothed first (sigma pixels), otherwise the interpolation of fractional overlaps smooths noise by different amounts and makes ripples between whole pixel steps
+    # tomo: (angles,slices,rays) 0-360 degree sinograms, scored together (so slices with little structure, whose mismatch is mostly noise, count for little). binned_cors: trial CORs in pixels of tomo
+    nrays, n = tomo.shape[2], tomo.shape[0]//2
+    first = scipy.ndimage.gaussian_filter(tomo[:n].astype(np.float64), (sigma, 0, sigma)).transpose(1, 0, 2).reshape(-1, nrays)
+    second = scipy.ndimage.gaussian_filter(tomo[n:2*n, :, ::-1].astype(np.float64), (sigma, 0, sigma)).transpose(1, 0, 2).reshape(-1, nrays)
+    seam = np.full(len(binned_cors), np.nan)
+    for k, cor in enumerate(binned_cors):
+        overlap = nrays - 2*cor
+        columns = np.arange(int(np.ceil(nrays - overlap)), nrays) # pixels of the first half that the mirrored second half lands on
+        if columns.size < min_overlap:
+            continue
+        a = first[:, columns]
+        x = columns - (nrays - overlap) # where those pixels are in the second half (linear interpolation)
+        i0 = np.floor(x).astype(int)
+        f = x - i0
+        b = second[:, i0]*(1 - f) + second[:, np.minimum(i0 + 1, nrays - 1)]*f
+        a = a - a.mean(axis=1, keepdims=True)
+        b = b - b.mean(axis=1, keepdims=True)
+        seam[k] = np.sum((a - b)**2) / max(np.sum(a**2 + b**2), 1e-30)
+    return seam
+
+def _backproject_trials(filtered, angles, shifts, widths, num_threads=None):
+    # Backprojects trial k of filtered sinograms (angles, trials or 1, rays) with its rotation axis shifts[k] rays from the center (widths[k]: rays of real data, the rest reads zero).
+    # Whole rays of each shift are applied by offsetting the sinogram, and trials with the same fractional part are backprojected together at COR=fraction,
+    # so every trial is exactly what numpy_fbp_recon gives at its COR, but table lookups are shared across trials (a whole pixel step sweep needs one geometry)
+    nangles, _, nrays = filtered.shape
+    whole = np.floor(np.asarray(shifts) + 1e-6)
+    fraction = np.round(np.asarray(shifts) - whole, 6)
+    recons = np.empty((len(shifts), nrays, nrays), dtype=np.float32)
+    for f in np.unique(fraction):
+        group = np.flatnonzero(fraction == f)
+        stack = np.zeros((nangles, group.size, nrays), dtype=np.float32)
+        for j, k in enumerate(group):
+            source = filtered[:, k if filtered.shape[1] > 1 else 0]
+            s = int(whole[k])
+            first, last = max(0, -s), min(nrays, widths[k] - s)
+            if first < last:
+                stack[:, j, first:last] = source[:, first+s:last+s]
+        recons[group] = als.numpy_backproject(stack, angles, COR=f, num_threads=num_threads)
+    return recons
+
+def cor_sweep(path, slice_num, cor_range, step=1, proj_downsample=1, angles_ind=None,
+              preprocessing_settings={'minimum_transmission':0.01}, postprocessing_settings=None,
+              fc=1, mask=True, num_threads=None):
+    """ Reconstructs one slice at every trial COR from cor_range[0] to cor_range[1] (inclusive) in steps of step, and scores each (see CORSweep). Returns CORSweep.
+        The sinogram is read, preprocessed and filtered once, and trials are backprojected together (ALS_recon_functions.numpy_backproject, one batch per fractional pixel of COR),
+        so a sweep of dozens of CORs costs little more than one reconstruction of that many slices, with no Astra/GPU needed. Each trial is the same as numpy_fbp_recon at that COR.
+        360 degree scans are stitched to 180 degrees once per trial COR, since the overlap depends on it.
+        path: full path to .h5 file
+        slice_num: slice to reconstruct
+        cor_range: (first, last) trial COR, in full resolution pixels from center
+        step: COR step, in full resolution pixels. Can be fractional
+        proj_downsample: downsampling of projections. Trial CORs are still exact (not rounded to downsampled pixels)
+        Other parameters same as ALS_recon_helper.reconstruct
+    """
+    if not proj_downsample: proj_downsample = 1
+    assert step > 0, f"step must be positive, but got: {step}"
+    cors = np.arange(cor_range[0], cor_range[1] + step/2, step)
+    metadata = als.read_metadata(path, print_flag=False)
+    with trace.stage("read_data"):
+        tomo, angles = als.read_data(path, proj=angles_ind, sino=slice(slice_num, slice_num+1, 1),
+                                     downsample_factor=proj_downsample,
+                                     preprocess_settings=preprocessing_settings,
+                                     postprocess_settings=postprocessing_settings)
+    nrays = tomo.shape[2]
+    binned_cors = (cors - (nrays*proj_downsample - metadata['numrays'])/2)/proj_downsample # binning pads the detector, which moves its center
+    seam = None
+    with trace.stage("cor_sweep_filter", trials=cors.size):
+        if metadata['angularrange'] > 300: # stitch at each trial's overlap, all padded on the right to the widest
+            overlaps = nrays - 2*binned_cors
+            assert np.all((overlaps >= 0) & (overlaps <= nrays)), f"360 degree trial CORs must be between 0 and {metadata['numrays']/2} pixels"
+            widths = 2*nrays - np.floor(overlaps).astype(int)
+            sinos = np.zeros((tomo.shape[0]//2, cors.size, widths.max()), dtype=np.float32)
+            for k, overlap in enumerate(overlaps):
+                als.sino_360_to_180(tomo, overlap=overlap, rotation='right', out=sinos[:, k:k+1, :widths[k]], num_threads=1)
+            seam = _seam_scores(tomo, binned_cors)
+            angles = angles[:sinos.shape[0]]
+            shifts = widths/2 - (overlaps % 1)/2 - widths.max()/2 # axis of each stitched sinogram (see ALS_recon_helper.stitched_360_COR), from center of padded width
+            filtered = als.filter_sinograms(sinos, fc=fc, filter_name="ramp", out=sinos, num_threads=num_threads)
+        else: # one sinogram, filtered once for every trial
+            widths = np.full(cors.size, nrays)
+            shifts = binned_cors
+            filtered = als.filter_sinograms(tomo, fc=fc, filter_name="ramp", num_threads=num_threads)
+    with trace.stage("cor_sweep_backproject", trials=cors.size):
+        recons = _backproject_trials(filtered, angles, shifts, widths, num_threads=num_threads)
+    recons = als.finish_recon(recons, metadata['pxsize'], mask=mask, num_threads=num_threads)
+    return CORSweep(cors, recons, slice_num, seam=seam)
@@ -12,12 +12,22 @@ import numpy as np
 import matplotlib.pyplot as plt
 import ipywidgets as widgets
 import scipy.signal as signal
-from scipy.fft import fft, ifft, fftfreq, fftshift
-from skimage import transform, io
+import ALS_recon_resources as resources # before tomopy, so numexpr starts with our thread settings
 import tomopy
-import astra
 import dxchange
 import importlib
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+import scipy.fft
+import ALS_recon_io as als_io
+import ALS_recon_trace as trace
+import ALS_recon_svmbir_cache as svmbir_cache
+# Astra is only needed for the astra_* reconstructions (numpy_fbp_recon works without it)
+astra_spec = importlib.util.find_spec("astra")
+if astra_spec is not None:
+    import astra
 # checks if svmbir is installed before importing (so users who install locally aren't required to install svmbir if they won't use it)
 svmbir_spec = importlib.util.find_spec("svmbir")
 if svmbir_spec is not None: # this 
@@ -25,6 +35,9 @@ if svmbir_spec is not None: # this
 
 def check_for_gpu(verbose = False):
     """ Checks if GPU can be used for reconstruction """
+    if os.environ.get('CUDA_VISIBLE_DEVICES') == '': # GPUs hidden from this process (eg. cpu batch workers)
+        print('No GPU visible to this process, will use CPU')
+        return False
     try:
         subprocess.check_output('nvidia-smi')
         if verbose:
@@ -51,29 +64,17 @@ def read_metadata(path,print_flag=True):
         path: full path to .h5 file
         print_flag: whether to print metadata to screen
     """
-    numslices = int(dxchange.read_hdf5(path, "/measurement/instrument/detector/dimension_y")[0])
-    numrays = int(dxchange.read_hdf5(path, "/measurement/instrument/detector/dimension_x")[0])
-    pxsize = dxchange.read_hdf5(path, "/measurement/instrument/detector/pixel_size")[0] / 10.0  # /10 to convert units from mm to cm
-    numangles = int(dxchange.read_hdf5(path, "/process/acquisition/rotation/num_angles")[0])
-    propagation_dist = dxchange.read_hdf5(path, "/measurement/instrument/camera_motor_stack/setup/camera_distance")[1]
-    kev = dxchange.read_hdf5(path, "/measurement/instrument/monochromator/energy")[0] / 1000
-    angularrange = dxchange.read_hdf5(path, "/process/acquisition/rotation/range")[0]
+    metadata = dict(als_io.open_dataset(path).metadata) # read once when file is opened. Copy so callers can't modify the cached values
     filename = os.path.split(path)[-1]
     
     if print_flag:
         print(f'{filename}:')
-        print(f'numslices: {numslices}, rays: {numrays}, numangles: {numangles}')
-        print(f'angularrange: {angularrange}, pxsize: {pxsize*10000} um, distance: {propagation_dist} mm. energy: {kev} keV')
-        if kev>100:
+        print(f"numslices: {metadata['numslices']}, rays: {metadata['numrays']}, numangles: {metadata['numangles']}")
+        print(f"angularrange: {metadata['angularrange']}, pxsize: {metadata['pxsize']*10000} um, distance: {metadata['propagation_dist']} mm. energy: {metadata['kev']} keV")
+        if metadata['kev']>100:
             print('white light mode detected; energy is set to 30 kev for the phase retrieval function')
           
-    return {'numslices': numslices,
-            'numrays': numrays,
-            'pxsize': pxsize,
-            'numangles': numangles,
-            'propagation_dist': propagation_dist,
-            'kev': kev,
-            'angularrange': angularrange}
+    return metadata
 
 def read_data(path, proj=None, sino=None, downsample_factor=None, prelog=False,
               preprocess_settings={'minimum_transmission':0.01}, postprocess_settings=None, **kwargs):
@@ -87,56 +88,219 @@ def read_data(path, proj=None, sino=None, downsample_factor=None, prelog=False,
         preprocess_settings: dictionary of parameters used to process projections BEFORE log (see prelog_process_tomo)
         postprocess_settings: dictionary of parameters used to process projections AFTER log (see postlog_process_tomo)
     """
-    metadata = read_metadata(path,print_flag=False)
-
-    tomo, flat, dark, angles = dxchange.exchange.read_aps_tomoscan_hdf5(path, proj=proj, sino=sino, dtype=np.float32)
-    angles = angles[proj].squeeze()
-    tomopy.normalize(tomo, flat, dark, out=tomo)
-        
-    if preprocess_settings:
-        tomo = prelog_process_tomo(tomo, preprocess_settings)
+    preprocess_settings = preprocess_settings or {}
+    if any(preprocess_settings.get(key) for key in PRELOG_FILTERS):
+        # stripe/outlier removal need normalized projections and have to run before the threshold, so only threshold and log are fused
+        tomo, angles = read_normalized(path, proj=proj, sino=sino)
+        tomo = prelog_process_tomo(tomo, dict(preprocess_settings, minimum_transmission=None))
+        flat = dark = None
+    else:
+        tomo, angles, flat, dark = read_raw(path, proj=proj, sino=sino)
+    with trace.stage("normalize_log") as span:
+        tomo, nonfinite = normalize_log(tomo, flat, dark, minimum_transmission=preprocess_settings.get('minimum_transmission'), log=not prelog)
+        span.set(nonfinite=nonfinite)
+    warn_nonfinite(nonfinite, tomo.size)
     if prelog:
         # downsampling pre-log can lead to bright halo in recon with radius = nrays -- may need to mask recon
-        if downsample_factor and downsample_factor!=1:
-            tomo = np.asarray([transform.downscale_local_mean(proj, (downsample_factor,downsample_factor), cval=0).astype(proj.dtype) for proj in tomo])
+        tomo = downsample_tomo(tomo, downsample_factor)
         return tomo, angles
-    # take log
-    tomopy.minus_log(tomo, out=tomo)
-    # To Do: safety check for Inf/NaN pixels after log?
+    tomo = postprocess_tomo(tomo, downsample_factor, postprocess_settings)
+    return tomo, angles
+
+def read_raw(path, proj=None, sino=None, dtype=None):
+    """ Reads raw (not normalized) projections, averaged flat/dark fields and angles. Returns tomo, angles, flat, dark
+        path: full path to .h5 file
+        proj: which projections to read (first,last,step). None means all projections.
+        sino: which slices to read (first,last,step). None means all slices.
+        dtype: type of the returned projections. None keeps the type stored in the file (normalize_log converts to float32 as it goes, so no extra pass)
+    """
+    # dataset handle is shared between calls, so file is only opened once and flat/dark are only read and averaged once
+    dataset = als_io.open_dataset(path)
+    raw_dtype = dataset.file['/exchange/data'].dtype
+    with trace.stage("read") as span:
+        tomo = dataset.read_projections(proj=proj, sino=sino, dtype=dtype or raw_dtype)
+        span.set(bytes_read=tomo.size*raw_dtype.itemsize)
+    with trace.stage("flat_dark"):
+        flat, dark = dataset.get_flat_dark(sino=sino)
+    angles = dataset.angles[als_io.as_slice(proj)].squeeze()
+    return tomo, angles, flat, dark
+
+def read_normalized(path, proj=None, sino=None):
+    """ Reads projections and normalizes with flat/dark fields. Input to prelog_process_tomo.
+        path: full path to .h5 file
+        proj: which projections to read (first,last,step). None means all projections.
+        sino: which slices to read (first,last,step). None means all slices.
+    """
+    tomo, angles, flat, dark = read_raw(path, proj=proj, sino=sino, dtype=np.float32)
+    with trace.stage("normalize"):
+        tomopy.normalize(tomo, flat, dark, out=tomo, ncore=resources.get_num_threads())
+    return tomo, angles
+
+def normalize_log(tomo, flat=None, dark=None, minimum_transmission=None, log=True, out=None, num_threads=None, tile_bytes=1<<20):
+    """ Flat/dark normalization, threshold of low transmission and negative log in one pass through memory. Returns out and the number of NaN/Inf pixels in it.
+        Gives the same result as tomopy.normalize, then tomo[tomo < minimum_transmission] = minimum_transmission, then tomopy.minus_log,
+        but works on cache-sized tiles of each projection in float32, so every pixel is read and written once instead of once per step (plus the boolean mask of the threshold).
+        tomo: 3D numpy array (angles,slices,rays), raw counts (any type) or already normalized transmission (if flat is None)
+        flat, dark: averaged flat/dark fields with shape (1,slices,rays) (see ALS_recon_io.get_flat_dark). None means tomo is already normalized
+        minimum_transmission: transmission values below this are set to it before the log. None (or 0) means no threshold
+        log: if False, stop after the threshold (prelog data)
+        out: optional preallocated float32 array with the shape of tomo to write into. None means tomo itself if it is float32, otherwise a new array
+        num_threads: number of threads, each handles a block of angles. None means this process's thread budget (see ALS_recon_resources)
+        tile_bytes: approximate size of the piece of a projection each step runs on (should fit in cache)
+    """
+    nangles, nslices, nrays = tomo.shape
+    if out is None:
+        out = tomo if tomo.dtype == np.float32 else np.empty(tomo.shape, dtype=np.float32)
+    assert out.shape == tomo.shape and out.dtype == np.float32, f"out must be float32 with shape {tomo.shape}, but got: {out.dtype} {out.shape}"
+    if flat is not None:
+        flat, dark = flat.reshape(nslices, nrays), dark.reshape(nslices, nrays)
+        denom = np.maximum(flat - dark, np.float32(1e-6)) # same floor as tomopy.normalize, so dead detector pixels don't divide by zero
+    minimum_transmission = np.float32(minimum_transmission) if minimum_transmission else None
+    rows = max(1, min(nslices, tile_bytes//(4*nrays)))
+    tiles = [(r0, min(r0+rows, nslices)) for r0 in range(0, nslices, rows)]
+
+    def process_block(a0, a1):
+        finite = np.empty((rows, nrays), dtype=bool)
+        nonfinite = 0
+        with np.errstate(divide='ignore', invalid='ignore'): # NaN/Inf are counted and reported instead (see warn_nonfinite)
+            for a in range(a0, a1):
+                for r0, r1 in tiles:
+                    src, dst, ok = tomo[a, r0:r1], out[a, r0:r1], finite[:r1-r0]
+                    if flat is not None:
+                        np.subtract(src, dark[r0:r1], out=dst)
+                        np.divide(dst, denom[r0:r1], out=dst)
+                    elif dst is not src:
+                        np.copyto(dst, src)
+                    if minimum_transmission is not None:
+                        np.maximum(dst, minimum_transmission, out=dst) # NaN stays NaN, same as the masked assignment
+                    if log:
+                        np.log(dst, out=dst)
+                        np.negative(dst, out=dst)
+                    np.isfinite(dst, out=ok)
+                    nonfinite += ok.size - np.count_nonzero(ok)
+        return nonfinite
+
+    if num_threads is None:
+        num_threads = resources.get_num_threads()
+    block_size = max(1, -(-nangles//(4*num_threads))) # a few blocks per thread to balance the load
+    blocks = [(a0, min(a0+block_size, nangles)) for a0 in range(0, nangles, block_size)]
+    nonfinite = sum(resources.run_blocks(lambda b: process_block(*b), blocks, num_threads)) # numpy releases the GIL during arithmetic, so threads run in parallel
+    return out, int(nonfinite)
+
+def warn_nonfinite(nonfinite, size):
+    """ Prints a warning if processed projections have NaN/Inf pixels (eg. zero or negative transmission without a minimum_transmission threshold), since they spread through the whole reconstructed slice """
+    if nonfinite:
+        print(f"Warning: {nonfinite} of {size} pixels are NaN/Inf after log ({100*nonfinite/size:.3g}%). Check flat/dark fields or set minimum_transmission")
+
+def log_and_postprocess_tomo(tomo, downsample_factor=None, postprocess_settings=None):
+    """ Takes negative log of processed projections, downsamples, then applies post-log processing. Last steps of read_data. Modifies tomo in place where possible.
+        downsample_factor: Integer downsampling of projection images using local pixel averaging. None (or 1) means no downsampling 
+        postprocess_settings: dictionary of parameters used to process projections AFTER log (see postlog_process_tomo)
+    """
+    with trace.stage("minus_log") as span:
+        tomo, nonfinite = normalize_log(tomo.astype(np.float32, copy=False))
+        span.set(nonfinite=nonfinite)
+    warn_nonfinite(nonfinite, tomo.size)
+    return postprocess_tomo(tomo, downsample_factor, postprocess_settings)
+
+def postprocess_tomo(tomo, downsample_factor=None, postprocess_settings=None):
+    """ Downsamples projections after log, then applies post-log processing.
+        downsample_factor: Integer downsampling of projection images using local pixel averaging. None (or 1) means no downsampling 
+        postprocess_settings: dictionary of parameters used to process projections AFTER log (see postlog_process_tomo)
+    """
     # downsampling post-log is better
-    if downsample_factor and downsample_factor!=1:
-        tomo = np.asarray([transform.downscale_local_mean(proj, (downsample_factor,downsample_factor), cval=0).astype(proj.dtype) for proj in tomo])
+    with trace.stage("downsample"):
+        tomo = downsample_tomo(tomo, downsample_factor)
     if postprocess_settings: # putting after downsample for efficiency, but could put before too 
         tomo = postlog_process_tomo(tomo, postprocess_settings)
-    return tomo, angles
+    return tomo
+
+def downsample_tomo(tomo, downsample_factor):
+    """ Downsamples each projection image by local pixel averaging (see bin_projections).
+        downsample_factor: Integer downsampling factor. None (or 1) means no downsampling (returns tomo unchanged)
+    """
+    if downsample_factor and downsample_factor!=1:
+        tomo = bin_projections(tomo, downsample_factor)
+    return tomo
+
+def bin_projections(tomo, factor, out=None, edge_mean=False, num_threads=None, block_size=8):
+    """ Downsamples projection images (last two dimensions of tomo) by averaging factor x factor blocks of pixels.
+        Gives the same result as running skimage.transform.downscale_local_mean(proj, (factor,factor), cval=0) on every projection,
+        but reduces whole blocks of projections at once with reshape-and-sum in float32, split across threads.
+        tomo: 3D numpy array (angles,slices,rays)
+        factor: integer downsampling factor
+        out: optional preallocated float32 array with shape (angles, ceil(slices/factor), ceil(rays/factor)) to write into
+        edge_mean: what to do when slices/rays aren't divisible by factor. False averages the leftover edge pixels with zeros (same as downscale_local_mean), True averages only the pixels that exist
+        num_threads: number of threads, each handles a block of angles. None means this process's thread budget (see ALS_recon_resources)
+        block_size: number of projections each thread reduces at once
+    """
+    factor = int(factor)
+    nangles, nslices, nrays = tomo.shape
+    out_shape = (nangles, -(-nslices//factor), -(-nrays//factor))
+    if out is None:
+        out = np.empty(out_shape, dtype=np.float32)
+    assert out.shape == out_shape, f"out must have shape {out_shape}, but got: {out.shape}"
+    my, mx = nslices//factor, nrays//factor # number of complete blocks
+    ry, rx = nslices - my*factor, nrays - mx*factor # leftover edge pixels
+
+    def bin_block(a0, a1):
+        src, dst = tomo[a0:a1], out[a0:a1]
+        # sum along rays by adding strided views (much faster than reducing a reshaped axis of length factor)
+        cols = np.empty((a1-a0, nslices, out_shape[2]), dtype=np.float32)
+        np.copyto(cols[:, :, :mx], src[:, :, 0:mx*factor:factor])
+        for k in range(1, factor):
+            cols[:, :, :mx] += src[:, :, k:mx*factor:factor]
+        if rx:
+            np.sum(src[:, :, mx*factor:], axis=2, dtype=np.float32, out=cols[:, :, mx])
+        # then along slices
+        np.copyto(dst[:, :my], cols[:, 0:my*factor:factor])
+        for k in range(1, factor):
+            dst[:, :my] += cols[:, k:my*factor:factor]
+        if ry:
+            np.sum(cols[:, my*factor:], axis=1, dtype=np.float32, out=dst[:, my])
+        dst *= np.float32(1/factor**2)
+        if edge_mean: # rescale edges to average over only the pixels that exist
+            if ry: dst[:, my, :] *= np.float32(factor/ry)
+            if rx: dst[:, :, mx] *= np.float32(factor/rx)
+
+    blocks = [(a0, min(a0+block_size, nangles)) for a0 in range(0, nangles, block_size)]
+    resources.run_blocks(lambda b: bin_block(*b), blocks, num_threads) # numpy releases the GIL during reductions, so threads run in parallel
+    return out
+
+PRELOG_FILTERS = ['sm_size', 'outlier_diff_1D', 'outlier_diff_2D'] # prelog_process_tomo settings that turn on a stage between normalization and threshold
 
 def prelog_process_tomo(tomo, args):
     """ Apply processing steps to PROJECTIONS (not sinograms) before log. Can make this list as long as you want. """
     # sarepy ring removal (combo of 3 methods, see: https://sarepy.readthedocs.io/toc/section3_1/section3_1_6.html)
     # "small stripe" method relies on median filter along angle dimension (after sorting) 
     if 'sm_size' in args and args['sm_size']:
-        tomo = tomopy.remove_all_stripe(tomo,snr=args['snr'], la_size=args['la_size'], sm_size=args['sm_size'])
+        with trace.stage("remove_all_stripe"):
+            tomo = tomopy.remove_all_stripe(tomo,snr=args['snr'], la_size=args['la_size'], sm_size=args['sm_size'], ncore=resources.get_num_threads())
 
     # 1D median filter along angle dimension, to remove outliers 
     if 'outlier_diff_1D' in args and args['outlier_diff_1D']:
         # currently hardcoded to filter along angle dimension
-        tomopy.misc.corr.remove_outlier1d(tomo, args['outlier_diff_1D'], size=args['outlier_size_1D'], axis=0, out=tomo)
+        with trace.stage("remove_outlier1d"):
+            tomopy.misc.corr.remove_outlier1d(tomo, args['outlier_diff_1D'], size=args['outlier_size_1D'], axis=0, ncore=resources.get_num_threads(), out=tomo)
         
     # 2D median filter on each projection (ie, perpendicular to angle), to remove outliers 
     if 'outlier_diff_2D' in args and args['outlier_diff_2D']:
         # currently hardcoded to filter along
-        tomopy.misc.corr.remove_outlier(tomo, args['outlier_diff_2D'], size=args['outlier_size_2D'], axis=0, out=tomo)
+        with trace.stage("remove_outlier"):
+            tomopy.misc.corr.remove_outlier(tomo, args['outlier_diff_2D'], size=args['outlier_size_2D'], axis=0, ncore=resources.get_num_threads(), out=tomo)
 
     # threshold low measurements
     if 'minimum_transmission' in args and args['minimum_transmission']:
-        tomo[tomo < args['minimum_transmission'] ] = args['minimum_transmission']
+        with trace.stage("threshold"):
+            tomo[tomo < args['minimum_transmission'] ] = args['minimum_transmission']
     return tomo
 
 def postlog_process_tomo(tomo, args):
     """ Apply processing steps to PROJECTIONS (not sinograms) after log. Can make this list as long as you want. """
     # wavelet filter to remove rings (stripes in sinogram)
     if 'ringSigma' in args and args['ringSigma']:
-        tomo = tomopy.remove_stripe_fw(tomo, sigma=args['ringSigma'], level=args['ringLevel'], pad=False, wname='db5')
+        with trace.stage("remove_stripe_fw"):
+            tomo = tomopy.remove_stripe_fw(tomo, sigma=args['ringSigma'], level=args['ringLevel'], pad=False, wname='db5', ncore=resources.get_num_threads())
     
     return tomo
 
@@ -161,6 +325,29 @@ def preprocess_tomo_orig(tomo, flat, dark,
     tomo = tomopy.remove_stripe_fw(tomo, sigma=ringSigma, level=ringLevel, pad=True, wname=ringWavelet)
     return tomo
 
+_recon_masks = OrderedDict() # (shape, r) -> boolean image, True outside mask radius
+_recon_masks_lock = threading.Lock()
+
+def get_recon_mask(shape, r=None):
+    """ Boolean image that is True outside the circular mask (see mask_recon). Cached and read-only, since every chunk of a batch job has the same slice shape
+        shape: (rows, columns) of reconstructed slices
+        r: mask radius. None defaults to half of image width or height (whichever is larger)
+    """
+    if r is None:
+        r = np.maximum(shape[0],shape[1])/2
+    key = (tuple(shape), float(r))
+    with _recon_masks_lock:
+        outside = _recon_masks.get(key)
+        if outside is None:
+            x, y = np.arange(shape[0]), np.arange(shape[1])
+            X,Y = np.meshgrid(x-x.mean(),y-y.mean(),indexing='ij')
+            outside = X**2 + Y**2 > r**2
+            outside.flags.writeable = False
+            _recon_masks[key] = outside
+            while len(_recon_masks) > 8:
+                _recon_masks.popitem(last=False)
+    return outside
+
 def mask_recon(recon,r=None):
     """ Applies circular mask to image - all pixels outside radius set to zero.
         r: mask radius. None defaults to half of image width or height (whichever is larger)
@@ -171,17 +358,170 @@ def mask_recon(recon,r=None):
         recon = np.expand_dims(recon,0)
 
     # Need to add this to remove bright halo
-    x, y = np.arange(recon.shape[1]), np.arange(recon.shape[2])
-    X,Y = np.meshgrid(x-x.mean(),y-y.mean(),indexing='ij')
-    if r is None:
-        r = np.maximum(recon.shape[1],recon.shape[2])/2
-    recon[:,(X**2 + Y**2 > (r)**2)] = 0
+    recon[:,get_recon_mask(recon.shape[1:],r)] = 0
     
     if not stack_flag:
         recon = recon.squeeze()
         
     return recon
 
+def get_unit_scale(pxsize):
+    """ Factor that converts reconstructed voxel values from 1/pixel to 1/cm (or 1/10um for pixels under 10 nm, Dula's request)
+        pxsize: pixel size in cm (metadata['pxsize'])
+    """
+    scale = 1/pxsize
+    if pxsize < 1e-6: # if less than 10 nm resolution
+        scale *= 1000
+    return scale
+
+class ReconStats:
+    """ Running min, max and histogram of reconstructed values, collected chunk by chunk by finish_recon, so color limits don't need another pass over the volume.
+        Thread safe, so blocks of a chunk can be added from several threads.
+        bins: number of histogram bins
+        value_range: (low, high) of histogram. None means set from the first data added, widened by its range on both sides.
+                     When later data falls outside (eg. the first chunk was nearly empty edge slices), the range is doubled (merging pairs of bins) until it fits, so percentiles stay accurate to a bin width
+    """
+    def __init__(self, bins=4096, value_range=None):
+        self.bins = bins
+        self.value_range = value_range
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.min = np.inf
+        self.max = -np.inf
+        self.count = 0
+        self.num_nan = 0
+        self._lock = threading.Lock()
+
+    def update(self, data):
+        """ Adds values of data (any shape) """
+        lo, hi = np.min(data), np.max(data)
+        num_nan = 0
+        if np.isnan(lo) or np.isnan(hi): # ignore NaNs
+            nan = np.isnan(data)
+            num_nan = int(np.count_nonzero(nan))
+            data = data[~nan]
+            if data.size == 0:
+                with self._lock:
+                    self.num_nan += num_nan
+                return
+            lo, hi = np.min(data), np.max(data)
+        with self._lock:
+            if self.value_range is None:
+                width = float(hi - lo) or 1.
+                self.value_range = (float(lo) - width, float(hi) + width)
+            self._widen(float(lo), float(hi))
+            low, high = self.value_range
+        index = np.subtract(data, low, dtype=np.float32)
+        index *= np.float32(self.bins/(high - low))
+        np.clip(index, 0, self.bins-1, out=index) # (only float32 round off at the edges)
+        counts = np.bincount(index.astype(np.intp).ravel(), minlength=self.bins)
+        with self._lock:
+            if self.value_range != (low, high): # another thread widened the range meanwhile
+                counts = self._rebin(counts, (low, high), self.value_range)
+            self.counts += counts
+            self.min = min(self.min, float(lo))
+            self.max = max(self.max, float(hi))
+            self.count += data.size
+            self.num_nan += num_nan
+
+    def _widen(self, lo, hi):
+        # doubles value_range (towards the side that is too small) until lo to hi fits, merging pairs of bins. Call with lock held
+        low, high = self.value_range
+        while lo < low or hi > high:
+            if lo < low:
+                low -= high - low
+            else:
+                high += high - low
+        if (low, high) != self.value_range:
+            self.counts = self._rebin(self.counts, self.value_range, (low, high))
+            self.value_range = (low, high)
+
+    def _rebin(self, counts, old_range, new_range):
+        # counts of histogram over old_range, moved to bins over new_range (each old bin goes to the new bin its center is in: exact when new_range is old_range doubled)
+        old_width = (old_range[1] - old_range[0])/self.bins
+        centers = old_range[0] + (np.arange(self.bins) + 0.5)*old_width
+        index = np.clip(((centers - new_range[0])*self.bins/(new_range[1] - new_range[0])).astype(np.intp), 0, self.bins-1)
+        return np.bincount(index, weights=counts, minlength=self.bins).astype(np.int64)
+
+    def merge(self, other):
+        """ Adds the values collected by another ReconStats with the same bins (eg. from another worker). Its histogram is moved to this one's bins, widening the range if needed """
+        assert other.bins == self.bins, "can only merge ReconStats with the same number of histogram bins"
+        if other.count == 0:
+            self.num_nan += other.num_nan
+            return self
+        if self.value_range is None:
+            self.value_range = other.value_range
+        self._widen(*other.value_range)
+        self.counts += self._rebin(other.counts, other.value_range, self.value_range)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.count += other.count
+        self.num_nan += other.num_nan
+        return self
+
+    def percentile(self, q):
+        """ Approximate percentile(s) q (0-100) of values added so far, from the histogram (accurate to a bin width, and never outside min/max) """
+        assert self.count > 0, "no values added yet"
+        low, high = self.value_range
+        edges = np.linspace(low, high, self.bins+1)
+        cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        values = np.interp(np.asarray(q, dtype=np.float64)/100*self.count, cumulative, edges)
+        return np.clip(values, self.min, self.max)
+
+    def __repr__(self):
+        if self.count == 0:
+            return "ReconStats(no values)"
+        p1, p99 = self.percentile([1, 99])
+        return f"ReconStats(min={self.min:.4g}, max={self.max:.4g}, 1-99 percentile={p1:.4g} to {p99:.4g}, {self.count} values" + (f", {self.num_nan} NaN)" if self.num_nan else ")")
+
+def finish_recon(recon, pxsize=None, mask=True, r=None, stats=None, dtype=None, num_threads=None, block_size=8):
+    """ Post-reconstruction epilogue: masks, converts units, collects stats and casts reconstructed slices in one pass over each block of slices, instead of a full pass over the volume for each.
+        recon: 2D or 3D array of reconstructed slices (slices,rows,columns). Modified in place
+        pxsize: pixel size in cm (metadata['pxsize']), to convert values from 1/pixel to 1/cm (see get_unit_scale). None means leave units alone
+        mask: whether to set pixels outside the circular mask to zero (see mask_recon). r: mask radius
+        stats: ReconStats to add the (final) values to. None means don't collect stats
+        dtype: output dtype, eg. np.float16 to halve the size of saved volumes. None means keep dtype of recon.
+               Values too large for dtype (eg. float16 above 65504, which 1/cm values of very small pixels can reach) are clipped to its largest value, with a warning, instead of becoming inf
+        num_threads: number of threads, each handles a block of slices. None means this process's thread budget (see ALS_recon_resources)
+        block_size: number of slices each thread processes at once (small enough to stay in cache between steps)
+        Returns recon, or a new array of dtype
+    """
+    assert recon.ndim in [2,3], f"Image dimensions must be 2 or 3, but got: {recon.ndim}"
+    stack = recon if recon.ndim == 3 else recon[None]
+    if dtype is None or np.dtype(dtype) == recon.dtype:
+        out = recon
+    else:
+        out = np.empty(recon.shape, dtype=dtype)
+    out_stack = out if out.ndim == 3 else out[None]
+    scale = stack.dtype.type(get_unit_scale(pxsize)) if pxsize is not None else None
+    outside = get_recon_mask(stack.shape[1:], r) if mask else None
+    limit = None # largest value of a smaller float output dtype
+    if out is not recon and np.issubdtype(out.dtype, np.floating) and np.finfo(out.dtype).max < np.finfo(stack.dtype).max:
+        limit = stack.dtype.type(np.finfo(out.dtype).max)
+    clipped = [] # largest magnitude of blocks that had to be clipped
+
+    def finish_block(s0, s1):
+        block = stack[s0:s1]
+        if scale is not None:
+            block *= scale
+        if outside is not None:
+            block[:, outside] = 0
+        if stats is not None:
+            stats.update(block) # (true values, before clipping)
+        if limit is not None:
+            largest = max(-float(np.min(block)), float(np.max(block)))
+            if largest > limit:
+                np.clip(block, -limit, limit, out=block)
+                clipped.append(largest)
+        if out is not recon:
+            out_stack[s0:s1] = block
+
+    nslices = stack.shape[0]
+    blocks = [(s0, min(s0+block_size, nslices)) for s0 in range(0, nslices, block_size)]
+    resources.run_blocks(lambda b: finish_block(*b), blocks, num_threads) # numpy releases the GIL during arithmetic, so threads run in parallel
+    if clipped:
+        print(f"Warning: reconstructed values up to {max(clipped):.4g} don't fit in {out.dtype} (largest {float(limit):g}), clipped. Save as float32 to keep them")
+    return out
+
 def auto_find_cor(path):
     """ Reads first and last projection image and uses cross-correlation to estimate COR. Uses tomopy implementation.
         Note: COR converted to units of pixels FROM CENTER (ie perfectly centered projections have a COR=0). Tomopy uses pixels from edge. 
@@ -218,7 +558,7 @@ def plot_0_and_180_proj_diff(first_proj,last_proj_flipped,init_cor=0,fignum=1,ys
     fig, axs = plt.subplots(num=fignum)
     fig.canvas.toolbar_position = 'right'
     fig.canvas.header_visible = False
-    shifted_last_proj = shift_projections(last_proj_flipped, 2*init_cor, yshift=0)
+    shifted_last_proj = shift_images(last_proj_flipped, 2*init_cor)
     img = axs.imshow(first_proj - shifted_last_proj, cmap='gray',vmin=-.1,vmax=.1)
     plt.tight_layout()
 
@@ -239,21 +579,150 @@ def plot_0_and_180_proj_diff(first_proj,last_proj_flipped,init_cor=0,fignum=1,ys
     return axs, img, ui, sliders
 
 def shift_projections(projs, COR, yshift=0):
-    """ Applies tranlation to image using scikit-image. Used for manual COR finding.
+    """ Applies tranlation to image(s). Used for manual COR finding. Same shifts and linear interpolation as the scikit-image warp this used to be, but in float32 and multithreaded (see shift_images)
         projs: 2D projection images to translate (can be one or multiple in a stack)
-        COR: x shift to apply
-        y_shift: y shift to apply
-    """
-    translateFunction = transform.SimilarityTransform(translation=(-COR, yshift))
-    if projs.ndim == 2:
-        shifted = transform.warp(projs, translateFunction)
-    elif projs.ndim == 3:
-        # Apply translation with interpolation to projection[n]
-        shifted = np.asarray([transform.warp(proj, translateFunction) for proj in projs])
-    else:
-        print('projs must be 2D or 3D')
-        return
-    return shifted
+        COR: x shift to apply (positive moves image right)
+        y_shift: y shift to apply (positive moves image up)
+    """
+    return shift_images(projs, COR, -yshift)
+
+def shift_images(images, xshift=0, yshift=0, method="linear", out=None, num_threads=None, block_size=64):
+    """ Translates 2D image(s) by (xshift, yshift) pixels, with zeros shifted in from the edges. Returns float32 array.
+        Whole pixels of the shift are a copy to the shifted position, only the fractional pixel is interpolated, one axis at a time (vectorized over the stack).
+        Rows are split into blocks across threads for the x shift, then columns for the y shift.
+        images: 2D image or 3D stack of images (images,rows,columns), eg. tomo (angles,slices,rays) to shift along rays
+        xshift: pixels to move images right (along columns). Can be fractional
+        yshift: pixels to move images down (along rows). Can be fractional
+        method: "linear" (linear interpolation, same as scikit-image warp with order=1) or "fourier" (phase shift, so no interpolation blur, but slight ringing near sharp edges)
+        out: float32 array with the same shape as images to write into (not images itself). None means a new array
+        num_threads: number of threads. None means this process's thread budget (see ALS_recon_resources)
+        block_size: number of rows (or columns) each thread shifts at once
+    """
+    assert images.ndim in [2,3], f"Image dimensions must be 2 or 3, but got: {images.ndim}"
+    assert method in ["linear", "fourier"], f"method must be 'linear' or 'fourier', but got: {method}"
+    if out is None:
+        out = np.empty(images.shape, dtype=np.float32)
+    assert out.shape == images.shape and out.dtype == np.float32, f"out must be float32 with shape {images.shape}, but got: {out.dtype} {out.shape}"
+    assert not np.shares_memory(out, images), "out can't overlap images"
+    src, dst = (images, out) if images.ndim == 3 else (images[None], out[None])
+    passes = [(axis, shift) for axis, shift in [(2, xshift), (1, yshift)] if shift != 0]
+    if not passes: # nothing to shift
+        dst[...] = src
+        return out
+    for n, (axis, shift) in enumerate(passes):
+        target = dst if n == len(passes) - 1 else np.empty(src.shape, dtype=np.float32) # x then y: first of two passes goes to a temporary
+        # blocks across the axis that isn't shifted (rows for x, columns for y)
+        other = 1 if axis == 2 else 2
+        length = src.shape[other]
+        index = lambda b0, b1: (slice(None), slice(b0, b1), slice(None)) if other == 1 else (slice(None), slice(None), slice(b0, b1))
+        blocks = [(b0, min(b0+block_size, length)) for b0 in range(0, length, block_size)]
+        shift_block = lambda b: _shift_axis(src[index(*b)], target[index(*b)], shift, axis, method)
+        resources.run_blocks(shift_block, blocks, num_threads) # numpy and scipy.fft release the GIL, so threads run in parallel
+        src = target
+    return out
+
+def _shift_axis(src, dst, shift, axis, method):
+    # dst[k] = src[k - shift] along axis (zeros where k - shift is outside src): fractional part interpolated, whole part by offset slices
+    src, dst = np.moveaxis(src, axis, -1), np.moveaxis(dst, axis, -1)
+    n = src.shape[-1]
+    whole = int(np.floor(shift))
+    f = np.float32(shift - whole)
+
+    def place(values, offset, weight=None, add=False):
+        # dst[k] = weight*values[k - offset] where that's inside values (zero elsewhere), or add to dst there
+        first, last = min(max(offset, 0), n), max(min(n + offset, n), 0)
+        if not add:
+            dst[..., :first] = 0
+            dst[..., max(last, first):] = 0
+        if first >= last:
+            return
+        part, target = values[..., first-offset:last-offset], dst[..., first:last]
+        if add:
+            target += part if weight is None else weight*part
+        elif weight is None:
+            target[...] = part
+        else:
+            np.multiply(part, weight, out=target)
+
+    if f == 0:
+        place(src, whole)
+    elif method == "linear": # between src[k - whole] and src[k - whole - 1]
+        place(src, whole, 1-f)
+        place(src, whole+1, f, add=True)
+    else: # zero padded so the phase shift doesn't wrap the edges around
+        padded = scipy.fft.next_fast_len(2*n, real=True)
+        spectrum = scipy.fft.rfft(src, n=padded, axis=-1)
+        spectrum *= np.exp(-2j*np.pi*f*scipy.fft.rfftfreq(padded)).astype(np.complex64)
+        shifted = scipy.fft.irfft(spectrum, n=padded, axis=-1, overwrite_x=True)
+        place(shifted[..., :n], whole)
+        place(shifted[..., n:n+1], whole+n, add=True) # part of the last pixel moved past the edge of src, which is inside dst if whole < 0
+
+def _fast_even_length(n):
+    # smallest length >= n that scipy.fft is fast for, and even (so the ramp filter is symmetric)
+    n = scipy.fft.next_fast_len(int(n), real=True)
+    while n % 2:
+        n = scipy.fft.next_fast_len(n+1, real=True)
+    return n
+
+@functools.lru_cache(maxsize=32)
+def get_filter_plan(num_rays, fc=1, filter_name=None):
+    """ Designs the filter applied along rays before backprojection, once per (num_rays, fc, filter_name) -- every chunk of a scan reuses it.
+        Returns (padded length, frequency response for rfft of that length as read-only float32 array)
+        num_rays: number of rays in sinograms
+        fc: normalized LP filter cutoff (1 = no LP filter, 0 = filter everything)
+        filter_name: None (LP filter only) or "ramp" (FBP ramp filter, times LP filter if fc != 1)
+    """
+    assert filter_name in [None, "ramp"], f"filter_name must be None or 'ramp', but got: {filter_name}"
+    N = np.minimum(100,num_rays) # LP filter taps
+    # pad so filtering is a linear (not circular) convolution, ie. edges don't wrap around into each other. Ramp filter kernel is as long as the data
+    padded = _fast_even_length(2*num_rays if filter_name == "ramp" else num_rays + N)
+    freqs = scipy.fft.rfftfreq(padded)
+    response = np.ones(freqs.size)
+    if filter_name == "ramp":
+        # same ramp as skimage iradon: spatial domain ramp (Kak & Slaney), which avoids the DC offset of a plain |f| ramp
+        n = np.concatenate((np.arange(1, padded/2 + 1, 2, dtype=int), np.arange(padded/2 - 1, 0, -2, dtype=int)))
+        f = np.zeros(padded)
+        f[0] = 0.25
+        f[1::2] = -1 / (np.pi * n) ** 2
+        response *= 2 * np.real(scipy.fft.rfft(f))
+    if fc != 1:
+        lpf = signal.firwin(N,fc) # time domain filter taps
+        _, LPF = signal.freqz(lpf,a=1,worN=2*np.pi*freqs)
+        response *= np.abs(LPF) # abs keeps filter zero phase -- no pixel shift
+    response = response.astype(np.float32)
+    response.setflags(write=False) # shared by every caller
+    return padded, response
+
+def filter_sinograms(tomo, fc=1, filter_name=None, out=None, num_threads=None, block_size=8):
+    """ Applies LP and/or ramp filter (see get_filter_plan) along rays of every sinogram, with zero-padded real FFTs in float32.
+        Works through blocks of projections across threads, so the only full size array is the output.
+        tomo: 3D numpy array (angles,slices,rays)
+        fc: normalized LP filter cutoff (1 = no LP filter, 0 = filter everything)
+        filter_name: None (LP filter only) or "ramp"
+        out: float32 array with the same shape as tomo to write into. Can be tomo itself to filter in place. None means a new array
+        num_threads: number of threads, each handles a block of angles. None means this process's thread budget (see ALS_recon_resources)
+        block_size: number of projections each thread filters at once
+    """
+    nangles, nslices, nrays = tomo.shape
+    padded, response = get_filter_plan(nrays, fc, filter_name)
+    if out is None:
+        out = np.empty(tomo.shape, dtype=np.float32)
+    assert out.shape == tomo.shape and out.dtype == np.float32, f"out must be float32 with shape {tomo.shape}, but got: {out.dtype} {out.shape}"
+
+    def filter_block(a0, a1):
+        buffer = np.zeros((a1-a0, nslices, padded), dtype=np.float32)
+        buffer[:, :, :nrays] = tomo[a0:a1]
+        if filter_name is None: # LP only: pad with edge values (half after the last ray, half wrapping around before the first), so edges aren't pulled towards zero
+            right = (padded - nrays) // 2
+            buffer[:, :, nrays:nrays+right] = buffer[:, :, nrays-1:nrays]
+            buffer[:, :, nrays+right:] = buffer[:, :, 0:1]
+        spectrum = scipy.fft.rfft(buffer, axis=2, overwrite_x=True)
+        spectrum *= response
+        out[a0:a1] = scipy.fft.irfft(spectrum, n=padded, axis=2, overwrite_x=True)[:, :, :nrays]
+
+    blocks = [(a0, min(a0+block_size, nangles)) for a0 in range(0, nangles, block_size)]
+    resources.run_blocks(lambda b: filter_block(*b), blocks, num_threads) # scipy.fft releases the GIL, so threads run in parallel
+    return out
 
 def astra_fbp_recon(tomo,angles,COR=0,fc=1,gpu=False,**kwargs):
     """ Filtred backprojection reconstruction using 2D Astra backprojection operator (ie slice by slice).
@@ -264,21 +733,20 @@ def astra_fbp_recon(tomo,angles,COR=0,fc=1,gpu=False,**kwargs):
         gpu: whether to use Astra GPU or CPU implementation
     """
     if fc != 1:
-        # Apply 1D LP filter to sinogram along ray dimension
-        N = np.minimum(100,tomo.shape[2])
-        lpf = signal.firwin(N,fc) # time domain filter taps
-        _, LPF = np.abs(signal.freqz(lpf,a=1,worN=tomo.shape[2],whole=True)) # freq domain filter, part 1 (abs keeps filter zero phase -- no pixel shift)
-        tomo = np.real(ifft( fft(tomo, axis=2) * LPF, axis=2)) # apply filter in freq domain, part 2
+        # Apply 1D LP filter to sinogram along ray dimension (filtered copy, so caller's tomo is unchanged)
+        tomo = filter_sinograms(tomo, fc=fc)
         # tomo = signal.filtfilt(b,1,tomo,axis=2) # apply filter in time domain. Note: filtfilt ensures no pixel shift, but overfilters a little (ie fc is not technically accurate)
     
     if gpu:
         rec = tomopy.recon(tomo, angles,
                            center=COR + tomo.shape[2]/2,
+                           ncore=resources.get_num_threads(),
                            algorithm=tomopy.astra,
                            options={'method':"FBP_CUDA", 'proj_type':'cuda'})
     else:
         rec = tomopy.recon(tomo, angles,
                            center=COR + tomo.shape[2]/2,
+                           ncore=resources.get_num_threads(),
                            algorithm=tomopy.astra,
                            options={'method':"FBP", 'proj_type':'linear'})
     return rec
@@ -294,11 +762,13 @@ def astra_cgls_recon(tomo,angles,COR=0,num_iter=20,gpu=False,**kwargs):
     if gpu:
         rec = tomopy.recon(tomo, angles,
                            center=COR + tomo.shape[2]/2,
+                           ncore=resources.get_num_threads(),
                            algorithm=tomopy.astra,
                            options={'method':"CGLS_CUDA", 'proj_type':'cuda', 'num_iter': num_iter})
     else:
         rec = tomopy.recon(tomo, angles,
                            center=COR + tomo.shape[2]/2,
+                           ncore=resources.get_num_threads(),
                            algorithm=tomopy.astra,
                            options={'method':"CGLS", 'proj_type':'linear', 'num_iter': num_iter})
     return rec
@@ -326,13 +796,7 @@ def astra_fbp_recon_3d(tomo,angles_or_vectors,vectors=False,COR=0,fc=1):
         proj_geom = astra.geom_postalignment(proj_geom, [-COR])
     
     # filtered
-    ramp_filter_freq_domain = transform.radon_transform._get_fourier_filter(tomo.shape[2],'None').squeeze()
-    if fc != 1:
-        N = np.minimum(100,tomo.shape[2])
-        lpf = signal.firwin(N,fc) # time domain filter taps
-        _, LPF = np.abs(signal.freqz(lpf,a=1,worN=tomo.shape[2],whole=True)) # zero-phase freq domain filter
-        ramp_filter_freq_domain *= LPF
-    tomo = np.real(ifft( fft(tomo, axis=2) * ramp_filter_freq_domain, axis=2))
+    tomo = filter_sinograms(tomo, fc=fc, filter_name="ramp")
 
     # backprojection
     cfg = astra.astra_dict('BP3D_CUDA')    
@@ -379,44 +843,108 @@ def astra_cgls_recon_3d(tomo,angles_or_vectors,vectors=False,COR=0,num_iter=20):
     rec = astra.data3d.get(rec_id)
     return rec
 
-def svmbir_recon(tomo,angles,COR=0,proj_downsample=1,p=1.2,q=2,T=0.1,sharpness=0,snr_dB=40.0,max_iter=100,init_image=None,num_threads=None):
+def svmbir_recon(tomo,angles,COR=0,proj_downsample=1,p=1.2,q=2,T=0.1,sharpness=0,snr_dB=40.0,max_iter=100,init_image=None,num_threads=None,svmbir_lib_path=None,levels=None,level_iters=None,stop_threshold=0.02):
     """ Super Voxel Model Based Image Reconstruction.       
         tomo: sinogram(s) to reconstuct. 3D numpy array (angles,slices,rays)
         angles: projection angles, in radians 
         COR: center of rotation, in pixels from center of image
         proj_downsample: Same as downsample_factor -- integer downsampling of projection images using local pixel averaging. None (or 1) means no downsampling 
+        svmbir_lib_path: where SVMBIR finds system matrices, eg. a node-local copy (see ALS_recon_svmbir_cache.SVMBIRCache.stage). None means get_svmbir_cache_dir()
+        levels: coarse-to-fine binning factors of rays, eg. [4,2,1]. SVMBIR first converges on sinograms binned by the first factor (much smaller system matrix, far fewer voxels),
+                and each level's result is upsampled as init_image of the next. A final level at full resolution (1) is always added. None (or [1]) means full resolution only
+        level_iters: maximum iterations of each level (including the final full resolution one). None means max_iter for every level (each stops earlier once converged, see stop_threshold)
+        stop_threshold: a level stops when the average change of the image in one iteration falls below this (in % of the average image value, see SVMBIR documentation)
+        init_image: starting image at full resolution, in tomopy format (like the result). None means FBP of the coarsest level.
+                Note: it used to be passed to SVMBIR untransposed, so an init_image in tomopy format started SVMBIR from a mirrored image. Images made for that (already in SVMBIR's layout) must now be transposed first
+        num_threads: SVMBIR threads. None means this process's thread budget (see ALS_recon_resources)
         For other parameters, see SVMBIR documetnation (https://svmbir.readthedocs.io/en/latest/index.html)
     """
     if not proj_downsample: proj_downsample = 1
-    if init_image is None:
-        init_image = astra_fbp_recon(tomo,angles,COR=COR/proj_downsample,fc=0.5,gpu=check_for_gpu())
-    tomo = shift_projections(tomo,-COR/proj_downsample) # must manually shift COR. Shifting SVMBIR projector requires recomputing system matrix
-    recon = svmbir.recon(tomo,angles,
-                              center_offset=0.0, # MUST BE ZERO TO AVOID VERY LONG COMPUTATION OF SYSTEM MATRIX
-                              init_image=init_image, # init with fbp for faster convergence
-                              T=T, q=q, p=p, sharpness=sharpness, snr_db=snr_dB,
-                              positivity=False, # must be False due to phase contrast in ALS data
-                              num_threads=num_threads, # None means use all available 
-                              max_iterations=max_iter,
-                              svmbir_lib_path=get_svmbir_cache_dir(), # must have access to this directory
-                              verbose=0) # 0, 1 or 2
-    recon = recon.transpose(0,2,1) # to match tomopy format
+    if num_threads is None: num_threads = resources.get_num_threads() # SVMBIR's own default is every core of the node
+    levels = get_svmbir_levels(levels)
+    if level_iters is None:
+        level_iters = [max_iter]*len(levels)
+    assert len(level_iters) == len(levels), f"level_iters must have one entry per level {levels}, but got: {level_iters}"
+    image, image_factor = (None if init_image is None else init_image.transpose(0,2,1)), 1 # SVMBIR images are transposed compared to tomopy's
+    for factor, iters in zip(levels, level_iters):
+        with trace.stage("svmbir_level", factor=factor):
+            # must manually shift COR (binning keeps the rotation axis centered). Shifting SVMBIR projector requires recomputing system matrix
+            sino = bin_rays(tomo, factor, COR=COR/proj_downsample, num_threads=num_threads)
+            if image is None: # init with fbp for faster convergence
+                image, image_factor = astra_fbp_recon(sino,angles,fc=0.5,gpu=check_for_gpu()).transpose(0,2,1), factor
+            elif image_factor != factor:
+                image = resample_svmbir_image(image, image_factor, factor, sino.shape[2])
+            image = svmbir.recon(sino,angles,
+                                 center_offset=0.0, # MUST BE ZERO TO AVOID VERY LONG COMPUTATION OF SYSTEM MATRIX
+                                 init_image=image,
+                                 T=T, q=q, p=p, sharpness=sharpness, snr_db=snr_dB,
+                                 positivity=False, # must be False due to phase contrast in ALS data
+                                 num_threads=num_threads,
+                                 max_iterations=iters,
+                                 stop_threshold=stop_threshold,
+                                 svmbir_lib_path=svmbir_lib_path or get_svmbir_cache_dir(), # must have access to this directory
+                                 verbose=0) # 0, 1 or 2
+            image_factor = factor
+    recon = image.transpose(0,2,1) # to match tomopy format
     return recon
+
+def get_svmbir_levels(levels):
+    """ Binning factors of svmbir_recon levels, coarsest first and always ending at full resolution (1)
+        levels: list of integer binning factors (or None, which means [1])
+    """
+    levels = [int(factor) for factor in (levels or [])]
+    assert all(factor >= 1 for factor in levels), f"SVMBIR levels must be binning factors >= 1, but got: {levels}"
+    assert levels == sorted(levels, reverse=True), f"SVMBIR levels must go from coarse to fine (eg. [4,2,1]), but got: {levels}"
+    if not levels or levels[-1] != 1:
+        levels.append(1)
+    return levels
+
+def bin_rays(tomo, factor, COR=0, num_threads=None):
+    """ Moves the rotation axis to the center of sinograms and averages groups of factor rays. Returns float32 array (angles, slices, ceil(rays/factor))
+        When rays aren't divisible by factor, the binned detector is padded (with edge values) evenly on both sides, so the axis stays at its center
+        tomo: 3D numpy array (angles,slices,rays)
+        factor: integer binning factor (1 only shifts)
+        COR: center of rotation, in pixels (of tomo) from center of detector
+        num_threads: number of threads for the shift (see shift_images). None means this process's thread budget (see ALS_recon_resources)
+    """
+    nangles, nslices, nrays = tomo.shape
+    nbinned = -(-nrays//factor)
+    pad = nbinned*factor - nrays
+    # an odd pad can't be split evenly, so shift by the extra half pixel instead
+    sino = shift_images(tomo, -COR + (pad%2)/2, num_threads=num_threads)
+    if factor == 1:
+        return sino
+    if pad:
+        sino = np.pad(sino, ((0,0),(0,0),(pad//2,pad-pad//2)), mode='edge')
+    return sino.reshape(nangles, nslices, nbinned, factor).mean(axis=3, dtype=np.float32)
+
+def resample_svmbir_image(image, factor, new_factor, num_pixels):
+    """ Resamples SVMBIR reconstructions of rays binned by factor onto the grid of rays binned by new_factor (eg. to initialize the next level of svmbir_recon).
+        Both grids are centered on the rotation axis (see bin_rays). Values are rescaled too, since they're attenuation per (binned) pixel
+        image: 3D numpy array (slices,pixels,pixels)
+        num_pixels: size of the new grid (rays binned by new_factor)
+    """
+    from scipy import ndimage
+    ratio = new_factor/factor # coarse pixels per new pixel
+    offset = (0.5 - num_pixels/2)*ratio + image.shape[1]/2 - 0.5 # coarse pixel index of the center of new pixel 0
+    out = ndimage.affine_transform(np.asarray(image, dtype=np.float32), [1, ratio, ratio], offset=[0, offset, offset],
+                                   output_shape=(image.shape[0], num_pixels, num_pixels), order=1, mode='nearest')
+    out *= np.float32(ratio)
+    return out
       
 def svmbir_fbp(tomo,angles,cor=0,num_threads=None):
     """ Use SVMBIR projector to do regular FBP reconstruction. Only really useful as a faster test of SVMBIR projectors.
         tomo: sinogram(s) to reconstuct. 3D numpy array (angles,slices,rays)
         angles: projection angles, in radians 
         cor: center of rotation, in pixels from center of image
-        num_threads: How many CPU threads to use. None defaults to all available threads
+        num_threads: How many CPU threads to use. None means this process's thread budget (see ALS_recon_resources)
     """
-    # Using scikit-image implementation of ramp filter, but I've noticed it only works for an even number of rays? I'm sure there's better implementations out there.
-    fourier_filter = transform.radon_transform._get_fourier_filter(tomo.shape[2],'ramp').squeeze()
-    filtered_tomo = np.real(ifft( fft(tomo, axis=2) * fourier_filter, axis=2))
+    # same ramp filter as scikit-image, zero-padded to an even length (so any number of rays works)
+    filtered_tomo = filter_sinograms(tomo, filter_name="ramp", num_threads=num_threads)
     rec = svmbir.backproject(filtered_tomo, angles,
                              geometry='parallel',
                              center_offset=cor,
-                             num_threads=num_threads,
+                             num_threads=num_threads or resources.get_num_threads(),
                              svmbir_lib_path=get_svmbir_cache_dir(),
                              verbose=False)
     return rec
@@ -431,58 +959,150 @@ def tomopy_gridrec_recon(tomo,angles,COR=0,fc=1,butterworth_order=2,**kwargs):
     """
     rec = tomopy.recon(tomo, angles,
                        center=COR + tomo.shape[2]/2,
+                       ncore=resources.get_num_threads(),
                        algorithm='gridrec',
                        filter_name='butterworth',
                        filter_par=[fc, butterworth_order])                       
     return rec
 
+BACKPROJECTION_TABLE_GB = 1. # memory for geometry tables kept between numpy_fbp_recon calls (see BackprojectionGeometry)
+_backprojection_geometries = OrderedDict() # key -> BackprojectionGeometry, least recently used first
+_backprojection_geometries_lock = threading.Lock()
+
+class BackprojectionGeometry:
+    """ Where each reconstructed pixel falls on the detector at each angle, as (index, linear interpolation weight) tables, for numpy_fbp_recon.
+        Same geometry as Astra's parallel beam projector used through tomopy: pixel x to the right, y up, detector position t = x cos(angle) + y sin(angle), rotation axis at COR pixels from center of detector.
+        Tables are made per block of pixels the first time they're needed. If all of them fit in BACKPROJECTION_TABLE_GB, they are kept, so later chunks (or interactive slices) with the same geometry skip that work.
+        Use get_backprojection_geometry rather than creating directly
+    """
+    def __init__(self, num_rays, angles, COR, block_pixels):
+        self.num_rays = num_rays
+        self.num_pixels = num_rays # output is num_rays x num_rays, like tomopy.recon
+        self.cos = np.cos(angles).astype(np.float32)
+        self.sin = np.sin(angles).astype(np.float32)
+        self.offset = np.float32(COR + num_rays/2 - 0.5 + 1) # detector index of t=0, +1 for the zero column padded in front
+        total = self.num_pixels**2
+        self.blocks = [(p0, min(p0+block_pixels, total)) for p0 in range(0, total, block_pixels)]
+        self.nbytes = 8*len(angles)*total
+        self.keep = self.nbytes <= BACKPROJECTION_TABLE_GB*1024**3
+        self._tables = {}
+
+    def table(self, b):
+        """ Detector indices (into sinogram padded with a zero ray at each end) and weights of the next ray, for block b of pixels. Arrays (angles, pixels) """
+        table = self._tables.get(b)
+        if table is None:
+            p0, p1 = self.blocks[b]
+            rows, cols = np.divmod(np.arange(p0, p1), self.num_pixels)
+            x = (cols + 0.5 - self.num_pixels/2).astype(np.float32)
+            y = (self.num_pixels/2 - rows - 0.5).astype(np.float32)
+            u = x[None, :]*self.cos[:, None] + y[None, :]*self.sin[:, None] + self.offset
+            index = np.floor(u)
+            weight = u - index
+            outside = (index < 0) | (index > self.num_rays) # reads zero padding
+            index[outside] = 0
+            weight[outside] = 0
+            table = (index.astype(np.int32), weight)
+            if self.keep:
+                self._tables[b] = table
+        return table
+
+def get_backprojection_geometry(num_rays, angles, COR, block_pixels):
+    """ Cached BackprojectionGeometry for these rays, angles and COR (a new one if any of them changed) """
+    angles = np.asarray(angles, dtype=np.float64).ravel()
+    key = (num_rays, hashlib.sha1(angles.tobytes()).hexdigest(), float(COR), block_pixels)
+    with _backprojection_geometries_lock:
+        geometry = _backprojection_geometries.pop(key, None)
+        if geometry is None:
+            geometry = BackprojectionGeometry(num_rays, angles, COR, block_pixels)
+        _backprojection_geometries[key] = geometry
+        # forget least recently used geometries that don't fit with this one
+        kept = 0
+        for k in reversed(list(_backprojection_geometries)):
+            g = _backprojection_geometries[k]
+            if g.keep and kept + g.nbytes > BACKPROJECTION_TABLE_GB*1024**3:
+                del _backprojection_geometries[k]
+            elif g.keep:
+                kept += g.nbytes
+        while len(_backprojection_geometries) > 8:
+            _backprojection_geometries.popitem(last=False)
+    return geometry
+
+def numpy_fbp_recon(tomo,angles,COR=0,fc=1,num_threads=None,**kwargs):
+    """ Filtered backprojection in NumPy, on CPU. Doesn't need Astra or a GPU, and gives FBP quality (unlike gridrec) on login/shared nodes.
+        Matches astra_fbp_recon on CPU (same geometry and scaling) to a few percent, pixel by pixel -- the ramp filters and interpolation differ slightly at the finest scale.
+        Unlike Astra through tomopy, COR isn't rounded to whole pixels.
+        All slices are backprojected together (one table lookup per pixel and angle is shared by every slice), split into blocks of pixels across threads.
+        tomo: sinogram(s) to reconstuct. 3D numpy array (angles,slices,rays)
+        angles: projection angles, in radians 
+        COR: center of rotation, in pixels from center of image
+        fc: normalized LP filter cutoff (1 = no LP filter, 0 = filter everything)
+        num_threads: number of threads. None means this process's thread budget (see ALS_recon_resources)
+    """
+    # filtered sinograms passed straight through, so numpy_backproject can free them once transposed
+    return numpy_backproject(filter_sinograms(tomo, fc=fc, filter_name="ramp", num_threads=num_threads), angles, COR=COR, num_threads=num_threads)
+
+def numpy_backproject(filtered, angles, COR=0, num_threads=None):
+    """ Backprojection half of numpy_fbp_recon, for sinograms that are already filtered (see filter_sinograms). Returns float32 array (slices,rays,rays)
+        Every slice goes through the same geometry, so callers can stack anything that shares it (eg. one sinogram shifted to several trial CORs, see ALS_recon_cor.cor_sweep) and pay for the table lookups once.
+        filtered: filtered sinogram(s). 3D numpy array (angles,slices,rays)
+        angles: projection angles, in radians
+        COR: center of rotation, in pixels from center of image
+        num_threads: number of threads. None means this process's thread budget (see ALS_recon_resources)
+    """
+    nangles, nslices, nrays = filtered.shape
+    angles = np.asarray(angles).ravel()
+    assert angles.size == nangles, f"Need one angle per projection, but got {angles.size} angles for {nangles} projections"
+    # rays first and slices last, so each table lookup reads all slices at once. Zero ray at each end for pixels outside the detector
+    sino = np.zeros((nangles, nrays+2, nslices), dtype=np.float32)
+    sino[:, 1:-1, :] = filtered.transpose(0, 2, 1)
+    del filtered
+
+    geometry = get_backprojection_geometry(nrays, angles, COR, block_pixels=max(256, 2**16//nslices))
+    out = np.empty((geometry.num_pixels**2, nslices), dtype=np.float32)
+    scale = np.float32(np.pi / (2*nangles)) # same as skimage iradon and Astra FBP
+
+    def backproject_block(b):
+        p0, p1 = geometry.blocks[b]
+        index, weight = geometry.table(b)
+        acc = np.zeros((p1-p0, nslices), dtype=np.float32)
+        left = np.empty_like(acc)
+        right = np.empty_like(acc)
+        for k in range(nangles):
+            np.take(sino[k], index[k], axis=0, out=left, mode="clip") # indices are in range, clip avoids a buffered copy
+            np.take(sino[k, 1:], index[k], axis=0, out=right, mode="clip") # next ray
+            right -= left
+            right *= weight[k][:, None]
+            acc += left
+            acc += right
+        acc *= scale
+        out[p0:p1] = acc
+
+    resources.run_blocks(backproject_block, range(len(geometry.blocks)), num_threads) # numpy releases the GIL in take and arithmetic, so threads run in parallel
+    return np.ascontiguousarray(out.reshape(geometry.num_pixels, geometry.num_pixels, nslices).transpose(2, 0, 1))
 
-def cache_svmbir_projector(num_rays,num_angles,save_to_default_cache=True):
-    """ Creates a SVMBIR system matrix cache as quickly as possible by and automatically saves in location set by get_svmbir_cache_dir.
+
+def cache_svmbir_projector(num_rays,num_angles,save_to_default_cache=True,num_workers=None,levels=None):
+    """ Creates SVMBIR system matrix caches as quickly as possible (in parallel, see ALS_recon_svmbir_cache.SVMBIRCache.prewarm) and saves them in location set by get_svmbir_cache_dir, with an index of what's there.
         Cache depends on both image size, projections angles (assumed evenly distributed from 0 to 180), and COR (assumed 0).
         
         num_rays: number of rays in projections. Produces images with same dimensions in each side. Can be list with multiple entries (will cache all of them)
         num_angles: Number of projection angles. Can be list with multiple entries (will cache all of them)
         save_to_default_cache: If True, saves to the default svmbir cache path. Otherwise, saves to a folder called "svmbir_cache" in your scatch
                 -- for some reason I was having getting "Permission Denied" when trying to save directly the default cache directory on cfs, but I could save to scratch and copy over
+        num_workers: number of matrices to build at once. None means all of them, up to the number of cpus
+        levels: also cache the coarse levels svmbir_recon uses with these levels (eg. [4,2,1]). None means full resolution only
     """
-    if os.environ.get('CLIB') =='CMD_LINE':
-        import svmbir.interface_py_c as ci
-    else:
-        import svmbir.interface_cy_c as ci
-    
     save_path = get_svmbir_cache_dir() if save_to_default_cache else os.path.join(get_scratch_path(),"svmbir_cache")        
     if not isinstance(num_rays, list): num_rays = [num_rays]
     if not isinstance(num_angles, list): num_angles = [num_angles]
-    
-    for i,(sz,nang) in enumerate(zip(num_rays,num_angles)):
-        num_slices = 1
-        num_rows = sz
-        num_cols = sz
-
-        angles = np.linspace(0,np.pi,nang)
-        num_views = len(angles)
-        num_channels = sz
-        roi_radius = float(1.0 * max(num_rows, num_cols))/2.0
-
-        print(f"Starting size: {sz}, num_angles: {nang}")
-        t0 = time.time()
-        paths, sinoparams, imgparams = ci._init_geometry(angles, center_offset=0.0,
-                                                     geometry='parallel', dist_source_detector=0.0,
-                                                     magnification=1.0,
-                                                     num_channels=num_channels, num_views=num_views, num_slices=num_slices,
-                                                     num_rows=num_rows, num_cols=num_cols,
-                                                     delta_channel=1.0, delta_pixel=1.0,
-                                                     roi_radius=roi_radius,
-                                                     object_name='object',
-                                                     svmbir_lib_path=save_path,
-                                                     verbose=2)
-        print(f"{sz}x{sz}-->{nang}x{sz}: {time.time() - t0} sec")
+    geometries = [(-(-sz//factor), np.linspace(0,np.pi,nang)) for sz,nang in zip(num_rays,num_angles) for factor in get_svmbir_levels(levels)]
+    svmbir_cache.SVMBIRCache(save_path).prewarm(geometries, num_workers=num_workers)
 
-        
 def get_svmbir_cache_dir():
-    """ Sets location of SVMBIR system matrix cache. Must be accessible by all users, otherwise SVMBIR will take prohibitively long """
-    return '//global/cfs/cdirs/als/users/tomography_notebooks/svmbir_cache'
+    """ Sets location of SVMBIR system matrix cache. Must be accessible by all users, otherwise SVMBIR will take prohibitively long.
+        Set SVMBIR_CACHE_DIR to use a different directory (eg. when not on NERSC)
+    """
+    return os.environ.get('SVMBIR_CACHE_DIR', '//global/cfs/cdirs/als/users/tomography_notebooks/svmbir_cache')
 
 def get_scratch_path():
     """ Gets path to user's scratch if on NERSC, otherwise returns current directory """
@@ -492,42 +1112,51 @@ def get_scratch_path():
     else: # not on NERSC
         return os.getcwd()
     
-def sino_360_to_180(data, overlap=0, rotation='left'):
-    """ Taken directly from Dula's legacy "reconstruction.py"
-    Converts 0-360 degrees sinogram to a 0-180 sinogram.
-    
-    Parameters
-    ----------
-    data : ndarray
-        Input 3D data.
-
-    overlap : scalar, optional
-        Overlapping number of pixels.
-
-    rotation : string, optional
-        Left if rotation center is close to the left of the
-        field-of-view, right otherwise.
-
-    Returns
-    -------
-    ndarray
-    Output 3D data.
+def sino_360_to_180(data, overlap=0, rotation='left', out=None, num_threads=None, block_size=8):
+    """ Converts 0-360 degrees sinograms to 0-180 degree sinograms, by mirroring the second half of the projections and stitching it onto the first.
+        Based on Dula's legacy "reconstruction.py", but works on views of data in float32, so the only allocation is the output, and stitches blocks of slices in parallel.
+        data: 3D numpy array (angles,slices,rays) of 0-360 degree sinograms. With an odd number of angles, the last one (usually the 360 degree repeat of the first) is ignored
+        overlap: number of pixels the two halves overlap, can be fractional. Integer part is blended linearly, fractional part is a subpixel shift of the mirrored half
+        rotation: 'left' if rotation center is close to the left of the field-of-view, 'right' otherwise
+        out: optional preallocated array with shape (angles//2, slices, 2*rays - floor(overlap)) to write into
+        num_threads: number of threads, each handles a block of slices. None means this process's thread budget (see ALS_recon_resources)
+        block_size: number of slices each thread stitches at once
+        Returns out. Rotation axis is at the center of the stitched sinograms, offset by -overlap%1/2 pixels for 'right' (+overlap%1/2 for 'left')
     """
     dx, dy, dz = data.shape
-    lo = overlap//2
-    ro = overlap - lo
+    assert 0 <= overlap <= dz, f"overlap must be between 0 and {dz} pixels, but got: {overlap}"
+    assert rotation in ('left', 'right'), f"rotation must be 'left' or 'right', but got: {rotation}"
     n = dx//2
-    out = np.zeros((n, dy, 2*dz-overlap), dtype=data.dtype)
-    if rotation == 'left':
-        weights = (np.arange(overlap)+0.5)/overlap
-        out[:, :, -dz+overlap:] = data[:n, :, overlap:]
-        out[:, :, :dz-overlap] = data[n:2*n, :, overlap:][:, :, ::-1]
-        out[:, :, dz-overlap:dz] = weights*data[:n, :, :overlap] + (weights*data[n:2*n, :, :overlap])[:, :, ::-1]
-    elif rotation == 'right':
-        weights = (np.arange(overlap)[::-1]+0.5)/overlap
-        out[:, :, :dz-overlap] = data[:n, :, :-overlap]
-        out[:, :, -dz+overlap:] = data[n:2*n, :, :-overlap][:, :, ::-1]
-        out[:, :, dz-overlap:dz] = weights*data[:n, :, -overlap:] + (weights*data[n:2*n, :, -overlap:])[:, :, ::-1]
+    o = int(np.floor(overlap))
+    dtype = np.result_type(data.dtype, np.float32)
+    out_shape = (n, dy, 2*dz-o)
+    if out is None:
+        out = np.empty(out_shape, dtype=dtype)
+    assert out.shape == out_shape, f"out must have shape {out_shape}, but got: {out.shape}"
+    if rotation == 'left': # same as 'right' on mirrored views of data and out
+        data, stitched = data[:, :, ::-1], out[:, :, ::-1]
+    else:
+        stitched = out
+    f = out.dtype.type(overlap - o)
+    weights = ((np.arange(o)[::-1]+0.5)/o).astype(out.dtype) # weight of first half across the overlap, second half gets 1-weights
+
+    def stitch_block(s0, s1):
+        first, second = data[:n, s0:s1], data[n:2*n, s0:s1][:, :, ::-1]
+        dst = stitched[:, s0:s1]
+        dst[:, :, :dz-o] = first[:, :, :dz-o]
+        mirrored = dst[:, :, dz-o:] # dz pixels wide, starts at the overlap
+        if f: # subpixel shift of mirrored half by linear interpolation (edge pixel repeated)
+            np.multiply(second, 1-f, out=mirrored)
+            mirrored[:, :, :-1] += f*second[:, :, 1:]
+            mirrored[:, :, -1] += f*second[:, :, -1]
+        else:
+            mirrored[...] = second
+        if o:
+            mirrored[:, :, :o] *= 1-weights
+            mirrored[:, :, :o] += weights*first[:, :, dz-o:]
+
+    blocks = [(s0, min(s0+block_size, dy)) for s0 in range(0, dy, block_size)]
+    resources.run_blocks(lambda b: stitch_block(*b), blocks, num_threads) # numpy releases the GIL during arithmetic, so threads run in parallel
     return out
 
 ######### The functions below are used for ipywidgets calls #########
@@ -568,6 +1197,48 @@ def plot_recon_comparison(recon1,recon2,titles=['',''],fignum=1,figsize=4):
                                                                        step=(recon.max()-recon.min())/500, value=clims))
     return axs, img, clim_slider
 
+def plot_cor_sweep(sweep,fignum=1,figsize=4,continuous_update=True):
+    """ Creates a gallery of trial reconstructions from ALS_recon_cor.cor_sweep: a slider flips through trial CORs, next to a plot of their sharpness and entropy scores
+        sweep: CORSweep returned by cor_sweep
+        fignum: matplotlib figure number
+        continuous_update: If True, slider will update on any movement. If false, will only update when slider is released.
+
+        Returns:
+        axs: matplotib axis handles to image and scores plots
+        img: matplotlib image handle to image
+        ui: ipywidgets handle to COR and color scale sliders (starts at best COR by the sweep's default score, see CORSweep.best. Read chosen trial with ui.children[0].label)
+        sliders: ipywidgets handle to slider functionality
+    """
+    if plt.fignum_exists(fignum): plt.close(fignum)
+    fig, axs = plt.subplots(1,2,num=fignum,figsize=(2*figsize,figsize))
+    fig.canvas.toolbar_position = 'right'
+    fig.canvas.header_visible = False
+    best = sweep.best_index()
+    img = axs[0].imshow(sweep.recons[best],cmap='gray')
+    normalize = lambda score: (score - np.nanmin(score)) / max(np.nanmax(score) - np.nanmin(score), 1e-30) # scores have different units, plot all from 0 to 1
+    if sweep.seam is not None: # 360 degree scan: sharpness and entropy drift with the stitched width, so only seam is shown
+        axs[1].plot(sweep.cors, normalize(sweep.seam), '.-', label='seam mismatch (lower is better)')
+    else:
+        axs[1].plot(sweep.cors, normalize(sweep.sharpness), '.-', label='sharpness (higher is better)')
+        axs[1].plot(sweep.cors, normalize(sweep.entropy), '.-', label='entropy (lower is better)')
+    line = axs[1].axvline(sweep.cors[best], color='k', linestyle='--')
+    axs[1].set_xlabel('COR')
+    axs[1].set_yticks([])
+    axs[1].legend(fontsize='small')
+    plt.tight_layout()
+
+    cor_slider = widgets.SelectionSlider(description='COR', options=[(f"{cor:g}", k) for k, cor in enumerate(sweep.cors)], value=best,
+                                         layout=widgets.Layout(width='50%'), continuous_update=continuous_update)
+    clims = [np.percentile(sweep.recons[best],1), np.percentile(sweep.recons[best],99)]
+    clim_slider = widgets.interactive(set_clim, img=widgets.fixed(img),
+                                      clims=widgets.FloatRangeSlider(description='Color Scale', layout=widgets.Layout(width='50%'),
+                                                                           min=sweep.recons.min(), max=sweep.recons.max(),
+                                                                           step=(sweep.recons.max()-sweep.recons.min())/500, value=clims))
+    ui = widgets.VBox([cor_slider, clim_slider])
+    sliders = widgets.interactive_output(set_cor_trial,{'trial':cor_slider,'img':widgets.fixed(img),'axs':widgets.fixed(axs[0]),
+                                                        'line':widgets.fixed(line),'sweep':widgets.fixed(sweep)})
+    return axs, img, ui, sliders
+
 def set_proj(img,path,proj_num,hline_handles=None):
     """ Sets projection image to display. Used by projection plotting sliders
         img: matplotlib image handle(s)
@@ -639,6 +1310,22 @@ def shift_proj_difference(dx,dy,img,axs,first_proj,last_proj_flipped,downsample_
         last_proj_flipped: flipped 180 degree projection        
         downsample_factor: Integer downsampling of projection images using local pixel averaging. None (or 1) means no downsampling 
     """
-    shifted_last_proj = shift_projections(last_proj_flipped, 2*dx, yshift=dy)
-    img.set_data(first_proj - shifted_last_proj)
-    axs.set_title(f"COR: {downsample_factor*dx}, y_shift: {downsample_factor*dy/2}")
\ No newline at end of file
+    difference = shift_images(last_proj_flipped, 2*dx, -dy) # -dy: positive y_shift moves projection up
+    np.subtract(first_proj, difference, out=difference)
+    img.set_data(difference)
+    axs.set_title(f"COR: {downsample_factor*dx}, y_shift: {downsample_factor*dy/2}")
+
+def set_cor_trial(trial,img,axs,line,sweep):
+    """ Sets trial reconstruction of a COR sweep to display. Used by plot_cor_sweep
+        trial: index of trial COR
+        img: matplotlib image handle
+        axs: matplotlib axes handle of image
+        line: matplotlib line handle marking trial COR on scores plot
+        sweep: CORSweep returned by ALS_recon_cor.cor_sweep
+    """
+    img.set_data(sweep.recons[trial])
+    line.set_xdata([sweep.cors[trial], sweep.cors[trial]])
+    if sweep.seam is not None:
+        axs.set_title(f"COR: {sweep.cors[trial]:g}, seam mismatch: {sweep.seam[trial]:.3g}")
+    else:
+        axs.set_title(f"COR: {sweep.cors[trial]:g}, sharpness: {sweep.sharpness[trial]:.3g}, entropy: {sweep.entropy[trial]:.3f}")
@@ -8,7 +8,10 @@ import os
 import time
 import numpy as np
 import ipywidgets as widgets
+from collections import OrderedDict
 import ALS_recon_functions as als
+import ALS_recon_io as als_io
+import ALS_recon_trace as trace
 
 
 def reconstruct(path, angles_ind, slices_ind, COR,
@@ -16,7 +19,7 @@ def reconstruct(path, angles_ind, slices_ind, COR,
                 proj_downsample=1, fc=1,
                 preprocessing_settings={'minimum_transmission':0.01}, postprocessing_settings=None,
                 mask=True, convert360to180=True,
-                use_gpu=False):
+                use_gpu=False, stats=None):
     
     """ This is what the ALS_recon notebook calls for all reconstructions (except SVMBIR cells) -- if not method is set, default is chosen depending on depending on machine/resources    
         path: full path to .h5 file
@@ -26,33 +29,102 @@ def reconstruct(path, angles_ind, slices_ind, COR,
         preprocess_settings: dictionary of parameters used to process projections BEFORE log (see prelog_process_tomo). Note: important to have default minimum_transmission
         postprocess_settings: dictionary of parameters used to process projections AFTER log (see postlog_process_tomo)
         use_gpu: whether to use Astra GPU or CPU implementation
+        stats: ALS_recon_functions.ReconStats to add reconstructed values to, eg. to pick color limits without another pass over recon
+    """
+    tomo, angles, metadata = prepare_tomo(path, angles_ind, slices_ind, COR,
+                                          proj_downsample=proj_downsample,
+                                          preprocessing_settings=preprocessing_settings,
+                                          postprocessing_settings=postprocessing_settings,
+                                          convert360to180=convert360to180)
+    recon = reconstruct_tomo(tomo, angles, COR, metadata,
+                             method=method,
+                             proj_downsample=proj_downsample, fc=fc,
+                             mask=mask,
+                             use_gpu=use_gpu, stats=stats)
+    return recon, tomo
+
+def prepare_tomo(path, angles_ind, slices_ind, COR,
+                 proj_downsample=1,
+                 preprocessing_settings={'minimum_transmission':0.01}, postprocessing_settings=None,
+                 convert360to180=True, sinogram_store=None):
+    """ First half of reconstruct: reads and processes sinograms, and converts 360 degree data to 180 degrees. Split out so batch jobs can read the next chunk while the current one is reconstructing.
+        Same parameters as reconstruct, plus
+        sinogram_store: SinogramStore to reuse processed sinograms from an earlier run (see ALS_recon_sinogram_store). None means always read and process
+        Returns tomo, angles and metadata (needed by reconstruct_tomo). For stitched 360 degree data, metadata['stitched_COR'] is the COR to reconstruct with
     """
     metadata = als.read_metadata(path, print_flag=False)
-    tomo, angles = als.read_data(path,
+    with trace.stage("read_data"):
+        read_data = als.read_data if sinogram_store is None else sinogram_store.read_data
+        tomo, angles = read_data(path,
                                  proj=angles_ind, sino=slices_ind,
                                  downsample_factor=proj_downsample,
                                  preprocess_settings=preprocessing_settings,
                                  postprocess_settings=postprocessing_settings)
     
     if metadata['angularrange'] > 300 and convert360to180: # convert 360 to 180
-        print("Detected 360 degree acquisition - will convert sinograms to 180 degrees")
-            
-        # Taken from Dula's legacy reconstruction.py
-        # In lines below, "tomo.shape[2]-COR" was changed to "tomo.shape[2]//2-COR" to compensate for change in COR definition
-        if tomo.shape[0]%2>0:
-            tomo = als.sino_360_to_180(tomo[0:-1,:,:], overlap=int(np.round((tomo.shape[2]//2-COR/proj_downsample-.5))*2), rotation='right')           
-        else:
-            tomo = als.sino_360_to_180(tomo[:,:,:], overlap=int(np.round((tomo.shape[2]//2-COR/proj_downsample))*2), rotation='right')                       
-        angles = angles[:tomo.shape[0]]
+        metadata['stitched_COR'] = stitched_360_COR(tomo.shape[2], COR, proj_downsample)
+        with trace.stage("sino_360_to_180"):
+            tomo, angles = convert_tomo_360_to_180(tomo, angles, COR, proj_downsample)
+    return tomo, angles, metadata
+
+def convert_tomo_360_to_180(tomo, angles, COR, proj_downsample=1, out=None):
+    """ Converts 360 degree sinograms to 180 degrees, with overlap set by COR (in full resolution pixels from center)
+        out: optional preallocated array to write stitched sinograms into (see ALS_recon_functions.sino_360_to_180)
+        Returns tomo, angles. Reconstruct them with stitched_360_COR as the COR
+    """
+    print("Detected 360 degree acquisition - will convert sinograms to 180 degrees")
+    if not proj_downsample: proj_downsample = 1
+    # Overlap is exact (not rounded to whole pixels), the fractional pixel is a subpixel shift of the mirrored half
+    overlap = tomo.shape[2] - 2*COR/proj_downsample
+    tomo = als.sino_360_to_180(tomo, overlap=overlap, rotation='right', out=out)
+    angles = angles[:tomo.shape[0]]
+    return tomo, angles
+
+def stitched_360_COR(num_rays, COR, proj_downsample=1):
+    """ COR (in full resolution pixels from center) of sinograms stitched by convert_tomo_360_to_180. The rotation axis ends up in the middle, up to the fractional pixel of overlap
+        num_rays: detector width of the 360 degree sinograms, after downsampling
+        COR: COR of the 360 degree scan (in full resolution pixels from center)
+    """
+    if not proj_downsample: proj_downsample = 1
+    overlap = num_rays - 2*COR/proj_downsample
+    return -(overlap % 1)/2 * proj_downsample
+
+def reconstruct_tomo(tomo, angles, COR, metadata,
+                     method=None,
+                     proj_downsample=1, fc=1,
+                     mask=True,
+                     use_gpu=False,
+                     stats=None, dtype=None):
+    """ Second half of reconstruct: reconstructs sinograms produced by prepare_tomo, masks and converts units.
+        metadata: dictionary from read_metadata or prepare_tomo (only pxsize is used, and stitched_COR if sinograms were converted from 360 degrees)
+        stats: ALS_recon_functions.ReconStats to add reconstructed values to (eg. for color limits). None means don't collect stats
+        dtype: dtype of returned recon. None means float32
+        Other parameters same as reconstruct.
+    """
+    if not proj_downsample: proj_downsample = 1
+    if 'stitched_COR' in metadata: # 360 degree data converted to 180, COR is no longer the scan's COR
+        COR = metadata['stitched_COR']
+    with trace.stage("recon", method=method or "default"):
+        recon = _run_recon_method(tomo, angles, COR, method, proj_downsample, fc, use_gpu)
+
+    with trace.stage("finish_recon"): # mask and convert units in one pass
+        recon = als.finish_recon(recon, metadata['pxsize'], mask=mask, stats=stats, dtype=dtype)
+    return recon
 
+def _run_recon_method(tomo, angles, COR, method, proj_downsample, fc, use_gpu):
+    # picks reconstruction backend for reconstruct_tomo
     if method == "fbp":
         recon = als.astra_fbp_recon(tomo, angles, COR=COR/proj_downsample, fc=fc, gpu=use_gpu)
     elif method == "cgls":
         recon = als.astra_cgls_recon(tomo, angles, COR=COR/proj_downsample, num_iter=20, gpu=use_gpu)
     elif method == "gridrec":
         recon = als.tomopy_gridrec_recon(tomo, angles, COR=COR/proj_downsample, fc=fc)
+    elif method == "fbp_numpy":
+        recon = als.numpy_fbp_recon(tomo, angles, COR=COR/proj_downsample, fc=fc)
     else: # no method chosen, use default depending on 
-        if use_gpu: # have GPU
+        if als.astra_spec is None: # Astra not installed, use FBP that doesn't need it
+            recon = als.numpy_fbp_recon(tomo, angles, COR=COR/proj_downsample, fc=fc)
+        elif use_gpu: # have GPU
             recon = als.astra_fbp_recon(tomo, angles, COR=COR/proj_downsample, fc=fc, gpu=use_gpu)
             # recon = als.astra_cgls_recon(tomo, angles, COR=COR/proj_downsample, num_iter=20, gpu=use_gpu)
         else:
@@ -63,15 +135,106 @@ def reconstruct(path, angles_ind, slices_ind, COR,
                 recon = als.astra_fbp_recon(tomo, angles, COR=COR/proj_downsample, fc=fc, gpu=use_gpu)
             else: # on Cori CPU node or not NERSC -- assume slow so use gridrec
                 recon = als.tomopy_gridrec_recon(tomo, angles, COR=COR/proj_downsample, fc=fc)
+    return recon
 
-    if mask: # by default, mask recon ROI
-        recon = als.mask_recon(recon)
-    
-    recon /= metadata['pxsize']  # convert reconstructed voxel values from 1/pixel to 1/cm
-    if metadata['pxsize'] < 1e-6: # if less than 10 nm resolution
-        recon *= 1000 # Dula's request
-    
-    return recon, tomo
+class StageCache:
+    """ Least-recently-used cache of numpy arrays (or tuples of arrays), with a cap on total memory.
+        max_bytes: total memory allowed. Least recently used entries are dropped once this is exceeded
+    """
+
+    def __init__(self, max_bytes=2*1024**3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict() # key -> (value, nbytes), oldest first
+
+    def get(self, key):
+        """ Returns cached value (and marks it as most recently used), or None if not cached """
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, value):
+        """ Adds value to cache, evicting least recently used entries if needed. Values larger than max_bytes are not cached """
+        nbytes = sum(v.nbytes for v in (value if isinstance(value, tuple) else (value,)) if isinstance(v, np.ndarray))
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+def _freeze(obj):
+    """ Converts settings (dictionaries, slices, lists) into something hashable, for use in cache keys """
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(v) for v in obj)
+    if isinstance(obj, slice):
+        return ('slice', obj.start, obj.stop, obj.step)
+    return obj
+
+class ReconSession:
+    """ Same as reconstruct, but caches the output of every stage keyed by the parameters that stage depends on. Used by the interactive parameter selection cell.
+        eg. changing only fc or COR reuses the processed sinogram, changing only ring removal parameters reuses the normalized projections.
+        path: full path to .h5 file
+        max_cache_GB: memory cap for cached stage outputs (least recently used outputs are dropped first)
+    """
+
+    def __init__(self, path, max_cache_GB=2):
+        self.path = path
+        self.cache = StageCache(max_bytes=int(max_cache_GB*1024**3))
+        self.last_reused = [] # names of stages reused by the most recent call to reconstruct
+
+    def reconstruct(self, angles_ind, slices_ind, COR,
+                    method=None,
+                    proj_downsample=1, fc=1,
+                    preprocessing_settings={'minimum_transmission':0.01}, postprocessing_settings=None,
+                    mask=True, convert360to180=True,
+                    use_gpu=False):
+        """ Same parameters and returns as reconstruct """
+        metadata = als.read_metadata(self.path, print_flag=False)
+
+        # Each stage: (name, parameters it depends on, function of previous stage output). Stages modify data in place, so they get copies of cached data
+        stages = [('normalized', (self.path, als_io.open_dataset(self.path).mtime, _freeze(angles_ind), _freeze(slices_ind)),
+                   lambda _: als.read_normalized(self.path, proj=angles_ind, sino=slices_ind)),
+                  ('prelog', _freeze(preprocessing_settings),
+                   lambda x: (als.prelog_process_tomo(x[0].copy(), preprocessing_settings) if preprocessing_settings else x[0], x[1])),
+                  ('postlog', (proj_downsample, _freeze(postprocessing_settings)),
+                   lambda x: (als.log_and_postprocess_tomo(x[0].copy(), proj_downsample, postprocessing_settings), x[1]))]
+        if metadata['angularrange'] > 300 and convert360to180: # only 360 degree conversion depends on COR
+            metadata['stitched_COR'] = stitched_360_COR(-(-metadata['numrays']//(proj_downsample or 1)), COR, proj_downsample)
+            stages.append(('360to180', (COR,),
+                           lambda x: convert_tomo_360_to_180(x[0], x[1], COR, proj_downsample)))
+        stages.append(('recon', (method, COR, fc, mask, use_gpu),
+                       lambda x: (reconstruct_tomo(x[0], x[1], COR, metadata,
+                                                   method=method, proj_downsample=proj_downsample, fc=fc,
+                                                   mask=mask, use_gpu=use_gpu), x[0])))
+
+        # key of each stage includes the keys of every stage before it
+        keys = []
+        for name, params, _ in stages:
+            keys.append((keys[-1] if keys else ()) + (name, params))
+        # start from the last stage that is still cached
+        start, value = 0, None
+        for i in range(len(stages)-1, -1, -1):
+            value = self.cache.get(keys[i])
+            if value is not None:
+                start = i+1
+                break
+        self.last_reused = [name for name, _, _ in stages[:start]]
+        for i in range(start, len(stages)):
+            value = stages[i][2](value)
+            self.cache.put(keys[i], value)
+        recon, tomo = value
+        return recon, tomo
 
 def show_slice_reconstruction(path, slice_num,
                               proj_downsample, angles_downsample,
@@ -84,7 +247,8 @@ def show_slice_reconstruction(path, slice_num,
                               use_gpu,
                               img_handle,
                               sino_handle,
-                              hline_handle):
+                              hline_handle,
+                              session=None):
     """ Wrapper for reconstruction_parameter_options to update the 2D reconstruction in main parameter selection cell (ie. what's run when you press the green "Reconstruct" button).
         Interfaces with reconstruction_parameter_options -- if you want to add another parameter option here, you need to create a widget for it there too.
     
@@ -96,6 +260,7 @@ def show_slice_reconstruction(path, slice_num,
         sino_handle: matplotlib image handle for associated sinogram - only if you want to update a sinogram image every time you change the recon slice. Not currently used.
         hline_handle: matplotlib horizontal line handle - only if you want to update a line on a projection image every time you change the recon slice. Not currently used.
         use_gpu: whether to use Astra GPU or CPU implementation
+        session: ReconSession for path. If given, stages whose parameters haven't changed since the last press are reused instead of recomputed
         
         * For the selectable parameters, see descriptions in ALS_recon.ipynb *        
     """
@@ -112,17 +277,24 @@ def show_slice_reconstruction(path, slice_num,
     postprocessing_settings = {"ringSigma": ringSigma,
                           "ringLevel": ringLevel
                          }
-    recon, tomo = reconstruct(path=path,
-                              angles_ind=angles_ind, slices_ind=slices_ind,
-                              COR=COR,
-                              proj_downsample=proj_downsample, fc=fc,
-                              preprocessing_settings=preprocessing_settings, postprocessing_settings=postprocessing_settings,
-                              use_gpu=use_gpu)
+    if session is not None:
+        recon, tomo = session.reconstruct(angles_ind=angles_ind, slices_ind=slices_ind,
+                                          COR=COR,
+                                          proj_downsample=proj_downsample, fc=fc,
+                                          preprocessing_settings=preprocessing_settings, postprocessing_settings=postprocessing_settings,
+                                          use_gpu=use_gpu)
+    else:
+        recon, tomo = reconstruct(path=path,
+                                  angles_ind=angles_ind, slices_ind=slices_ind,
+                                  COR=COR,
+                                  proj_downsample=proj_downsample, fc=fc,
+                                  preprocessing_settings=preprocessing_settings, postprocessing_settings=postprocessing_settings,
+                                  use_gpu=use_gpu)
     img_handle.set_data(recon.squeeze())
     if sino_handle: sino_handle.set_data(tomo.squeeze())
     if hline_handle: hline_handle.set_ydata([slice_num,slice_num])
 
-def reconstruction_parameter_options(path,cor_init,use_gpu,img_handle,sino_handle,hline_handle):
+def reconstruction_parameter_options(path,cor_init,use_gpu,img_handle,sino_handle,hline_handle,max_cache_GB=2):
     """ Creates widgets for every parameter required by show_slice_reconstruction, then puts into Tabs widgets creates Reconstruction button functionality
         path: full path to .h5 file
         cor_init: initial COR to use
@@ -130,9 +302,11 @@ def reconstruction_parameter_options(path,cor_init,use_gpu,img_handle,sino_handl
         img_handle: matplotlib image handle for reconstruction
         sino_handle: matplotlib image handle for associated sinogram - only if you want to update a sinogram image every time you change the recon slice. Not currently used.
         hline_handle: matplotlib horizontal line handle - only if you want to update a line on a projection image every time you change the recon slice. Not currently used.
+        max_cache_GB: memory cap for intermediate results kept between presses of the Reconstruct button (see ReconSession)
     """
     
     metadata = als.read_metadata(path, print_flag=False)
+    session = ReconSession(path, max_cache_GB=max_cache_GB)
     #################################################### Common Parameters Tab ####################################################    
     parameter_widgets = {}
     # Angle downsample    
@@ -305,9 +479,11 @@ def reconstruction_parameter_options(path,cor_init,use_gpu,img_handle,sino_handl
                             use_gpu=use_gpu,
                             img_handle=img_handle,
                             sino_handle=sino_handle,
-                            hline_handle=hline_handle
+                            hline_handle=hline_handle,
+                            session=session
                             )
-            reconstruct_status.value = f"Finished: took {time.time()-tic:.1f} sec"
+            reused = f" (reused {', '.join(session.last_reused)})" if session.last_reused else ""
+            reconstruct_status.value = f"Finished: took {time.time()-tic:.1f} sec{reused}"
     reconstruct_button.on_click(reconstruct_callback)   
 
     # Create tab widget and populate
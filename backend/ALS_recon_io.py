@@ -0,0 +1,539 @@
+"""
+ALS_recon_io.py
+Functions and classes for reading raw ALS data and writing reconstructions
+Reading: keeps .h5 files open between calls so interactive widgets and batch chunks don't re-open and re-read the same file every time
+Writing: volume writers used by batch jobs (tiff stack, or a single chunked/compressed hdf5 or zarr volume), optionally with downsampled pyramid levels
+"""
+
+import os
+import threading
+import queue
+import importlib.util
+from contextlib import contextmanager, nullcontext
+import numpy as np
+import h5py
+import dxchange
+import ALS_recon_trace as trace
+try:
+    import fcntl # for file locks when several processes write the same volume. Not available on Windows (but neither is MPI there)
+except ImportError:
+    fcntl = None
+# optional packages for compressed/zarr output. Only needed if you choose those writers
+hdf5plugin_spec = importlib.util.find_spec("hdf5plugin")
+if hdf5plugin_spec is not None:
+    import hdf5plugin
+zarr_spec = importlib.util.find_spec("zarr")
+if zarr_spec is not None:
+    import zarr
+    import numcodecs
+
+# where read_metadata values live in the APS tomoscan hdf5 format: (hdf5 key, index into dataset)
+METADATA_KEYS = {
+    'numslices': ("/measurement/instrument/detector/dimension_y", 0),
+    'numrays': ("/measurement/instrument/detector/dimension_x", 0),
+    'pxsize': ("/measurement/instrument/detector/pixel_size", 0),
+    'numangles': ("/process/acquisition/rotation/num_angles", 0),
+    'propagation_dist': ("/measurement/instrument/camera_motor_stack/setup/camera_distance", 1),
+    'kev': ("/measurement/instrument/monochromator/energy", 0),
+    'angularrange': ("/process/acquisition/rotation/range", 0),
+}
+
+_open_datasets = {} # realpath -> ALSDataset
+_open_datasets_lock = threading.Lock()
+
+def open_dataset(path):
+    """ Returns an ALSDataset for path. Reuses the already open handle (and its cached flat/dark fields) unless the file has been modified since it was opened.
+        path: full path to .h5 file
+    """
+    key = os.path.realpath(path)
+    mtime = os.stat(key).st_mtime_ns
+    with _open_datasets_lock:
+        dataset = _open_datasets.get(key)
+        # reopen if file changed, or if we are in a forked process (h5py handles can't be shared across processes)
+        if dataset is not None and (dataset.mtime != mtime or dataset.pid != os.getpid()):
+            if dataset.pid == os.getpid(): dataset.close()
+            dataset = None
+        if dataset is None:
+            dataset = ALSDataset(key, mtime)
+            _open_datasets[key] = dataset
+    return dataset
+
+def close_datasets():
+    """ Closes all open dataset handles (eg. before moving or deleting files) """
+    with _open_datasets_lock:
+        for dataset in _open_datasets.values():
+            dataset.close()
+        _open_datasets.clear()
+
+def as_slice(s):
+    """ Converts None, (first,last,step) tuple or slice into a slice """
+    if s is None:
+        return slice(None)
+    if isinstance(s, slice):
+        return s
+    return slice(*s)
+
+class ALSDataset:
+    """ Handle to an APS tomoscan format .h5 file. Opened once, with metadata read in one pass.
+        Flat and dark fields are averaged over their frames the first time each slice is needed, then kept in memory.
+        Use open_dataset(path) rather than creating directly, so handles are shared.
+    """
+
+    def __init__(self, path, mtime=None):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns if mtime is None else mtime
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self.file = h5py.File(path, 'r')
+        self.metadata = self._read_metadata()
+        self.data_shape = self.file['/exchange/data'].shape # (angles, slices, rays)
+        self._angles = None
+        # averaged flat/dark for every slice, filled in lazily (see get_flat_dark)
+        self._flat = None
+        self._dark = None
+        self._reduced_rows = np.zeros(self.data_shape[1], dtype=bool)
+
+    def _read_metadata(self):
+        metadata = {}
+        for name, (key, index) in METADATA_KEYS.items():
+            metadata[name] = np.atleast_1d(self.file[key][()])[index]
+        metadata['numslices'] = int(metadata['numslices'])
+        metadata['numrays'] = int(metadata['numrays'])
+        metadata['numangles'] = int(metadata['numangles'])
+        metadata['pxsize'] = metadata['pxsize'] / 10.0 # /10 to convert units from mm to cm
+        metadata['kev'] = metadata['kev'] / 1000
+        return metadata
+
+    @property
+    def angles(self):
+        """ All projection angles, in radians """
+        if self._angles is None:
+            if '/exchange/theta' in self.file:
+                theta = self.file['/exchange/theta'][()]
+            else: # same fallback as dxchange
+                theta = np.linspace(0., 180., self.data_shape[0])
+            self._angles = theta * np.pi / 180.
+        return self._angles
+
+    def read_projections(self, proj=None, sino=None, dtype=np.float32):
+        """ Reads raw (not normalized) projections. Returns 3D numpy array (angles,slices,rays)
+            proj: which projections to read (first,last,step). None means all projections.
+            sino: which slices to read (first,last,step). None means all slices.
+        """
+        with self._lock:
+            tomo = self.file['/exchange/data'][as_slice(proj), as_slice(sino), :]
+        return tomo.astype(dtype, copy=False)
+
+    def get_flat_dark(self, sino=None):
+        """ Returns flat and dark fields averaged over all frames, each with shape (1,slices,rays) float32 (ready for tomopy.normalize)
+            sino: which slices to return (first,last,step). None means all slices.
+        """
+        rows = np.arange(self.data_shape[1])[as_slice(sino)]
+        with self._lock:
+            if self._flat is None:
+                self._flat = np.zeros(self.data_shape[1:], dtype=np.float32)
+                self._dark = np.zeros(self.data_shape[1:], dtype=np.float32)
+            missing = rows[~self._reduced_rows[rows]]
+            if missing.size:
+                # read one contiguous block covering every missing row (much faster than row by row on CFS)
+                lo, hi = missing.min(), missing.max()+1
+                for key, reduced in [('/exchange/data_white', self._flat), ('/exchange/data_dark', self._dark)]:
+                    frames = self.file[key][:, lo:hi, :].astype(np.float32, copy=False)
+                    reduced[lo:hi] = np.mean(frames, axis=0, dtype=np.float32)
+                self._reduced_rows[lo:hi] = True
+            flat = self._flat[rows][np.newaxis]
+            dark = self._dark[rows][np.newaxis]
+        return flat, dark
+
+    def close(self):
+        try:
+            self.file.close()
+        except Exception: # already closed, or closing a handle inherited from parent process
+            pass
+
+
+######### The functions below write reconstructions #########
+
+VOLUME_WRITERS = ["tiff", "hdf5", "zarr"]
+BLOSC_COMPRESSORS = ["lz4", "zstd", "blosclz"]
+MAX_STORAGE_CHUNK_BYTES = 256*1024**2 # hdf5 can't have chunks over 4 GB, and large chunks are slow to read back a few slices from
+
+def storage_chunk_slices(chunk_slices, num_slices, slice_shape):
+    """ Number of slices per hdf5/zarr storage chunk: chunk_slices, or its largest divisor that keeps chunks under MAX_STORAGE_CHUNK_BYTES (so batch chunks still start on a storage chunk boundary) """
+    chunk_slices = int(max(1, min(chunk_slices, num_slices)))
+    slice_bytes = 4*int(np.prod(slice_shape))
+    if chunk_slices*slice_bytes <= MAX_STORAGE_CHUNK_BYTES:
+        return chunk_slices
+    divisors = [d for d in range(1, chunk_slices+1) if chunk_slices % d == 0 and d*slice_bytes <= MAX_STORAGE_CHUNK_BYTES]
+    return max(divisors) if divisors else 1
+
+def get_volume_writer(writer, save_dir, name, num_slices, start_slice=0, chunk_slices=50, compression=None, shared=False, lock_dir=None):
+    """ Creates writer for batch reconstruction output.
+        writer: "tiff" (one file per slice, the original format), "hdf5" (single name.h5 file) or "zarr" (single name.zarr directory)
+        save_dir: directory to save into
+        name: base file name (usually the dataset name)
+        num_slices: total number of slices in the volume (hdf5/zarr only)
+        start_slice: slice number of first slice in volume. Stored as an attribute so volume index 0 can be mapped back to the raw data (hdf5/zarr only)
+        chunk_slices: number of slices per hdf5/zarr chunk. Use the batch chunk size so each chunk write touches its own storage chunks (reduced to a divisor of it if chunks would be too big, see storage_chunk_slices)
+        compression: None, "lz4"/"zstd"/"blosclz" (Blosc, fast), "gzip" or "lzf" (hdf5 only). All lossless
+        shared: True if several processes (eg. MPI ranks) write disjoint slabs of the same volume
+        lock_dir: directory for the file lock of shared writes (hdf5/zarr only), eg. the job's hidden bookkeeping directory, so no lock file is left among the output. None means next to the volume
+    """
+    assert writer in VOLUME_WRITERS, f"writer must be one of {VOLUME_WRITERS}, but got: {writer}"
+    if writer == "tiff":
+        return TiffStackWriter(os.path.join(save_dir, name))
+    if writer == "hdf5":
+        return HDF5VolumeWriter(os.path.join(save_dir, name+".h5"), num_slices, start_slice=start_slice,
+                                chunk_slices=chunk_slices, compression=compression, shared=shared, lock_dir=lock_dir)
+    return ZarrVolumeWriter(os.path.join(save_dir, name+".zarr"), num_slices, start_slice=start_slice,
+                            chunk_slices=chunk_slices, compression=compression, shared=shared, lock_dir=lock_dir)
+
+@contextmanager
+def file_lock(lock_path):
+    """ Exclusive lock between processes, held for the duration of the with block. Does nothing if file locks aren't available """
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, 'a') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+def get_lock_path(path, lock_dir=None):
+    """ Lock file (see file_lock) for shared writes to the volume at path: in lock_dir (created if needed), or next to the volume if lock_dir is None """
+    if lock_dir is None:
+        return path+".lock"
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, os.path.basename(path)+".lock")
+
+class TiffStackWriter:
+    """ Writes every slice as its own tiff (same dtype as data) with dxchange.write_tiff_stack (name_00000.tiff, name_00001.tiff, ...).
+        Downsampled levels (see PyramidWriter) go in subdirectories (name_2x/name_2x_00000.tiff, ...)
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def write(self, data, start):
+        """ Writes stack of slices data, starting at slice number start """
+        with trace.stage("write_tiff", bytes_written=data.nbytes):
+            dxchange.write_tiff_stack(data, fname=self.fname, start=start, overwrite=True) # overwrite so a resumed job replaces partly written chunks (instead of adding name-1 files)
+
+    def write_level(self, factor, data, index):
+        """ Writes stack of slices of the factor x downsampled volume, starting at index in that volume """
+        directory, name = os.path.split(self.fname)
+        with trace.stage("write_tiff", bytes_written=data.nbytes, factor=factor):
+            dxchange.write_tiff_stack(data, fname=os.path.join(directory, f"{name}_{factor}x", f"{name}_{factor}x"), start=index, overwrite=True) # (see write)
+
+    def write_multiscales_metadata(self, factors):
+        pass
+
+    def _slice_filename(self, index):
+        # same naming as dxchange.write_tiff_stack
+        body, ext = os.path.splitext(os.path.abspath(self.fname))
+        fname = f"{body}_{index:05d}{ext}"
+        return fname if fname.endswith('.tiff') else fname+'.tiff'
+
+    def has_slices(self, start, stop):
+        """ Whether slices start to stop (not inclusive) have been written """
+        return all(os.path.isfile(f) and os.path.getsize(f) > 0 for f in map(self._slice_filename, range(start, stop)))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class HDF5VolumeWriter:
+    """ Writes all slices into one chunked (optionally compressed) dataset in a single .h5 file. Dataset is created on the first write, when slice dimensions are known.
+        If shared, each write takes a file lock and opens/closes the file, so several processes can write disjoint slabs without parallel hdf5.
+        Otherwise the file is kept open until close().
+        See get_volume_writer for parameters
+    """
+    dataset_name = "recon"
+    trace_name = "write_hdf5"
+
+    def __init__(self, filename, num_slices, start_slice=0, chunk_slices=50, compression=None, shared=False, lock_dir=None):
+        self.filename = filename
+        self.lock_path = get_lock_path(filename, lock_dir)
+        self.num_slices = num_slices
+        self.start_slice = start_slice
+        self.chunk_slices = int(max(1, min(chunk_slices, num_slices)))
+        self.compression_kwargs = self._get_compression_kwargs(compression)
+        self.shared = shared
+        self.file = None
+
+    @staticmethod
+    def _get_compression_kwargs(compression):
+        if compression is None:
+            return {}
+        if compression in ["gzip", "lzf"]: # built into hdf5
+            return {'compression': compression}
+        assert compression in BLOSC_COMPRESSORS, f"compression must be None, gzip, lzf or one of {BLOSC_COMPRESSORS}, but got: {compression}"
+        if hdf5plugin_spec is None:
+            print(f"hdf5plugin not installed, can't use {compression} compression. Using lzf instead")
+            return {'compression': "lzf"}
+        return dict(hdf5plugin.Blosc(cname=compression, clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+
+    def _write(self, name, data, z0, num_slices, chunk_slices, attrs):
+        # creates dataset on first write, then writes data at index z0
+        def write_to(f):
+            chunks = (storage_chunk_slices(chunk_slices, num_slices, data.shape[1:]),)+data.shape[1:]
+            dset = f.require_dataset(name, shape=(num_slices,)+data.shape[1:], dtype=data.dtype,
+                                     chunks=chunks, exact=False, **self.compression_kwargs)
+            for key, value in attrs.items():
+                dset.attrs[key] = value
+            dset[z0:z0+data.shape[0]] = data
+        if self.shared:
+            with file_lock(self.lock_path):
+                with h5py.File(self.filename, 'a') as f:
+                    write_to(f)
+        else:
+            if self.file is None:
+                self.file = h5py.File(self.filename, 'a')
+            write_to(self.file)
+
+    def write(self, data, start):
+        """ Writes stack of slices data, starting at slice number start (ie. raw data slice number, not volume index) """
+        with trace.stage(self.trace_name, bytes_written=data.nbytes):
+            self._write(self.dataset_name, data, start - self.start_slice, self.num_slices, self.chunk_slices,
+                        {'start_slice': self.start_slice})
+
+    def write_level(self, factor, data, index):
+        """ Writes stack of slices of the factor x downsampled volume (dataset recon_{factor}x), starting at index in that volume """
+        with trace.stage(self.trace_name, bytes_written=data.nbytes, factor=factor):
+            self._write(f"{self.dataset_name}_{factor}x", data, index, -(-self.num_slices//factor), self.chunk_slices//factor,
+                        {'start_slice': self.start_slice, 'downsample_factor': factor})
+
+    def write_multiscales_metadata(self, factors):
+        """ Lists the pyramid levels as file attributes, finest first """
+        def write_to(f):
+            f.attrs['multiscales'] = [self.dataset_name] + [f"{self.dataset_name}_{factor}x" for factor in factors]
+            f.attrs['multiscales_factors'] = [1] + list(factors)
+        if self.shared:
+            with file_lock(self.lock_path):
+                with h5py.File(self.filename, 'a') as f:
+                    write_to(f)
+        else:
+            if self.file is None:
+                self.file = h5py.File(self.filename, 'a')
+            write_to(self.file)
+
+    def has_slices(self, start, stop):
+        """ Whether slices start to stop (not inclusive) have been written. Checks the file can be read and the first and last slices aren't empty (unwritten chunks read as zeros) """
+        if not os.path.exists(self.filename):
+            return False
+        try:
+            with file_lock(self.lock_path) if self.shared else nullcontext():
+                with h5py.File(self.filename, 'r') as f:
+                    dset = f[self.dataset_name]
+                    z0, z1 = start - self.start_slice, stop - self.start_slice
+                    return dset.shape[0] >= z1 and bool(np.any(dset[z0])) and bool(np.any(dset[z1-1]))
+        except Exception: # missing dataset, or file left corrupt by a killed job
+            return False
+
+    def flush(self):
+        """ Makes sure everything written so far is on disk (so it survives if the job is killed) """
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class ZarrVolumeWriter:
+    """ Writes all slices into one chunked (optionally Blosc compressed) zarr array. Each zarr chunk is its own file, so slabs aligned with chunk_slices can be written by several processes without locking; other writes take a file lock.
+        Downsampled levels (see PyramidWriter) are stored next to it with OME-Zarr style multiscales metadata, so viewers can open a low resolution level first.
+        Requires zarr. See get_volume_writer for parameters
+    """
+    dataset_name = "recon"
+    trace_name = "write_zarr"
+
+    def __init__(self, path, num_slices, start_slice=0, chunk_slices=50, compression=None, shared=False, lock_dir=None):
+        assert zarr_spec is not None, "zarr must be installed to use zarr writer"
+        if compression is not None:
+            assert compression in BLOSC_COMPRESSORS, f"zarr compression must be None or one of {BLOSC_COMPRESSORS}, but got: {compression}"
+        self.path = path
+        self.lock_path = get_lock_path(path, lock_dir)
+        self.num_slices = num_slices
+        self.start_slice = start_slice
+        self.chunk_slices = int(max(1, min(chunk_slices, num_slices)))
+        self.compression = compression
+        self.shared = shared
+        self.arrays = {}
+
+    def _open_group(self):
+        if int(zarr.__version__.split('.')[0]) >= 3:
+            return zarr.open_group(self.path, mode='a', zarr_format=2) # v2 format for compatibility with older readers (and OME-Zarr 0.4)
+        return zarr.open_group(self.path, mode='a')
+
+    def _require_array(self, name, shape, chunks, dtype, attrs):
+        group = self._open_group()
+        if name in group:
+            return group[name]
+        compressor = numcodecs.Blosc(cname=self.compression, clevel=5, shuffle=numcodecs.Blosc.SHUFFLE) if self.compression else None
+        if int(zarr.__version__.split('.')[0]) >= 3:
+            array = group.create_array(name, shape=shape, chunks=chunks, dtype=dtype, compressors=compressor)
+        else:
+            array = group.create_dataset(name, shape=shape, chunks=chunks, dtype=dtype, compressor=compressor)
+        for key, value in attrs.items():
+            array.attrs[key] = value
+        return array
+
+    def _write(self, name, data, z0, num_slices, chunk_slices, attrs):
+        z1 = z0 + data.shape[0]
+        chunk_slices = storage_chunk_slices(chunk_slices, num_slices, data.shape[1:])
+        if name not in self.arrays:
+            args = (name, (num_slices,)+data.shape[1:], (chunk_slices,)+data.shape[1:], data.dtype, attrs)
+            if self.shared: # only one process should create the array
+                with file_lock(self.lock_path):
+                    self.arrays[name] = self._require_array(*args)
+            else:
+                self.arrays[name] = self._require_array(*args)
+        aligned = z0 % chunk_slices == 0 and (z1 % chunk_slices == 0 or z1 == num_slices)
+        if self.shared and not aligned: # slab shares a zarr chunk with another process's slab
+            with file_lock(self.lock_path):
+                self.arrays[name][z0:z1] = data
+        else:
+            self.arrays[name][z0:z1] = data
+
+    def write(self, data, start):
+        """ Writes stack of slices data, starting at slice number start (ie. raw data slice number, not volume index) """
+        with trace.stage(self.trace_name, bytes_written=data.nbytes):
+            self._write(self.dataset_name, data, start - self.start_slice, self.num_slices, self.chunk_slices,
+                        {'start_slice': self.start_slice})
+
+    def write_level(self, factor, data, index):
+        """ Writes stack of slices of the factor x downsampled volume (array recon_{factor}x), starting at index in that volume """
+        with trace.stage(self.trace_name, bytes_written=data.nbytes, factor=factor):
+            self._write(f"{self.dataset_name}_{factor}x", data, index, -(-self.num_slices//factor), self.chunk_slices//factor,
+                        {'start_slice': self.start_slice, 'downsample_factor': factor})
+
+    def write_multiscales_metadata(self, factors):
+        """ Writes OME-Zarr (v0.4) multiscales metadata listing the full resolution volume and each downsampled level """
+        datasets = [{'path': self.dataset_name if factor == 1 else f"{self.dataset_name}_{factor}x",
+                     'coordinateTransformations': [{'type': 'scale', 'scale': [float(factor)]*3}]}
+                    for factor in [1] + list(factors)]
+        self._open_group().attrs['multiscales'] = [{'version': '0.4',
+                                                    'name': os.path.splitext(os.path.basename(self.path))[0],
+                                                    'axes': [{'name': axis, 'type': 'space'} for axis in 'zyx'],
+                                                    'datasets': datasets,
+                                                    'type': 'mean'}]
+
+    def has_slices(self, start, stop):
+        """ Whether slices start to stop (not inclusive) have been written. Checks the first and last slices aren't empty (unwritten chunks read as zeros) """
+        if not os.path.exists(self.path):
+            return False
+        try:
+            array = self._open_group()[self.dataset_name]
+            z0, z1 = start - self.start_slice, stop - self.start_slice
+            return array.shape[0] >= z1 and bool(np.any(array[z0])) and bool(np.any(array[z1-1]))
+        except Exception:
+            return False
+
+    def flush(self):
+        pass # every chunk write goes straight to its own file
+
+    def close(self):
+        self.arrays = {}
+
+class PyramidWriter:
+    """ Wraps a volume writer so every chunk is also written as 2x, 4x, 8x, ... downsampled levels (averaging in z, y and x).
+        Levels are built from each chunk while it's still in memory, so no second pass over the written volume is needed.
+        Chunks can arrive in any order: downsampled slices that straddle two chunks are held (as partial sums) until both have arrived.
+        writer: volume writer to wrap
+        factors: list of downsampling factors
+        num_slices: total number of slices in the full resolution volume
+        start_slice: slice number of first slice in volume
+    """
+
+    def __init__(self, writer, factors=(2,4,8), num_slices=None, start_slice=0):
+        self.writer = writer
+        self.factors = sorted(int(f) for f in factors)
+        self.num_slices = num_slices
+        self.start_slice = start_slice
+        self.pending = {factor: {} for factor in self.factors} # factor -> {level index: [partial sum, number of slices added]}
+
+    def write(self, data, start):
+        import ALS_recon_functions as als # imported here to avoid circular import (ALS_recon_functions imports this module)
+        self.writer.write(data, start)
+        z0 = start - self.start_slice
+        z1 = z0 + data.shape[0]
+        for factor in self.factors:
+            binned = als.bin_projections(data, factor, edge_mean=True) # bin each slice in y and x
+            complete = {} # level index -> downsampled slice
+            for k in range(z0//factor, (z1-1)//factor + 1):
+                lo, hi = max(z0, k*factor), min(z1, (k+1)*factor)
+                expected = min((k+1)*factor, self.num_slices) - k*factor # last level slice may average fewer slices
+                partial = np.sum(binned[lo-z0:hi-z0], axis=0, dtype=np.float32)
+                count = hi - lo
+                if k in self.pending[factor]: # rest of this level slice came from another chunk
+                    partial += self.pending[factor][k][0]
+                    count += self.pending[factor].pop(k)[1]
+                if count == expected:
+                    complete[k] = (partial / expected).astype(data.dtype, copy=False) # levels saved in same dtype as full resolution
+                else:
+                    self.pending[factor][k] = [partial, count]
+            # write runs of consecutive complete level slices together
+            indices = sorted(complete)
+            while indices:
+                run = [indices.pop(0)]
+                while indices and indices[0] == run[-1]+1:
+                    run.append(indices.pop(0))
+                self.writer.write_level(factor, np.stack([complete[k] for k in run]), run[0])
+
+    def has_slices(self, start, stop):
+        return self.writer.has_slices(start, stop)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        unfinished = sum(len(p) for p in self.pending.values())
+        if unfinished:
+            print(f"Warning: {unfinished} downsampled slices were incomplete (not every chunk was written), they were not saved")
+        self.writer.write_multiscales_metadata(self.factors)
+        self.writer.close()
+
+class BackgroundWriter:
+    """ Wraps a volume writer so writes happen in a background thread, and reconstruction can continue while the previous chunk is saved.
+        writer: any of the volume writers above
+        queue_depth: max number of chunks waiting to be written (write() blocks when full, bounding memory use)
+    """
+
+    def __init__(self, writer, queue_depth=2):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None: # after an error, keep draining queue so write() doesn't block forever
+                try:
+                    self.writer.write(*item)
+                except BaseException as e:
+                    self.error = e
+
+    def write(self, data, start):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((data, start))
+
+    def has_slices(self, start, stop):
+        return self.writer.has_slices(start, stop)
+
+    def close(self):
+        """ Waits for queued writes to finish, then closes writer. Raises any error from the background thread """
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,105 @@
+"""
+ALS_recon_resources.py
+CPU cores and thread counts of this process, in one place. Every stage that runs threads (tomopy's ncore, numexpr, OpenMP inside Astra and SVMBIR, and the thread pools in ALS_recon_functions)
+uses get_num_threads, instead of each library picking its own default (usually every core of the node, which oversubscribes the cores as soon as several batch workers or MPI ranks share a node).
+The budget is the cores this process may run on, unless configure sets it: batch worker processes (ALS_batch_pipeline.run_chunk_workers) and MPI ranks get their own block of cores.
+Import this before tomopy or numexpr (ALS_recon_functions does), since some libraries only read their thread settings when they're first imported
+"""
+
+import os
+import sys
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'NUMEXPR_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TOMOPY_PYTHON_THREADS'] # read by the libraries when they start
+NUM_THREADS_ENV = 'ALS832_NUM_THREADS' # budget handed to child processes
+
+os.environ.setdefault('NUMEXPR_MAX_THREADS', str(os.cpu_count())) # to avoid numexpr warning (and its cap of 64 threads) on big nodes
+
+_num_threads = None # set by configure
+
+def get_available_cores():
+    """ CPU cores this process is allowed to run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def get_num_threads():
+    """ Number of threads each stage of this process should use: as set by configure, or inherited from the process that started this one, otherwise one per available core """
+    if _num_threads is not None:
+        return _num_threads
+    if os.environ.get(NUM_THREADS_ENV):
+        return int(os.environ[NUM_THREADS_ENV])
+    return len(get_available_cores())
+
+def run_blocks(fn, blocks, num_threads=None):
+    """ Calls fn on each of blocks (eg. (start, stop) ranges of a volume) in a pool of num_threads threads, and returns the results in the order of blocks.
+        Only runs in parallel if fn releases the GIL for most of its time (numpy arithmetic and reductions, scipy.fft and scipy.ndimage do)
+        num_threads: None means get_num_threads(). With 1 thread (or 1 block) they run in this thread, without a pool
+    """
+    blocks = list(blocks)
+    if num_threads is None:
+        num_threads = get_num_threads()
+    if num_threads <= 1 or len(blocks) <= 1:
+        return [fn(block) for block in blocks]
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(fn, blocks))
+
+def get_thread_env(num_threads):
+    """ Environment variables that set the thread count of every library to num_threads. Needed for processes that haven't started yet (see ALS_batch_pipeline.run_chunk_workers) """
+    env = {var: str(num_threads) for var in THREAD_ENV_VARS}
+    env[NUM_THREADS_ENV] = str(num_threads)
+    return env
+
+def configure(num_threads=None, cores=None, verbose=False):
+    """ Sets the resources of this process: pins it to cores and sets every library's thread count to num_threads. Returns num_threads
+        num_threads: threads per stage. None means one per core
+        cores: list of CPU cores to run on. None means keep the current ones
+        verbose: print the resulting budget
+    """
+    global _num_threads
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [int(c) for c in cores])
+    available = get_available_cores()
+    _num_threads = int(num_threads) if num_threads else len(available)
+    os.environ.update(get_thread_env(_num_threads))
+    if 'numexpr' in sys.modules: # already running (eg. imported by tomopy), so its environment variable won't be read again
+        sys.modules['numexpr'].set_num_threads(_num_threads)
+    if verbose:
+        print(f"Using {_num_threads} threads on {len(available)} cores ({available[0]}-{available[-1]})")
+    return _num_threads
+
+def get_node_cores(index, count):
+    """ Block of this node's cores for process index of count processes sharing the node (eg. MPI ranks on one node).
+        If the launcher already bound this process to fewer cores than the node has (eg. srun --cpu-bind), those are kept
+    """
+    cores = get_available_cores()
+    if len(cores) < os.cpu_count() or count <= 1:
+        return cores
+    if count > len(cores):
+        return [cores[index % len(cores)]]
+    return [int(c) for c in np.array_split(cores, count)[index]] # contiguous blocks, so processes don't share cores
+
+def check_oversubscription(processes_per_node=1, verbose=True):
+    """ Looks for more threads than cores, and returns what it found (list of strings, printed if verbose)
+        processes_per_node: processes of this job sharing the node (eg. MPI ranks per node, or batch workers)
+    """
+    cores = get_available_cores()
+    num_threads = get_num_threads()
+    issues = []
+    if num_threads > len(cores):
+        issues.append(f"{num_threads} threads per process, but it can only run on {len(cores)} cores")
+    if processes_per_node > 1 and len(cores) == os.cpu_count() and processes_per_node*num_threads > len(cores):
+        issues.append(f"{processes_per_node} processes x {num_threads} threads on a node with {len(cores)} cores, and processes aren't pinned to separate cores")
+    for var in THREAD_ENV_VARS:
+        value = os.environ.get(var)
+        if value and value.isdigit() and int(value) > len(cores) and int(value) != num_threads: # (num_threads is reported above)
+            issues.append(f"{var}={value}, but this process can only run on {len(cores)} cores")
+    if hasattr(os, 'getloadavg'):
+        load = os.getloadavg()[0]
+        if load > os.cpu_count():
+            issues.append(f"load average is {load:.1f} on {os.cpu_count()} cores, something else is busy on this node")
+    if verbose:
+        for issue in issues:
+            print(f"Oversubscribed: {issue}")
+    return issues
@@ -0,0 +1,204 @@
+"""
+ALS_recon_sinogram_store.py
+On-disk store of processed (post-log) sinograms on scratch, so rerunning a batch job with only different reconstruction settings (method, fc, SVMBIR sharpness, COR, ...)
+skips reading, normalization, ring/outlier removal and downsampling (see ALS_recon_functions.read_data), which are often the slowest steps.
+Each entry is the output of read_data for one scan and one set of processing settings (angles_ind, proj_downsample, preprocess and postprocess settings), keyed by a hash of those and of the file's identity (path, size, modification time).
+Entries are filled in chunk by chunk as batch jobs read them (the first run), and read back by any later run, whatever its chunk size.
+Each entry is one float32 .npy file of sinograms (slices, angles, rays), so a chunk of slices is one contiguous read. The index (index.json) records which rows are filled in, how big entries are and when they were last used,
+and least recently used entries are evicted to stay under a size quota
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import ALS_recon_functions as als
+import ALS_recon_io as als_io
+import ALS_recon_trace as trace
+
+INDEX_NAME = "index.json"
+DATA_NAME = "sinograms.npy"
+ANGLES_NAME = "angles.npy"
+QUOTA_GB = 500. # default size limit of the store
+STORE_VERSION = 1 # part of every key, so entries written by an older version of read_data (or of this layout) are never read back
+
+def get_sinogram_store_dir():
+    """ Default location of the store: als832_sinogram_store in the user's scratch (see ALS_recon_functions.get_scratch_path). Set SINOGRAM_STORE_DIR to use a different directory """
+    return os.environ.get('SINOGRAM_STORE_DIR', os.path.join(als.get_scratch_path(), "als832_sinogram_store"))
+
+def entry_key(path, proj=None, downsample_factor=None, preprocess_settings=None, postprocess_settings=None, phase=0):
+    """ Index key of the sinograms read_data returns for these arguments (all slices). Changes if the file is modified or replaced
+        phase: first slice of the downsampling blocks (slice number modulo downsample_factor), since read_data downsamples each chunk from its first slice
+    """
+    stat = os.stat(path)
+    identity = {"version": STORE_VERSION, "path": os.path.realpath(path), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                "proj": proj, "downsample_factor": downsample_factor or 1, "phase": phase,
+                "preprocess": preprocess_settings, "postprocess": postprocess_settings}
+    text = json.dumps(identity, sort_keys=True, default=repr) # repr for slices, numpy values, etc.
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+def _add_rows(ranges, start, stop):
+    # merges [start,stop) into sorted list of non-overlapping [start,stop) ranges
+    merged = []
+    for a, b in sorted(ranges + [[start, stop]]):
+        if merged and a <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    return merged
+
+def _has_rows(ranges, start, stop):
+    return any(a <= start and stop <= b for a, b in ranges)
+
+class SinogramStore:
+    """ Store of processed sinograms in a directory on scratch.
+        path: store directory. Each entry is in path/<key>/, the index in path/index.json. None means get_sinogram_store_dir()
+        quota_GB: size limit. Least recently used entries are removed when adding one goes over it
+    """
+    def __init__(self, path=None, quota_GB=QUOTA_GB):
+        self.path = path or get_sinogram_store_dir()
+        self.quota_GB = quota_GB
+        self.index_path = os.path.join(self.path, INDEX_NAME)
+        self._touched = set() # keys marked as used by this process, so last_used is only updated once per job
+
+    def read_index(self):
+        """ Index entries: key (see entry_key) -> {"data_path", "shape", "rows", "nbytes", "created", "last_used"}. rows are the [start,stop) ranges of filled in rows """
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError): # no index yet (or unreadable, entries are rewritten as they're used)
+            return {}
+
+    def _write_index(self, index):
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.index_path) # readers never see a partly written index
+
+    def _update(self, change):
+        # read-modify-write of the index, locked against other processes
+        os.makedirs(self.path, exist_ok=True)
+        with als_io.file_lock(self.index_path + ".lock"):
+            index = self.read_index()
+            result = change(index)
+            self._write_index(index)
+        return result
+
+    def entry_path(self, key, name=DATA_NAME):
+        """ Full path of file name of entry key """
+        return os.path.join(self.path, key, name)
+
+    @property
+    def nbytes(self):
+        """ Total size of stored entries """
+        return sum(entry["nbytes"] for entry in self.read_index().values())
+
+    def get(self, key, start, stop):
+        """ Rows start to stop of entry key as (angles,rows,rays) float32 array, and angles. None if any of the rows aren't stored """
+        entry = self.read_index().get(key)
+        if entry is None or not _has_rows(entry["rows"], start, stop):
+            return None
+        try:
+            data = np.load(self.entry_path(key), mmap_mode='r')
+            angles = np.load(self.entry_path(key, ANGLES_NAME))
+        except (OSError, ValueError): # evicted since the index was read
+            return None
+        with trace.stage("sinogram_store_read", bytes_read=(stop-start)*data[0].nbytes):
+            tomo = np.ascontiguousarray(data[start:stop].transpose(1, 0, 2)) # read and reorder to projections in one copy
+        if key not in self._touched:
+            self.touch(key)
+        return tomo, angles
+
+    def touch(self, key):
+        """ Marks entry as just used, so it's the last to be evicted """
+        def change(index):
+            if key in index:
+                index[key]["last_used"] = time.time()
+        self._update(change)
+        self._touched.add(key)
+
+    def put(self, key, start, stop, tomo, angles, num_rows):
+        """ Stores rows start to stop of entry key, creating the entry (and evicting others if over quota) if it's new. Returns whether the rows were stored
+            tomo: processed projections (angles,stop-start,rays), as returned by read_data
+            angles: projection angles
+            num_rows: number of rows of the whole entry (slices of the scan, after downsampling)
+        """
+        shape = [int(num_rows), tomo.shape[0], tomo.shape[2]]
+        nbytes = 4*int(np.prod(shape))
+        if nbytes > self.quota_GB*1024**3:
+            if key not in self._touched: # (only once per job)
+                print(f"Sinograms of this scan ({nbytes/1024**3:.1f} GB) don't fit in the {self.quota_GB} GB quota of the sinogram store, not storing them")
+                self._touched.add(key)
+            return False
+        def create(index):
+            entry = index.get(key)
+            if entry is not None and os.path.exists(self.entry_path(key)):
+                return entry["shape"] == shape
+            os.makedirs(os.path.join(self.path, key), exist_ok=True)
+            np.save(self.entry_path(key, ANGLES_NAME), np.asarray(angles))
+            np.lib.format.open_memmap(self.entry_path(key), mode='w+', dtype=np.float32, shape=tuple(shape)) # sparse file, filled in as chunks are stored
+            index[key] = {"data_path": self.entry_path(key), "shape": shape, "rows": [], "nbytes": nbytes,
+                          "created": time.time(), "last_used": time.time()}
+            self._evict(index, keep=key)
+            return True
+        if not self._update(create):
+            return False
+        # write data first, then record the rows, so other processes never read rows that aren't written yet
+        with trace.stage("sinogram_store_write", bytes_written=tomo.nbytes):
+            data = np.load(self.entry_path(key), mmap_mode='r+')
+            data[start:stop] = tomo.transpose(1, 0, 2)
+            data.flush()
+            del data
+        def record(index):
+            if key in index: # (unless it was evicted meanwhile)
+                index[key]["rows"] = _add_rows(index[key]["rows"], start, stop)
+        self._update(record)
+        return True
+
+    def _evict(self, index, keep=None):
+        # removes least recently used entries (other than keep) until the index fits in the quota
+        for key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if sum(entry["nbytes"] for entry in index.values()) <= self.quota_GB*1024**3:
+                break
+            if key == keep:
+                continue
+            entry = index.pop(key)
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            print(f"Evicted stored sinograms {key} ({entry['nbytes']/1024**3:.2f} GB) from {self.path}")
+
+    def read_data(self, path, proj=None, sino=None, downsample_factor=None, prelog=False,
+                  preprocess_settings={'minimum_transmission':0.01}, postprocess_settings=None, **kwargs):
+        """ Same parameters and returns as ALS_recon_functions.read_data, but reads the sinograms from the store if an earlier run stored them, otherwise runs read_data and stores them.
+            With downsampling, a chunk that ends in the middle of a downsampling block (other than at the last slice of the scan) isn't stored, since its last row would differ from the same row of a longer chunk
+            (see ALS_batch_recon.align_chunks, which avoids such chunks)
+        """
+        factor = int(downsample_factor or 1)
+        num_slices = als_io.open_dataset(path).data_shape[1]
+        start, stop, step = als_io.as_slice(sino).indices(num_slices)
+        phase = start % factor
+        if prelog or step != 1 or ((stop-phase) % factor and stop != num_slices) or stop <= start:
+            return als.read_data(path, proj=proj, sino=sino, downsample_factor=downsample_factor, prelog=prelog,
+                                 preprocess_settings=preprocess_settings, postprocess_settings=postprocess_settings, **kwargs)
+        key = entry_key(path, proj, downsample_factor, preprocess_settings, postprocess_settings, phase=phase)
+        rows = ((start-phase)//factor, -(-(stop-phase)//factor))
+        stored = self.get(key, *rows)
+        if stored is not None:
+            return stored
+        tomo, angles = als.read_data(path, proj=proj, sino=sino, downsample_factor=downsample_factor,
+                                     preprocess_settings=preprocess_settings, postprocess_settings=postprocess_settings, **kwargs)
+        try:
+            self.put(key, *rows, tomo, angles, num_rows=-(-(num_slices-phase)//factor))
+        except OSError as e: # store is only a shortcut, so a full scratch (or any other problem writing it) doesn't stop the job
+            print(f"Couldn't store sinograms in {self.path}: {e}")
+        return tomo, angles
+
+def get_batch_store(batch_settings):
+    """ SinogramStore of a batch job (see ALS_batch_recon.DEFAULT_BATCH_SETTINGS), or None if it doesn't use one
+        batch_settings: batch options. "sinogram_store" is False (no store), True (store in get_sinogram_store_dir()) or a directory, "sinogram_store_GB" its size limit
+    """
+    if not batch_settings.get("sinogram_store"):
+        return None
+    path = batch_settings["sinogram_store"] if isinstance(batch_settings["sinogram_store"], str) else None
+    return SinogramStore(path, quota_GB=batch_settings.get("sinogram_store_GB") or QUOTA_GB)
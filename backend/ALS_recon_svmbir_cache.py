@@ -0,0 +1,294 @@
+"""
+ALS_recon_svmbir_cache.py
+Index, prewarming and node-local staging of the SVMBIR system matrix cache (see ALS_recon_functions.get_svmbir_cache_dir).
+SVMBIR needs a system matrix for every geometry (rays, angles) it reconstructs, and building one takes minutes to hours. The index (index.json in the cache directory) records which matrix files belong to which geometry,
+how big they are, how long they took to build and when they were last used, so:
+ - batch jobs know before they start whether their geometry is cached (a miss means SVMBIR builds it first), and how long a miss will cost
+ - missing geometries can be built in parallel ahead of time (SVMBIRCache.prewarm)
+ - the matrix a job needs is copied once per node to node-local storage (stage, stage_mpi), instead of every rank reading it from the shared filesystem for every chunk
+ - least recently used entries are evicted to stay under a size quota (always for node-local copies, optional for the shared cache)
+"""
+
+import os
+import json
+import time
+import shutil
+import getpass
+import hashlib
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import ALS_recon_io as als_io
+
+INDEX_NAME = "index.json"
+MATRIX_DIR = "sysmatrix" # where SVMBIR keeps matrices inside svmbir_lib_path
+LOCAL_QUOTA_GB = 32. # default size limit of node-local copies (memory, if they're in /dev/shm)
+
+def geometry_key(num_rays, angles):
+    """ Index key of a SVMBIR geometry: rays (image is num_rays x num_rays), number of angles and a digest of the angles. center_offset is always 0 (see ALS_recon_functions.svmbir_recon) """
+    angles = np.round(np.asarray(angles, dtype=np.float64).ravel(), 6)
+    return f"{int(num_rays)}x{angles.size}_{hashlib.sha1(angles.tobytes()).hexdigest()[:12]}"
+
+def get_local_cache_dir():
+    """ Node-local directory staged matrices are copied to. /dev/shm (memory backed) if there is one, otherwise the temp directory. Set SVMBIR_LOCAL_CACHE_DIR to use a different directory """
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.environ.get('SVMBIR_LOCAL_CACHE_DIR', os.path.join(base, f"svmbir_cache_{getpass.getuser()}"))
+
+def _build_geometry(num_rays, angles, cache_path):
+    # Builds (or finds) the system matrix for one geometry in a private temporary svmbir_lib_path, seeded with links to the matrices already in cache_path, so parallel builds don't mix up their files
+    # and matrices cached before there was an index are found rather than rebuilt. Same parameters as svmbir.recon uses in svmbir_recon. Returns (names of matrix files, whether they're new, seconds)
+    if os.environ.get('CLIB') =='CMD_LINE':
+        import svmbir.interface_py_c as ci
+    else:
+        import svmbir.interface_cy_c as ci
+    shared = os.path.join(cache_path, MATRIX_DIR)
+    os.makedirs(shared, exist_ok=True)
+    work = tempfile.mkdtemp(prefix="build_", dir=cache_path)
+    try:
+        os.makedirs(os.path.join(work, MATRIX_DIR))
+        for name in os.listdir(shared):
+            os.symlink(os.path.join(shared, name), os.path.join(work, MATRIX_DIR, name))
+        tic = time.time()
+        paths, _, _ = ci._init_geometry(np.asarray(angles), center_offset=0.0,
+                                        geometry='parallel', dist_source_detector=0.0,
+                                        magnification=1.0,
+                                        num_channels=num_rays, num_views=len(angles), num_slices=1,
+                                        num_rows=num_rays, num_cols=num_rays,
+                                        delta_channel=1.0, delta_pixel=1.0,
+                                        roi_radius=float(num_rays)/2.0,
+                                        object_name='object',
+                                        svmbir_lib_path=work,
+                                        verbose=0)
+        seconds = time.time() - tic
+        built = os.path.join(work, MATRIX_DIR)
+        new = [name for name in os.listdir(built) if not os.path.islink(os.path.join(built, name))]
+        if isinstance(paths, dict) and 'sysmatrix_name' in paths: # files SVMBIR uses for this geometry, whether it built them or found them
+            prefix = os.path.basename(paths['sysmatrix_name'])
+            names = [name for name in os.listdir(built) if name.startswith(prefix)]
+        else:
+            names = new
+        for name in new:
+            shutil.move(os.path.join(built, name), os.path.join(shared, name))
+        return names, bool(new), seconds
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+class SVMBIRCache:
+    """ Index of the system matrices in a SVMBIR cache directory (the svmbir_lib_path given to SVMBIR).
+        path: cache directory. Matrices are in path/sysmatrix, the index in path/index.json
+        quota_GB: size limit. Least recently used entries (and their files) are removed when adding one goes over it. None means no limit (default, since the shared cache is used by everyone)
+    """
+    def __init__(self, path, quota_GB=None):
+        self.path = path
+        self.quota_GB = quota_GB
+        self.index_path = os.path.join(path, INDEX_NAME)
+
+    def read_index(self):
+        """ Index entries: key (see geometry_key) -> {"num_rays", "num_angles", "files", "nbytes", "build_seconds", "last_used"} """
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError): # no index yet (or unreadable, it's rebuilt as geometries are used)
+            return {}
+
+    def _write_index(self, index):
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.index_path) # readers never see a partly written index
+
+    def _update(self, change):
+        # read-modify-write of the index, locked against other processes
+        os.makedirs(self.path, exist_ok=True)
+        with als_io.file_lock(self.index_path + ".lock"):
+            index = self.read_index()
+            result = change(index)
+            self._write_index(index)
+        return result
+
+    def matrix_path(self, name):
+        """ Full path of matrix file name """
+        return os.path.join(self.path, MATRIX_DIR, name)
+
+    def lookup(self, num_rays, angles):
+        """ Index entry of this geometry, or None if it isn't cached (or its files are gone) """
+        entry = self.read_index().get(geometry_key(num_rays, angles))
+        if entry is None or not entry["files"] or not all(os.path.exists(self.matrix_path(name)) for name in entry["files"]):
+            return None
+        return entry
+
+    def touch(self, num_rays, angles):
+        """ Marks geometry as just used, so it's the last to be evicted """
+        def change(index):
+            entry = index.get(geometry_key(num_rays, angles))
+            if entry is not None:
+                entry["last_used"] = time.time()
+        self._update(change)
+
+    def add(self, num_rays, angles, files, build_seconds=None):
+        """ Records matrix files (names in path/sysmatrix) of a geometry, then evicts least recently used entries if over quota. Returns the entry """
+        entry = {"num_rays": int(num_rays), "num_angles": int(np.size(angles)), "files": list(files),
+                 "nbytes": sum(os.path.getsize(self.matrix_path(name)) for name in files),
+                 "build_seconds": build_seconds, "last_used": time.time()}
+        key = geometry_key(num_rays, angles)
+        def change(index):
+            if build_seconds is None and key in index: # adopted or copied, keep how long it took to build originally
+                entry["build_seconds"] = index[key].get("build_seconds")
+            index[key] = entry
+            self._evict(index, keep=key)
+        self._update(change)
+        return entry
+
+    def _evict(self, index, keep=None):
+        # removes least recently used entries (other than keep) until the index fits in the quota
+        if self.quota_GB is None:
+            return
+        for key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if sum(entry["nbytes"] for entry in index.values()) <= self.quota_GB*1024**3:
+                break
+            if key == keep:
+                continue
+            entry = index.pop(key)
+            in_use = {name for e in index.values() for name in e["files"]}
+            for name in entry["files"]:
+                if name not in in_use: # files can be shared by geometries SVMBIR hashes the same
+                    try:
+                        os.remove(self.matrix_path(name))
+                    except FileNotFoundError:
+                        pass
+            print(f"Evicted SVMBIR system matrix {key} ({entry['nbytes']/1024**3:.2f} GB) from {self.path}")
+
+    @property
+    def nbytes(self):
+        """ Total size of indexed matrices """
+        return sum(entry["nbytes"] for entry in self.read_index().values())
+
+    def estimate_build_seconds(self, num_rays, num_angles):
+        """ Rough time to build a matrix that isn't cached, scaled (by rays^2 x angles) from the closest size built before. None if nothing was ever built here """
+        built = [entry for entry in self.read_index().values() if entry.get("build_seconds")]
+        if not built:
+            return None
+        size = num_rays**2 * num_angles
+        closest = min(built, key=lambda entry: abs(np.log(entry["num_rays"]**2 * entry["num_angles"] / size)))
+        return closest["build_seconds"] * size / (closest["num_rays"]**2 * closest["num_angles"])
+
+    def ensure(self, num_rays, angles, verbose=True):
+        """ Returns index entry of this geometry, building its matrix first if it isn't cached (one process at a time, others wait and then find it). Misses are reported, since a build can take hours.
+            Returns None if the matrix files couldn't be found after building (eg. a SVMBIR version that keeps them elsewhere)
+        """
+        entry = self.lookup(num_rays, angles)
+        if entry is not None:
+            return entry
+        os.makedirs(self.path, exist_ok=True)
+        with als_io.file_lock(os.path.join(self.path, f"build_{geometry_key(num_rays, angles)}.lock")):
+            entry = self.lookup(num_rays, angles) # someone else may have built it while we waited
+            if entry is not None:
+                return entry
+            if verbose:
+                estimate = self.estimate_build_seconds(num_rays, len(angles))
+                print(f"SVMBIR system matrix for {num_rays} rays x {len(angles)} angles isn't indexed in {self.path}. Building it now"
+                      + (f" (about {estimate/60:.0f} min)" if estimate is not None else " (can take hours for large sizes)")
+                      + " -- prewarm the cache before submitting jobs to avoid this")
+            names, new, seconds = _build_geometry(num_rays, angles, self.path)
+            if not names:
+                print(f"Couldn't find the system matrix files SVMBIR made in {self.path}/{MATRIX_DIR}, so they aren't indexed")
+                return None
+            if verbose:
+                print(f"{'Built' if new else 'Found existing'} SVMBIR system matrix for {num_rays} rays x {len(angles)} angles in {seconds:.0f} sec")
+            return self.add(num_rays, angles, names, build_seconds=seconds if new else None)
+
+    def prewarm(self, geometries, num_workers=None):
+        """ Builds matrices of all geometries that aren't cached yet, in parallel worker processes
+            geometries: list of (num_rays, angles)
+            num_workers: number of builds at once. None means one per missing geometry, up to the number of cpus
+        """
+        missing = [(num_rays, np.asarray(angles)) for num_rays, angles in geometries if self.lookup(num_rays, angles) is None]
+        if not missing:
+            print(f"All {len(geometries)} SVMBIR geometries already cached in {self.path}")
+            return
+        if num_workers is None:
+            num_workers = min(len(missing), os.cpu_count())
+        print(f"Building {len(missing)} SVMBIR system matrices with {num_workers} workers")
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_build_geometry, num_rays, angles, self.path) for num_rays, angles in missing]
+            for (num_rays, angles), future in zip(missing, futures):
+                names, new, seconds = future.result()
+                if names:
+                    self.add(num_rays, angles, names, build_seconds=seconds if new else None)
+                print(f"{num_rays}x{num_rays}-->{len(angles)}x{num_rays}: {seconds:.1f} sec")
+
+    def stage(self, num_rays, angles, local_path=None, quota_GB=LOCAL_QUOTA_GB):
+        """ Copies this geometry's matrix to node-local storage (once per node: other processes wait for the copy, later calls find it) and returns the local directory to use as svmbir_lib_path.
+            Returns this cache's path if the geometry isn't cached (SVMBIR will build it there, see ensure)
+            local_path: node-local cache directory. None means get_local_cache_dir()
+            quota_GB: size limit of the node-local cache (least recently used geometries are removed)
+        """
+        entry = self.lookup(num_rays, angles)
+        if entry is None:
+            return self.path
+        local = SVMBIRCache(local_path or get_local_cache_dir(), quota_GB=quota_GB)
+        os.makedirs(os.path.join(local.path, MATRIX_DIR), exist_ok=True)
+        with als_io.file_lock(local.index_path + ".stage.lock"):
+            if local.lookup(num_rays, angles) is None:
+                tic = time.time()
+                for name in entry["files"]:
+                    tmp = local.matrix_path(name) + f".{os.getpid()}.tmp"
+                    shutil.copyfile(self.matrix_path(name), tmp)
+                    os.replace(tmp, local.matrix_path(name))
+                local.add(num_rays, angles, entry["files"])
+                print(f"Staged SVMBIR system matrix ({entry['nbytes']/1024**3:.2f} GB) to {local.path} in {time.time()-tic:.1f} sec")
+            else:
+                local.touch(num_rays, angles)
+        self.touch(num_rays, angles)
+        return local.path
+
+def stage_mpi(cache, num_rays, angles, comm, local_path=None, quota_GB=LOCAL_QUOTA_GB, block_MB=256):
+    """ stage for MPI jobs: rank 0 makes sure the matrix is cached (see SVMBIRCache.ensure) and reads it from the shared filesystem once, then broadcasts it to one rank per node, which writes it to node-local storage.
+        Call on every rank. Returns the node-local directory to use as svmbir_lib_path
+        comm: MPI communicator of all ranks
+        block_MB: size of each broadcast block (the matrix is never in memory all at once)
+    """
+    from mpi4py import MPI
+    entry = cache.ensure(num_rays, angles) if comm.Get_rank() == 0 else None
+    entry = comm.bcast(entry, root=0)
+    if entry is None: # not indexed, SVMBIR reads (or builds) it in the shared cache
+        return cache.path
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    leaders = comm.Split(0 if node_comm.Get_rank() == 0 else MPI.UNDEFINED, comm.Get_rank()) # one rank per node, world rank 0 first
+    local = SVMBIRCache(local_path or get_local_cache_dir(), quota_GB=quota_GB)
+    if leaders != MPI.COMM_NULL:
+        os.makedirs(os.path.join(local.path, MATRIX_DIR), exist_ok=True)
+        have = local.lookup(num_rays, angles) is not None
+        if not all(leaders.allgather(have)): # every leader takes part in the broadcast, the ones that already have it just don't write
+            tic = time.time()
+            buffer = np.empty(int(block_MB*1024**2), dtype=np.uint8)
+            for name in entry["files"]:
+                size = os.path.getsize(cache.matrix_path(name)) if leaders.Get_rank() == 0 else None
+                size = leaders.bcast(size, root=0)
+                tmp = local.matrix_path(name) + f".{os.getpid()}.tmp"
+                src = open(cache.matrix_path(name), 'rb') if leaders.Get_rank() == 0 else None
+                dst = open(tmp, 'wb') if not have else None
+                for start in range(0, size, buffer.size):
+                    block = buffer[:min(buffer.size, size-start)]
+                    if src is not None:
+                        src.readinto(block)
+                    leaders.Bcast(block, root=0)
+                    if dst is not None:
+                        dst.write(block)
+                if src is not None:
+                    src.close()
+                if dst is not None:
+                    dst.close()
+                    os.replace(tmp, local.matrix_path(name))
+            if not have:
+                local.add(num_rays, angles, entry["files"])
+            if leaders.Get_rank() == 0:
+                print(f"Staged SVMBIR system matrix ({entry['nbytes']/1024**3:.2f} GB) to {local.path} on {leaders.Get_size()} nodes in {time.time()-tic:.1f} sec")
+        else:
+            local.touch(num_rays, angles)
+        leaders.Free()
+    node_comm.Barrier() # matrix is on this node before any rank uses it
+    node_comm.Free()
+    if comm.Get_rank() == 0:
+        cache.touch(num_rays, angles)
+    return local.path
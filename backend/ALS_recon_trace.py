@@ -0,0 +1,205 @@
+"""
+ALS_recon_trace.py
+Optional tracing of reconstruction stages (read, normalize, ring removal, log, downsample, 360 stitching, recon, mask, write): wall time, bytes read/written and memory per stage and chunk
+Off by default. When off, trace.stage(...) returns a shared do-nothing object, so instrumented code costs one function call per stage
+Turn on with enable_tracing() (or batch setting "trace"), then print_trace_summary() or save_trace() to get JSON and Chrome trace files (open in chrome://tracing or https://ui.perfetto.dev)
+"""
+
+import os
+import json
+import time
+import threading
+
+_tracer = None # None means tracing is off
+
+class _NullSpan:
+    """ Stand-in for a span when tracing is off """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+def _read_memory():
+    # current and peak resident memory of this process, in bytes (Linux only, zeros elsewhere)
+    rss, hwm = 0, 0
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])*1024
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1])*1024
+    except OSError:
+        pass
+    return rss, hwm
+
+def _reset_peak_memory():
+    # resets this process's peak resident memory (VmHWM) to its current value (Linux 4.0+). Returns whether it could
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class _Span:
+    """ One traced stage. Args set while it runs (eg. bytes_read) are saved with it. The chunk being processed is inherited from the enclosing span on the same thread """
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        if stack and 'chunk' in stack[-1].args and 'chunk' not in self.args:
+            self.args['chunk'] = stack[-1].args['chunk']
+        stack.append(self)
+        self.rss_start, self.peak = self.tracer.open_span(self)
+        self.start = time.time()
+        return self
+
+    def set(self, **args):
+        """ Adds values to this span, eg. bytes_read=tomo.nbytes """
+        self.args.update(args)
+
+    def __exit__(self, *exc):
+        end = time.time()
+        rss_end, peak = self.tracer.close_span(self)
+        self.tracer.stack().pop()
+        self.tracer.add({'name': self.name, 'start': self.start, 'seconds': end-self.start,
+                         'pid': os.getpid(), 'tid': threading.get_ident(), 'thread': threading.current_thread().name,
+                         'rss_start': self.rss_start, 'rss_end': rss_end, 'peak_rss': peak, 'peak_rss_increase': max(peak - self.rss_start, 0),
+                         'error': exc[0] is not None,
+                         **{key: (list(value) if isinstance(value, tuple) else value) for key, value in self.args.items()}})
+        return False
+
+class Tracer:
+    """ Collects spans from all threads of this process. Use enable_tracing rather than creating directly.
+        Each span's peak memory is the highest resident memory while it ran: the process's peak (VmHWM) is reset when a span starts,
+        after passing the peak so far on to the spans that are still open (enclosing spans, and spans of other threads).
+        Where it can't be reset (not Linux, or an old kernel), peak_rss is the peak since the process started
+    """
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = set() # spans that haven't finished yet, in all threads
+        self._can_reset = True
+
+    def open_span(self, span):
+        # records span as open, resetting the peak. Returns current memory and peak so far
+        with self._lock:
+            rss, hwm = _read_memory()
+            for other in self._open:
+                other.peak = max(other.peak, hwm)
+            if self._can_reset:
+                self._can_reset = _reset_peak_memory()
+            self._open.add(span)
+            return rss, rss if self._can_reset else hwm
+
+    def close_span(self, span):
+        # removes span from the open spans. Returns current memory and highest memory while it ran
+        with self._lock:
+            rss, hwm = _read_memory()
+            self._open.discard(span)
+            return rss, max(span.peak, hwm)
+
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+def enable_tracing():
+    """ Turns tracing on in this process (clearing anything recorded before) """
+    global _tracer
+    _tracer = Tracer()
+
+def disable_tracing():
+    """ Turns tracing off. Returns list of recorded spans """
+    global _tracer
+    spans = get_spans()
+    _tracer = None
+    return spans
+
+def is_tracing():
+    return _tracer is not None
+
+def stage(name, **args):
+    """ Context manager that traces the code inside it as stage name, eg.
+            with trace.stage("normalize", chunk=(0,50)) as span:
+                ...
+                span.set(bytes_read=n)
+        Does nothing (and costs almost nothing) when tracing is off
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(_tracer, name, args)
+
+def get_spans():
+    """ List of spans recorded so far (dictionaries with name, start, seconds, memory, and any args) """
+    if _tracer is None:
+        return []
+    with _tracer._lock:
+        return list(_tracer.spans)
+
+def summarize_spans(spans):
+    """ Totals per stage name: count, total/max seconds, bytes read/written, highest peak memory and highest increase of memory during the stage """
+    summary = {}
+    for span in spans:
+        s = summary.setdefault(span['name'], {'count': 0, 'seconds': 0., 'max_seconds': 0., 'bytes_read': 0, 'bytes_written': 0, 'peak_rss': 0, 'peak_rss_increase': 0})
+        s['count'] += 1
+        s['seconds'] += span['seconds']
+        s['max_seconds'] = max(s['max_seconds'], span['seconds'])
+        s['bytes_read'] += span.get('bytes_read', 0)
+        s['bytes_written'] += span.get('bytes_written', 0)
+        s['peak_rss'] = max(s['peak_rss'], span['peak_rss'])
+        s['peak_rss_increase'] = max(s['peak_rss_increase'], span.get('peak_rss_increase', 0)) # (not in traces saved by older versions)
+    return summary
+
+def print_trace_summary(spans=None):
+    """ Prints per-stage totals, slowest stage first. spans: None means spans recorded in this process """
+    summary = summarize_spans(get_spans() if spans is None else spans)
+    print(f"{'stage':>20} {'count':>6} {'total (s)':>10} {'max (s)':>8} {'read (MB)':>10} {'written (MB)':>13} {'peak mem (GB)':>14} {'mem added (GB)':>15}")
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name:>20} {s['count']:>6d} {s['seconds']:>10.2f} {s['max_seconds']:>8.2f} {s['bytes_read']/1024**2:>10.1f} {s['bytes_written']/1024**2:>13.1f} {s['peak_rss']/1024**3:>14.2f} {s['peak_rss_increase']/1024**3:>15.2f}")
+
+def to_chrome_trace(spans):
+    """ Converts spans to Chrome trace event format (complete "X" events, times in microseconds) """
+    events = []
+    for span in spans:
+        args = {key: value for key, value in span.items() if key not in ['name', 'start', 'seconds', 'pid', 'tid']}
+        events.append({'name': span['name'], 'ph': 'X', 'ts': span['start']*1e6, 'dur': span['seconds']*1e6,
+                       'pid': span['pid'], 'tid': span['tid'], 'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def save_trace(path, spans=None):
+    """ Saves spans as path.json (spans plus per-stage summary) and path.chrome.json (Chrome trace)
+        path: file name without extension
+        spans: None means spans recorded in this process
+    """
+    spans = get_spans() if spans is None else spans
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path+".json", 'w') as f:
+        json.dump({'spans': spans, 'summary': summarize_spans(spans)}, f, indent=1, default=repr)
+    with open(path+".chrome.json", 'w') as f:
+        json.dump(to_chrome_trace(spans), f, default=repr)
+
+def load_spans(paths):
+    """ Reads spans from files written by save_trace (eg. one per batch worker or MPI rank), so they can be combined """
+    spans = []
+    for path in paths:
+        with open(path if path.endswith(".json") else path+".json") as f:
+            spans += json.load(f)['spans']
+    return spans
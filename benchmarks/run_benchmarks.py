@@ -0,0 +1,540 @@
+"""
+run_benchmarks.py
+Times each reconstruction path (reading, every preprocessing stage, COR finding, 360 to 180 conversion, Astra/tomopy/SVMBIR recon and end-to-end batch recon)
+on synthetic scans (see synthetic_data.py), for a matrix of scan sizes. Runs on CPU only (GPUs are hidden), so it works on login nodes and laptops
+Results are saved as json, with the git commit and machine they came from, so runs from different commits can be compared:
+    python run_benchmarks.py --sizes tiny small
+    python run_benchmarks.py --sizes tiny small --compare <earlier run>.json
+Results go to als832_benchmark_results in the temp directory (outside the repository), or --results-dir
+Correctness checks (eg. that COR finding recovers the known COR of synthetic scans, and that fused stages give the same results as the code they replaced) run with --check
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import fnmatch
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+import multiprocessing as mp
+os.environ['CUDA_VISIBLE_DEVICES'] = '' # CPU only, so results are comparable between machines (check_for_gpu and batch workers see no GPU)
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARK_DIR, '..', 'backend'))
+import ALS_recon_functions as als # (imports ALS_recon_resources before tomopy)
+import tomopy
+import ALS_recon_helper as helper
+import ALS_batch_recon as batch_recon
+import ALS_recon_cor as cor_finder
+import synthetic_data
+
+DEFAULT_RESULTS_DIR = os.path.join(tempfile.gettempdir(), "als832_benchmark_results")
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "als832_benchmark_data") # synthetic scans are kept here between runs
+REGRESSION_THRESHOLD = 0.1 # --compare flags benchmarks more than 10% slower than before
+
+SIZES = list(synthetic_data.SCAN_SIZES)
+BENCHMARKS = {} # name -> dictionary with setup function, scan angular range, largest size to run and number of repeats
+CHECKS = {} # name -> check function (see check)
+
+def benchmark(name, angular_range=180, max_size=None, repeat=None):
+    """ Registers a benchmark. Decorated function is called as setup(scan) and returns (run, prepare):
+        run is what gets timed. If prepare isn't None, it is called (untimed) before every run and its result passed to run (eg. a fresh copy of data that run modifies in place)
+        angular_range: which synthetic scan to use (180 or 360)
+        max_size: largest of synthetic_data.SCAN_SIZES to run on (None means all)
+        repeat: number of timed runs, overriding --repeat (eg. 1 for slow end-to-end benchmarks)
+    """
+    def register(setup):
+        BENCHMARKS[name] = {'setup': setup, 'angular_range': angular_range, 'max_size': max_size, 'repeat': repeat}
+        return setup
+    return register
+
+def check(name):
+    """ Registers a correctness check. Decorated function is called as check(data_dir) and raises AssertionError if a result is wrong """
+    def register(function):
+        CHECKS[name] = function
+        return function
+    return register
+
+class Scan:
+    """ Synthetic scan plus data derived from it that several benchmarks share (computed once, untimed) """
+    def __init__(self, path, size, angular_range):
+        self.path = path
+        self.size = size
+        self.angular_range = angular_range
+        self.metadata = als.read_metadata(path, print_flag=False)
+        self.COR = float(synthetic_data.get_scan_COR(path))
+        self._normalized = None
+        self._tomo = None
+
+    @property
+    def nbytes(self):
+        """ Size of the scan as float32 sinograms (for throughput) """
+        return 4*self.metadata['numangles']*self.metadata['numslices']*self.metadata['numrays']
+
+    def normalized(self):
+        """ Flat/dark normalized projections (input to the pre-log stages) """
+        if self._normalized is None:
+            self._normalized, _ = als.read_normalized(self.path)
+        return self._normalized
+
+    def tomo(self):
+        """ Fully processed sinograms and angles (input to reconstruction), not converted from 360 degrees """
+        if self._tomo is None:
+            self._tomo = als.read_data(self.path, preprocess_settings={'minimum_transmission': 0.01})
+        return self._tomo
+
+    @property
+    def recon_COR(self):
+        """ COR of tomo_180 (stitched 360 degree sinograms have the rotation axis in the middle) """
+        if self.angular_range > 300:
+            return helper.stitched_360_COR(self.tomo()[0].shape[2], self.COR)
+        return self.COR
+
+    def tomo_180(self):
+        """ Sinograms and angles ready to reconstruct (converted to 180 degrees if needed) """
+        tomo, angles = self.tomo()
+        if self.angular_range > 300:
+            return helper.convert_tomo_360_to_180(tomo, angles, self.COR)
+        return tomo, angles
+
+def _copy_of(array):
+    return lambda: array.copy()
+
+def _wavelet_level(num_rays):
+    # remove_stripe_fw needs a few pixels left at the coarsest level
+    return int(np.clip(np.log2(num_rays) - 4, 1, 8))
+
+################################ reading ################################
+
+for factor in [1, 2, 4]:
+    def setup_read(scan, factor=factor):
+        return lambda: als.read_data(scan.path, downsample_factor=factor, preprocess_settings={'minimum_transmission': 0.01}), None
+    benchmark(f"read_data/downsample_{factor}")(setup_read)
+
+@benchmark("read_normalized")
+def setup_read_normalized(scan):
+    return lambda: als.read_normalized(scan.path), None
+
+################################ preprocessing stages ################################
+
+@benchmark("preprocess/remove_all_stripe")
+def setup_remove_all_stripe(scan):
+    return lambda tomo: als.prelog_process_tomo(tomo, {'snr': 3, 'la_size': 31, 'sm_size': 11}), _copy_of(scan.normalized())
+
+@benchmark("preprocess/remove_outlier1d")
+def setup_remove_outlier1d(scan):
+    return lambda tomo: als.prelog_process_tomo(tomo, {'outlier_diff_1D': 0.5, 'outlier_size_1D': 3}), _copy_of(scan.normalized())
+
+@benchmark("preprocess/remove_outlier2d")
+def setup_remove_outlier2d(scan):
+    return lambda tomo: als.prelog_process_tomo(tomo, {'outlier_diff_2D': 0.5, 'outlier_size_2D': 3}), _copy_of(scan.normalized())
+
+@benchmark("preprocess/threshold")
+def setup_threshold(scan):
+    return lambda tomo: als.prelog_process_tomo(tomo, {'minimum_transmission': 0.01}), _copy_of(scan.normalized())
+
+@benchmark("preprocess/minus_log")
+def setup_minus_log(scan):
+    return lambda tomo: als.log_and_postprocess_tomo(tomo), _copy_of(scan.normalized())
+
+@benchmark("preprocess/normalize_log")
+def setup_normalize_log(scan):
+    tomo, _, flat, dark = als.read_raw(scan.path)
+    return lambda: als.normalize_log(tomo, flat, dark, minimum_transmission=0.01), None
+
+@benchmark("preprocess/normalize_log_unfused")
+def setup_normalize_log_unfused(scan):
+    tomo, _, flat, dark = als.read_raw(scan.path, dtype=np.float32)
+    def run(tomo):
+        tomopy.normalize(tomo, flat, dark, out=tomo)
+        tomo[tomo < 0.01] = 0.01
+        return tomopy.minus_log(tomo, out=tomo)
+    return run, _copy_of(tomo)
+
+@benchmark("preprocess/downsample_2")
+def setup_downsample(scan):
+    return lambda: als.downsample_tomo(scan.tomo()[0], 2), None
+
+@benchmark("preprocess/remove_stripe_fw")
+def setup_remove_stripe_fw(scan):
+    settings = {'ringSigma': 3, 'ringLevel': _wavelet_level(scan.metadata['numrays'])}
+    return lambda tomo: als.postlog_process_tomo(tomo, settings), _copy_of(scan.tomo()[0])
+
+################################ center of rotation ################################
+
+for angular_range in [180, 360]:
+    suffix = "" if angular_range == 180 else "_360"
+    def setup_auto_find_cor(scan):
+        return lambda: als.auto_find_cor(scan.path), None
+    benchmark("cor/auto_find_cor"+suffix, angular_range=angular_range)(setup_auto_find_cor)
+
+    def setup_estimate_cor_profile(scan):
+        return lambda: cor_finder.estimate_cor_profile(scan.path), None
+    benchmark("cor/estimate_cor_profile"+suffix, angular_range=angular_range)(setup_estimate_cor_profile)
+
+    def setup_cor_sweep(scan): # 21 trial CORs, same as the notebook's default sweep
+        return lambda: cor_finder.cor_sweep(scan.path, scan.metadata['numslices']//2, (scan.COR-5, scan.COR+5), step=0.5, proj_downsample=2), None
+    benchmark("cor/cor_sweep"+suffix, angular_range=angular_range)(setup_cor_sweep)
+
+################################ 360 to 180 ################################
+
+@benchmark("sino_360_to_180", angular_range=360)
+def setup_sino_360_to_180(scan):
+    tomo, _ = scan.tomo()
+    overlap = tomo.shape[2] - 2*scan.COR # same as ALS_recon_helper.convert_tomo_360_to_180
+    out = np.empty((tomo.shape[0]//2, tomo.shape[1], 2*tomo.shape[2] - int(np.floor(overlap))), dtype=np.float32)
+    return lambda: als.sino_360_to_180(tomo, overlap=overlap, rotation='right', out=out), None
+
+################################ shifts ################################
+
+for method in ["linear", "fourier"]:
+    def setup_shift_images(scan, method=method): # SVMBIR's COR pre-shift of every chunk
+        tomo, _ = scan.tomo()
+        out = np.empty(tomo.shape, dtype=np.float32)
+        return lambda: als.shift_images(tomo, -scan.COR, method=method, out=out), None
+    benchmark(f"shift_images/{method}")(setup_shift_images)
+
+################################ reconstruction ################################
+
+for angular_range in [180, 360]:
+    suffix = "" if angular_range == 180 else "_360"
+    def setup_fbp(scan):
+        tomo, angles = scan.tomo_180()
+        return lambda: als.astra_fbp_recon(tomo, angles, COR=scan.recon_COR, fc=1, gpu=False), None
+    benchmark("recon/astra_fbp"+suffix, angular_range=angular_range)(setup_fbp)
+
+@benchmark("recon/numpy_fbp")
+def setup_numpy_fbp(scan):
+    tomo, angles = scan.tomo_180()
+    return lambda: als.numpy_fbp_recon(tomo, angles, COR=scan.recon_COR, fc=1), None
+
+@benchmark("recon/astra_fbp_lowpass")
+def setup_fbp_lowpass(scan):
+    tomo, angles = scan.tomo_180()
+    return lambda: als.astra_fbp_recon(tomo, angles, COR=scan.recon_COR, fc=0.5, gpu=False), None
+
+@benchmark("recon/astra_cgls", max_size="medium")
+def setup_cgls(scan):
+    tomo, angles = scan.tomo_180()
+    return lambda: als.astra_cgls_recon(tomo, angles, COR=scan.recon_COR, num_iter=20, gpu=False), None
+
+@benchmark("recon/tomopy_gridrec")
+def setup_gridrec(scan):
+    tomo, angles = scan.tomo_180()
+    return lambda: als.tomopy_gridrec_recon(tomo, angles, COR=scan.recon_COR, fc=1), None
+
+@benchmark("recon/svmbir", max_size="small", repeat=1)
+def setup_svmbir(scan):
+    if als.svmbir_spec is None:
+        return None, None # not installed
+    tomo, angles = scan.tomo_180()
+    tomo = tomo[:, :2] # SVMBIR is slow, a couple of slices is enough to compare
+    # first call builds the system matrix for this geometry (cached in SVMBIR_CACHE_DIR), so warmup isn't timed
+    return lambda: als.svmbir_recon(tomo, angles, COR=scan.recon_COR, max_iter=20), None
+
+@benchmark("recon/svmbir_multires", max_size="small", repeat=1)
+def setup_svmbir_multires(scan):
+    if als.svmbir_spec is None:
+        return None, None # not installed
+    tomo, angles = scan.tomo_180()
+    tomo = tomo[:, :2]
+    # converges on 4x and 2x binned sinograms before full resolution (each level stops once converged, up to 20 iterations)
+    return lambda: als.svmbir_recon(tomo, angles, COR=scan.recon_COR, max_iter=20, levels=[4,2,1]), None
+
+################################ end to end ################################
+
+def get_benchmark_settings(scan, output_path, method="fbp"):
+    """ Batch settings dictionary (same layout as ALS_recon.ipynb) reconstructing all slices of scan """
+    name = os.path.splitext(os.path.basename(scan.path))[0]
+    return {"data": {"output_path": output_path, "data_path": scan.path, "name": name,
+                     "start_slice": 0, "stop_slice": scan.metadata['numslices']-1,
+                     "angles_ind": slice(0, None, 1), "proj_downsample": 1},
+            "preprocess": {"snr": 3, "la_size": 31, "sm_size": 11, "outlier_diff_1D": 0, "outlier_size_1D": 0, "minimum_transmission": 0.01},
+            "postprocess": {"ringSigma": 0, "ringLevel": 0},
+            "recon": {"method": method, "COR": scan.COR, "fc": 1, "use_gpu": False},
+            "batch": {"worker_backend": "cpu", "num_workers": 1, "record_timings": False, "resume": False}}
+
+for angular_range in [180, 360]:
+    suffix = "" if angular_range == 180 else "_360"
+    def setup_batch_astra_recon(scan):
+        output_path = os.path.join(os.path.dirname(scan.path), "output") # next to the synthetic scans, overwritten every run
+        def prepare():
+            shutil.rmtree(output_path, ignore_errors=True)
+            return get_benchmark_settings(scan, output_path)
+        return batch_recon.batch_astra_recon, prepare
+    benchmark("end_to_end/batch_astra_recon"+suffix, angular_range=angular_range, repeat=1)(setup_batch_astra_recon)
+
+@benchmark("end_to_end/batch_astra_recon_stored", repeat=1)
+def setup_batch_astra_recon_stored(scan):
+    # rerun of a job whose sinograms are in the sinogram store (untimed warmup run stores them), eg. trying another recon method
+    output_path = os.path.join(os.path.dirname(scan.path), "output")
+    store_path = os.path.join(os.path.dirname(scan.path), "sinogram_store")
+    shutil.rmtree(store_path, ignore_errors=True)
+    def prepare():
+        shutil.rmtree(output_path, ignore_errors=True)
+        settings = get_benchmark_settings(scan, output_path)
+        settings["batch"]["sinogram_store"] = store_path
+        return settings
+    return batch_recon.batch_astra_recon, prepare
+
+################################ correctness checks ################################
+
+@check("cor/cor_sweep_360")
+def check_cor_sweep_360(data_dir):
+    # stitched field of view changes with trial COR, so the sweep must find COR by how well the halves match (not by sharpness/entropy of the reconstructions)
+    path = os.path.join(data_dir, "cor_check_360.h5")
+    if not os.path.exists(path):
+        synthetic_data.write_synthetic_scan(path, num_angles=720, num_slices=8, num_rays=384, angular_range=360, COR=150.4)
+    COR = synthetic_data.get_scan_COR(path)
+    for cor_range, step, proj_downsample in [((130, 170), 4, 1), ((COR-2, COR+2), 0.2, 1), ((COR-10, COR+10), 1, 2)]:
+        sweep = cor_finder.cor_sweep(path, 4, cor_range, step=step, proj_downsample=proj_downsample)
+        print(f"    {sweep}")
+        assert abs(sweep.best() - COR) <= max(step/2, 0.5), f"COR sweep {cor_range} step {step} found COR {sweep.best():g}, but scan COR is {COR:g}"
+
+@check("cor/estimate_cor_profile_360")
+def check_cor_profile_360(data_dir):
+    # offset 360 degree scan: projection matching alone is off by up to a pixel or so, refining by matching the stitched halves should get within a fraction of one
+    path = os.path.join(data_dir, "cor_check_360.h5")
+    if not os.path.exists(path):
+        synthetic_data.write_synthetic_scan(path, num_angles=720, num_slices=8, num_rays=384, angular_range=360, COR=150.4)
+    COR = synthetic_data.get_scan_COR(path)
+    for proj_downsample in [1, 2, 4]:
+        profile = cor_finder.estimate_cor_profile(path, proj_downsample=proj_downsample)
+        print(f"    proj_downsample {proj_downsample}: {profile}")
+        assert abs(profile(profile.reference_slice) - COR) <= 0.25, f"COR profile at proj_downsample {proj_downsample} found COR {profile(profile.reference_slice):g}, but scan COR is {COR:g}"
+
+# fused/threaded versions of stages must give the same results as the code they replaced (up to float32 rounding)
+
+def _assert_close(name, result, expected, tolerance=1e-5):
+    assert result.shape == expected.shape, f"{name} has shape {result.shape}, but expected {expected.shape}"
+    error = float(np.max(np.abs(result - expected))) / max(float(np.max(np.abs(expected))), 1e-30)
+    print(f"    {name}: largest difference {error:.2g} of largest value")
+    assert error <= tolerance, f"{name} differs by up to {error:.2g} of largest value (tolerance {tolerance:g})"
+
+def _legacy_sino_360_to_180(data, overlap=0, rotation='left'):
+    # sino_360_to_180 before it took fractional overlaps (from Dula's legacy "reconstruction.py"), integer overlap only
+    dx, dy, dz = data.shape
+    n = dx//2
+    out = np.zeros((n, dy, 2*dz-overlap), dtype=data.dtype)
+    if rotation == 'left':
+        weights = (np.arange(overlap)+0.5)/overlap
+        out[:, :, -dz+overlap:] = data[:n, :, overlap:]
+        out[:, :, :dz-overlap] = data[n:2*n, :, overlap:][:, :, ::-1]
+        out[:, :, dz-overlap:dz] = weights*data[:n, :, :overlap] + (weights*data[n:2*n, :, :overlap])[:, :, ::-1]
+    elif rotation == 'right':
+        weights = (np.arange(overlap)[::-1]+0.5)/overlap
+        out[:, :, :dz-overlap] = data[:n, :, :-overlap]
+        out[:, :, -dz+overlap:] = data[n:2*n, :, :-overlap][:, :, ::-1]
+        out[:, :, dz-overlap:dz] = weights*data[:n, :, -overlap:] + (weights*data[n:2*n, :, -overlap:])[:, :, ::-1]
+    return out
+
+@check("equivalence/bin_projections")
+def check_bin_projections(data_dir):
+    from skimage import transform
+    tomo, _ = als.read_data(synthetic_data.get_synthetic_scan(data_dir, "tiny"), preprocess_settings={'minimum_transmission': 0.01})
+    tomo = np.ascontiguousarray(tomo[:, :-1, :-3]) # so slices and rays aren't divisible by the factors
+    for factor in [2, 3, 4]:
+        expected = np.asarray([transform.downscale_local_mean(proj, (factor, factor), cval=0) for proj in tomo])
+        _assert_close(f"factor {factor}", als.bin_projections(tomo, factor), expected)
+
+@check("equivalence/normalize_log")
+def check_normalize_log(data_dir):
+    path = synthetic_data.get_synthetic_scan(data_dir, "tiny")
+    tomo, _, flat, dark = als.read_raw(path, dtype=np.float32)
+    expected = tomo.copy()
+    tomopy.normalize(expected, flat, dark, out=expected)
+    expected[expected < 0.01] = 0.01
+    tomopy.minus_log(expected, out=expected)
+    raw, _, _, _ = als.read_raw(path) # raw counts, as read_data passes them
+    _assert_close("raw counts", als.normalize_log(raw, flat, dark, minimum_transmission=0.01)[0], expected)
+    _assert_close("float32 in place", als.normalize_log(tomo, flat, dark, minimum_transmission=0.01)[0], expected)
+
+@check("equivalence/shift_images")
+def check_shift_images(data_dir):
+    from skimage import transform
+    tomo, _ = als.read_data(synthetic_data.get_synthetic_scan(data_dir, "tiny"), preprocess_settings={'minimum_transmission': 0.01})
+    for xshift, yshift in [(3, 0), (-2.3, 0), (1.6, -0.7)]:
+        # warp maps each output pixel to the input pixel it comes from, so the translation is the opposite of the shift
+        warp = transform.SimilarityTransform(translation=(-xshift, -yshift))
+        # (in float64, since warp interpolates float32 images in float32, which is less accurate than shift_images)
+        expected = np.asarray([transform.warp(proj.astype(np.float64), warp, order=1, mode='constant', cval=0, preserve_range=True) for proj in tomo])
+        _assert_close(f"shift ({xshift:g}, {yshift:g})", als.shift_images(tomo, xshift, yshift), expected)
+
+@check("equivalence/sino_360_to_180")
+def check_sino_360_to_180(data_dir):
+    tomo, _ = als.read_data(synthetic_data.get_synthetic_scan(data_dir, "tiny", angular_range=360), preprocess_settings={'minimum_transmission': 0.01})
+    for rotation in ['left', 'right']:
+        for overlap in [1, 20]:
+            _assert_close(f"{rotation}, overlap {overlap}", als.sino_360_to_180(tomo, overlap=overlap, rotation=rotation),
+                          _legacy_sino_360_to_180(tomo, overlap=overlap, rotation=rotation))
+
+@check("equivalence/finish_recon")
+def check_finish_recon(data_dir):
+    recon = np.random.default_rng(0).normal(1, 0.5, (5, 64, 64)).astype(np.float32)
+    for pxsize in [6.5e-5, 5e-7]: # 0.65 um, and under 10 nm (which is scaled by another 1000)
+        expected = als.mask_recon(recon.copy()) / pxsize
+        if pxsize < 1e-6:
+            expected *= 1000
+        _assert_close(f"pixel size {pxsize:g} cm", als.finish_recon(recon.copy(), pxsize), expected)
+
+def run_checks(names=None, data_dir=DEFAULT_DATA_DIR):
+    """ Runs correctness checks (all, or names matching any of the patterns in names). Returns names of the ones that failed """
+    failed = []
+    for name, function in CHECKS.items():
+        if names and not any(fnmatch.fnmatch(name, pattern) for pattern in names):
+            continue
+        print(f"Checking {name}")
+        try:
+            function(data_dir)
+        except AssertionError as e:
+            print(f"    FAILED: {e}")
+            failed.append(name)
+    return failed
+
+################################ running and comparing ################################
+
+def time_benchmark(run, prepare=None, repeat=3, warmup=1):
+    """ Runs benchmark warmup+repeat times and returns the times (in seconds) of the last repeat runs """
+    times = []
+    for i in range(warmup+repeat):
+        args = (prepare(),) if prepare is not None else ()
+        tic = time.perf_counter()
+        run(*args)
+        if i >= warmup:
+            times.append(time.perf_counter()-tic)
+    return times
+
+def get_run_info():
+    """ Git commit and machine the benchmarks ran on """
+    def git(*args):
+        try:
+            return subprocess.check_output(['git', *args], cwd=BENCHMARK_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        except Exception:
+            return None
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {'commit': git('rev-parse', 'HEAD'),
+            'dirty': bool(status) if status is not None else None,
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'machine': os.environ.get('NERSC_HOST') or platform.node(),
+            'processor': platform.processor() or platform.machine(),
+            'cpu_count': mp.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'tomopy': getattr(getattr(als, 'tomopy', None), '__version__', None),
+            'astra': getattr(getattr(als, 'astra', None), '__version__', None)} # (either may not be installed)
+
+def select_benchmarks(patterns=None):
+    """ Benchmark names matching any of patterns (shell-style, eg. "recon/*"). None means all """
+    if not patterns:
+        return list(BENCHMARKS)
+    return [name for name in BENCHMARKS if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+
+def run_benchmarks(sizes=("tiny", "small"), names=None, repeat=3, data_dir=DEFAULT_DATA_DIR, verbose=True):
+    """ Runs benchmarks on every size and returns results dictionary (run info, and one entry per benchmark and size)
+        sizes: which synthetic_data.SCAN_SIZES to run
+        names: which benchmarks (see select_benchmarks). None means all
+        repeat: timed runs per benchmark (median is used to compare)
+        data_dir: where synthetic scans are written (reused if already there)
+    """
+    os.environ.setdefault('SVMBIR_CACHE_DIR', os.path.join(data_dir, "svmbir_cache")) # NERSC cache isn't there on other machines
+    names = select_benchmarks() if names is None else names
+    results = {'info': get_run_info(), 'results': []}
+    for size in sizes:
+        scans = {}
+        for name in names:
+            options = BENCHMARKS[name]
+            if options['max_size'] is not None and SIZES.index(size) > SIZES.index(options['max_size']):
+                continue
+            angular_range = options['angular_range']
+            if angular_range not in scans:
+                scans[angular_range] = Scan(synthetic_data.get_synthetic_scan(data_dir, size, angular_range), size, angular_range)
+            scan = scans[angular_range]
+            run, prepare = options['setup'](scan)
+            if run is None:
+                if verbose: print(f"{name:>36} {size:>7}: skipped (not installed)")
+                continue
+            times = time_benchmark(run, prepare, repeat=options['repeat'] or repeat)
+            median = float(np.median(times))
+            results['results'].append({'name': name, 'size': size, 'angular_range': angular_range,
+                                       'shape': synthetic_data.SCAN_SIZES[size],
+                                       'times': times, 'median': median, 'min': float(np.min(times)),
+                                       'MB_per_second': scan.nbytes/1024**2/median})
+            if verbose: print(f"{name:>36} {size:>7}: {median:9.3f} sec (min {np.min(times):.3f}, {scan.nbytes/1024**2/median:8.1f} MB/s)")
+    return results
+
+def save_results(results, results_dir=DEFAULT_RESULTS_DIR):
+    """ Saves results as <date>_<commit>_<machine>.json in results_dir. Returns path """
+    info = results['info']
+    name = f"{info['time'].replace(':','')}_{(info['commit'] or 'nogit')[:8]}{'-dirty' if info['dirty'] else ''}_{info['machine']}.json"
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, name)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+    return path
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare_results(old, new, threshold=REGRESSION_THRESHOLD):
+    """ Prints median times of benchmarks in both old and new results. Returns list of (name, size, ratio) that got more than threshold slower """
+    old_times = {(r['name'], r['size']): r['median'] for r in old['results']}
+    print(f"Comparing to {(old['info']['commit'] or '?')[:8]} on {old['info']['machine']} ({old['info']['time']})")
+    if old['info']['machine'] != new['info']['machine']:
+        print("Warning: different machines, so times may not be comparable")
+    print(f"{'benchmark':>36} {'size':>7} {'before (s)':>11} {'after (s)':>10} {'ratio':>6}")
+    regressions = []
+    for r in new['results']:
+        key = (r['name'], r['size'])
+        if key not in old_times:
+            continue
+        ratio = r['median'] / old_times[key]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            regressions.append((r['name'], r['size'], ratio))
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(f"{r['name']:>36} {r['size']:>7} {old_times[key]:>11.3f} {r['median']:>10.3f} {ratio:>6.2f}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reconstruction paths on synthetic data (CPU only)")
+    parser.add_argument("--sizes", nargs="+", default=["tiny", "small"], choices=SIZES)
+    parser.add_argument("--only", nargs="+", default=None, help='benchmarks to run, eg. "recon/*" "read_data/*"')
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="where synthetic scans are written (and reused)")
+    parser.add_argument("--results-dir", default=DEFAULT_RESULTS_DIR)
+    parser.add_argument("--compare", default=None, help="earlier results file to compare to. Exits with code 1 if anything got slower")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="fraction slower that counts as a regression")
+    parser.add_argument("--list", action="store_true", help="list benchmarks and exit")
+    parser.add_argument("--check", action="store_true", help="run correctness checks (matching --only, if given) instead of benchmarks. Exits with code 1 if any fail")
+    args = parser.parse_args()
+
+    if args.check:
+        failed = run_checks(args.only, data_dir=args.data_dir)
+        print(f"{len(failed)} checks failed" if failed else "All checks passed")
+        if failed:
+            sys.exit(1)
+        return
+
+    names = select_benchmarks(args.only)
+    if args.list:
+        print("\n".join(names))
+        return
+    results = run_benchmarks(args.sizes, names, repeat=args.repeat, data_dir=args.data_dir)
+    path = save_results(results, args.results_dir)
+    print(f"Results saved in {path}")
+    if args.compare:
+        regressions = compare_results(load_results(args.compare), results, threshold=args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmarks more than {args.threshold:.0%} slower")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
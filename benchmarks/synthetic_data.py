@@ -0,0 +1,213 @@
+"""
+synthetic_data.py
+Writes synthetic microCT scans (3D Shepp-Logan phantom) in the APS tomoscan hdf5 layout that ALS_recon_functions.read_metadata and read_data expect,
+so reconstruction code can be benchmarked and tested without beamline data
+Projections are computed analytically (exact line integrals through ellipsoids), then turned into raw detector counts with flat/dark fields,
+Poisson noise, miscalibrated detector columns (rings) and zingers (outliers). 180 degree scans and 360 degree offset-COR scans are supported
+
+Usage: python synthetic_data.py <output_dir> --size small --range 360
+"""
+
+import os
+import argparse
+import numpy as np
+import h5py
+
+# (angles, slices, rays) of the scan sizes benchmarks run on. "large" has the angles and rays of a full 8.3.2 scan (but few slices)
+SCAN_SIZES = {
+    "tiny": (90, 8, 128),
+    "small": (360, 32, 512),
+    "medium": (1000, 64, 1280),
+    "large": (1969, 64, 2560),
+}
+
+# 3D Shepp-Logan phantom (Kak & Slaney), in units of the object radius: density, semi-axes (a,b,c), center (x0,y0,z0), rotation about z in degrees
+PHANTOM_ELLIPSOIDS = np.array([
+    [ 1.0, .6900, .920, .810,  0.00,  0.0000,  0.00,   0],
+    [-0.8, .6624, .874, .780,  0.00, -0.0184,  0.00,   0],
+    [-0.2, .1100, .310, .220,  0.22,  0.0000,  0.00, -18],
+    [-0.2, .1600, .410, .280, -0.22,  0.0000,  0.00,  18],
+    [ 0.1, .2100, .250, .410,  0.00,  0.3500, -0.15,   0],
+    [ 0.1, .0460, .046, .050,  0.00,  0.1000,  0.25,   0],
+    [ 0.1, .0460, .046, .050,  0.00, -0.1000,  0.25,   0],
+    [ 0.1, .0460, .023, .050, -0.08, -0.6050,  0.00,   0],
+    [ 0.1, .0230, .023, .020,  0.00, -0.6060,  0.00,   0],
+    [ 0.1, .0230, .046, .020,  0.06, -0.6050,  0.00,   0],
+])
+
+def get_object_radius(num_rays, COR=0, angular_range=180):
+    """ Radius (in pixels) of the phantom, so it stays inside the field of view
+        num_rays: detector width in pixels
+        COR: center of rotation, in pixels from center of detector
+        angular_range: 180, or 360 for offset-COR scans (object can be up to twice as wide as the detector)
+    """
+    if angular_range > 300:
+        return 0.95*(num_rays/2 + abs(COR))
+    return 0.95*(num_rays/2 - abs(COR))
+
+def _slice_z(slices, num_slices):
+    # height of slices in units of the object radius, so phantom fills the height of the scan
+    return (np.asarray(slices) + 0.5 - num_slices/2) / (num_slices/2)
+
+def phantom_projections(angles, slices, num_slices, num_rays, COR=0, radius=None):
+    """ Line integrals of the phantom (in units of object radius). Returns float32 array (angles,slices,rays), same layout as tomo
+        angles: projection angles, in radians
+        slices: which slice heights to compute (indices out of num_slices)
+        COR: center of rotation, in pixels from center of detector (same convention as the rest of the package, ie. tomopy center = COR + num_rays/2). Can be an array with one COR per slice (tilted rotation axis)
+        radius: object radius in pixels. None means get_object_radius(num_rays, COR)
+    """
+    COR = np.asarray(COR, dtype=np.float64)
+    if radius is None:
+        radius = get_object_radius(num_rays, np.max(np.abs(COR)))
+    angles = np.asarray(angles, dtype=np.float64)[:, None, None]
+    z = _slice_z(slices, num_slices)[None, :, None]
+    t = ((np.arange(num_rays)[None, :] + 0.5 - (num_rays/2 + COR.reshape(-1, 1))) / radius)[None] # detector position relative to rotation axis
+    proj = np.zeros((angles.shape[0], z.shape[1], num_rays), dtype=np.float32)
+    for rho, a, b, c, x0, y0, z0, phi in PHANTOM_ELLIPSOIDS:
+        scale2 = 1 - ((z - z0)/c)**2 # ellipsoid cross section at height z is the ellipse scaled by sqrt(scale2)
+        if not np.any(scale2 > 0):
+            continue
+        alpha = angles - np.deg2rad(phi)
+        a2 = (a*np.cos(alpha))**2 + (b*np.sin(alpha))**2
+        tt = t - (x0*np.cos(angles) + y0*np.sin(angles))
+        chord2 = np.maximum(scale2*a2 - tt**2, 0)
+        proj += (2*rho*a*b*np.sqrt(chord2)/a2).astype(np.float32)
+    return proj
+
+def phantom_slices(slices, num_slices, size, radius=None):
+    """ Ground truth attenuation (per object radius) of the phantom at the given slice heights. Returns float32 array (slices,size,size)
+        size: image width, in pixels. Rotation axis is at the center of the image
+        radius: object radius in pixels. None means 0.95*size/2
+    """
+    if radius is None:
+        radius = 0.95*size/2
+    x = (np.arange(size) + 0.5 - size/2) / radius
+    X, Y = np.meshgrid(x, -x, indexing="xy") # y points up (row 0 is the top of the image), same as reconstructions
+    z = _slice_z(slices, num_slices)
+    image = np.zeros((len(z), size, size), dtype=np.float32)
+    for rho, a, b, c, x0, y0, z0, phi in PHANTOM_ELLIPSOIDS:
+        cos, sin = np.cos(np.deg2rad(phi)), np.sin(np.deg2rad(phi))
+        xr = (X - x0)*cos + (Y - y0)*sin
+        yr = -(X - x0)*sin + (Y - y0)*cos
+        inside = (xr/a)**2 + (yr/b)**2 + ((z[:, None, None] - z0)/c)**2 <= 1
+        image += rho*inside
+    return image
+
+def write_synthetic_scan(path, num_angles=360, num_slices=32, num_rays=512, angular_range=180, COR=0, COR_slope=0,
+                         max_attenuation=2., flat_counts=4000., dark_counts=100.,
+                         num_flats=10, num_darks=10,
+                         rings=True, outliers=True, noise=True,
+                         pixel_size_um=6.5, energy_keV=25., distance_mm=50.,
+                         seed=0, block_slices=16):
+    """ Writes a synthetic scan to an .h5 file in APS tomoscan format. Returns path
+        path: .h5 file to write (overwritten)
+        angular_range: 180 (angles 0 to 180 inclusive, like ALS 180 degree scans) or 360 (num_angles evenly spaced over 360, so angle i+num_angles/2 is angle i + 180)
+        COR: center of rotation, in pixels from center of detector. For 360 degree offset scans use a large COR, eg. num_rays/2 - 100 (100 pixel overlap)
+        COR_slope: change in COR per slice, to simulate a tilted rotation axis (COR is at the middle slice). Each slice is shifted sideways, which is what a small tilt does to projections
+        max_attenuation: line integral through the thickest part of the phantom (sets how dark the sample is, exp(-2) ~ 14% transmission)
+        flat_counts, dark_counts: detector counts of the open beam and the dark current
+        rings: if True, 1% of detector columns respond a few percent differently than in the flat field (gives stripes in sinograms, rings in reconstructions)
+        outliers: if True, 0.01% of pixels are zingers (saturated counts)
+        noise: if True, Poisson noise on projections and flat/dark fields
+        pixel_size_um, energy_keV, distance_mm: metadata values
+        seed: random seed, so the same call always writes the same data
+        block_slices: slices simulated at once (limits memory)
+    """
+    rng = np.random.default_rng(seed)
+    if angular_range > 300:
+        theta = np.linspace(0., 360., num_angles, endpoint=False)
+    else:
+        theta = np.linspace(0., 180., num_angles)
+    slice_COR = COR + COR_slope*(np.arange(num_slices) + 0.5 - num_slices/2)
+    radius = get_object_radius(num_rays, np.max(np.abs(slice_COR)), angular_range)
+    thickest = phantom_projections(np.deg2rad(theta[::max(num_angles//32, 1)]), [num_slices//2], num_slices, num_rays, COR=COR, radius=radius).max()
+    scale = max_attenuation / thickest
+
+    # detector: smooth gain variation across the field, plus a few columns whose response drifted since the flat was taken
+    gain = 1 + 0.1*np.cos(np.linspace(-1, 1, num_rays))[None, :] * np.ones((num_slices, 1))
+    gain *= 1 + 0.02*rng.standard_normal((num_slices, num_rays))
+    drift = np.ones(num_rays)
+    if rings:
+        bad = rng.choice(num_rays, size=max(num_rays//100, 1), replace=False)
+        drift[bad] = 1 + rng.uniform(-0.05, 0.05, size=bad.size)
+
+    def counts(mean):
+        return rng.poisson(mean) if noise else mean
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('/measurement/instrument/detector/dimension_y', data=[num_slices])
+        f.create_dataset('/measurement/instrument/detector/dimension_x', data=[num_rays])
+        f.create_dataset('/measurement/instrument/detector/pixel_size', data=[pixel_size_um/1000]) # mm
+        f.create_dataset('/process/acquisition/rotation/num_angles', data=[num_angles])
+        f.create_dataset('/measurement/instrument/camera_motor_stack/setup/camera_distance', data=[0., distance_mm])
+        f.create_dataset('/measurement/instrument/monochromator/energy', data=[energy_keV*1000]) # eV
+        f.create_dataset('/process/acquisition/rotation/range', data=[float(angular_range)])
+        f.create_dataset('/exchange/theta', data=theta)
+        f['/exchange'].attrs['synthetic'] = True
+        f['/exchange'].attrs['COR'] = COR
+        f['/exchange'].attrs['COR_slope'] = COR_slope
+
+        flat = flat_counts*gain
+        f.create_dataset('/exchange/data_white', data=np.clip(counts(flat[None]*np.ones((num_flats,1,1))) + dark_counts, 0, 65535).astype(np.uint16))
+        f.create_dataset('/exchange/data_dark', data=np.clip(counts(dark_counts*np.ones((num_darks, num_slices, num_rays))), 0, 65535).astype(np.uint16))
+        data = f.create_dataset('/exchange/data', shape=(num_angles, num_slices, num_rays), dtype=np.uint16,
+                                chunks=(1, num_slices, num_rays)) # one chunk per projection, like the detector writes them
+
+        for start in range(0, num_slices, block_slices):
+            stop = min(start+block_slices, num_slices)
+            proj = phantom_projections(np.deg2rad(theta), np.arange(start, stop), num_slices, num_rays, COR=slice_COR[start:stop], radius=radius)
+            mean = (flat[None, start:stop]*drift) * np.exp(-scale*proj)
+            block = counts(mean) + dark_counts
+            if outliers:
+                zingers = rng.random(block.shape) < 1e-4
+                block[zingers] = 65535
+            data[:, start:stop, :] = np.clip(block, 0, 65535).astype(np.uint16)
+    return path
+
+def get_synthetic_scan(directory, size="small", angular_range=180, overwrite=False, **kwargs):
+    """ Path of a synthetic scan of one of the SCAN_SIZES, writing it first if it isn't in directory already
+        angular_range: 180 (COR a few pixels off center) or 360 (offset COR, 10% overlap)
+        kwargs: passed to write_synthetic_scan
+    """
+    num_angles, num_slices, num_rays = SCAN_SIZES[size]
+    if angular_range > 300:
+        COR = num_rays/2 - num_rays//20
+    else:
+        COR = 3.5
+    kwargs.setdefault('COR', COR)
+    tilt = f"_slope{kwargs['COR_slope']:g}" if kwargs.get('COR_slope') else "" # tilted scans are kept separately
+    path = os.path.join(directory, f"synthetic_{size}_{int(angular_range)}{tilt}.h5")
+    if overwrite or not os.path.exists(path):
+        print(f"Writing {path} ({num_angles} angles, {num_slices} slices, {num_rays} rays)")
+        write_synthetic_scan(path, num_angles, num_slices, num_rays, angular_range=angular_range, **kwargs)
+    return path
+
+def get_scan_COR(path, slices=None):
+    """ True center of rotation of a synthetic scan, in pixels from center of detector
+        slices: slice numbers to get COR of (differs between slices if axis is tilted). None means COR at the middle slice
+    """
+    with h5py.File(path, 'r') as f:
+        COR = f['/exchange'].attrs['COR']
+        COR_slope = f['/exchange'].attrs.get('COR_slope', 0)
+        num_slices = f['/exchange/data'].shape[1]
+    if slices is None:
+        return COR
+    return COR + COR_slope*(np.asarray(slices) + 0.5 - num_slices/2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic scans in APS tomoscan hdf5 format")
+    parser.add_argument("output_dir")
+    parser.add_argument("--size", default="small", choices=list(SCAN_SIZES))
+    parser.add_argument("--range", type=int, default=180, choices=[180, 360], help="angular range of scan")
+    parser.add_argument("--no-rings", action="store_true")
+    parser.add_argument("--no-outliers", action="store_true")
+    parser.add_argument("--no-noise", action="store_true")
+    parser.add_argument("--cor-slope", type=float, default=0, help="change in COR per slice (tilted rotation axis)")
+    args = parser.parse_args()
+    get_synthetic_scan(args.output_dir, args.size, args.range, overwrite=True,
+                       rings=not args.no_rings, outliers=not args.no_outliers, noise=not args.no_noise, COR_slope=args.cor_slope)
+
+if __name__ == "__main__":
+    main()